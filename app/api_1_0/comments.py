@@ -3,27 +3,32 @@ from .. import db
 from ..models import Post, Permission, Comment
 from . import api
 from .decorators import permission_required
+from ..pagination import KeysetPagination
+from ..mentions import record_mentions
 
 
 @api.route('/comments/')
 def get_comments():
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+    pagination = KeysetPagination(Comment.query,
+        (Comment.timestamp, Comment.id), request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
     comments = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_comments', page=page-1, _external=True)
+        prev = url_for('api.get_comments', cursor=pagination.prev_cursor,
+                       _external=True)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_comments', page=page+1, _external=True)
-    return jsonify({
+        next = url_for('api.get_comments', cursor=pagination.next_cursor,
+                       _external=True)
+    json_comments = {
         'comments': [comment.to_json() for comment in comments],
         'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+        'next': next
+    }
+    if request.args.get('count'):
+        json_comments['count'] = pagination.total
+    return jsonify(json_comments)
 
 
 @api.route('/comments/<int:id>')
@@ -64,6 +69,7 @@ def new_post_comment(id):
     comment.author = g.current_user
     comment.post = post
     db.session.add(comment)
+    record_mentions(comment)
     db.session.commit()
     return jsonify(comment.to_json()), 201, \
         {'Location': url_for('api.get_comment', id=comment.id,
@@ -4,27 +4,31 @@ from ..models import Post, Permission
 from . import api
 from .decorators import permission_required
 from .errors import forbidden
+from ..pagination import KeysetPagination
 
 
 @api.route('/posts/')
 def get_posts():
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.paginate(
-        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    pagination = KeysetPagination(Post.query, (Post.timestamp, Post.id),
+        request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_posts', page=page-1, _external=True)
+        prev = url_for('api.get_posts', cursor=pagination.prev_cursor,
+                       _external=True)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_posts', page=page+1, _external=True)
-    return jsonify({
+        next = url_for('api.get_posts', cursor=pagination.next_cursor,
+                       _external=True)
+    json_posts = {
         'posts': [post.to_json() for post in posts],
         'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+        'next': next
+    }
+    if request.args.get('count'):
+        json_posts['count'] = pagination.total
+    return jsonify(json_posts)
 
 
 @api.route('/posts/<int:id>')
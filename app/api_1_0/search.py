@@ -0,0 +1,33 @@
+from flask import jsonify, request, url_for, current_app
+from . import api
+from ..search import search as search_documents
+
+
+@api.route('/search')
+def search():
+    q = request.args.get('q', '')
+    kind = request.args.get('kind') or None
+    pagination = search_documents(
+        q, kind, request.args.get('page', 1, type=int),
+        per_page=current_app.config['FLASKY_SEARCH_RESULTS_PER_PAGE'],
+        external=True)
+    prev = None
+    if pagination.has_prev:
+        prev = url_for('api.search', q=q, kind=kind,
+                       page=pagination.prev_num, _external=True)
+    next = None
+    if pagination.has_next:
+        next = url_for('api.search', q=q, kind=kind,
+                       page=pagination.next_num, _external=True)
+    return jsonify({
+        'results': [{
+            'kind': hit.kind,
+            'id': hit.item.id,
+            'title': hit.title,
+            'snippet': hit.text,
+            'url': hit.url
+        } for hit in pagination.items],
+        'prev': prev,
+        'next': next,
+        'count': pagination.total
+    })
@@ -0,0 +1,154 @@
+import os
+import uuid
+from datetime import datetime
+from flask import jsonify, request, g, url_for, current_app
+from werkzeug.http import parse_content_range_header
+from .. import db
+from ..models import Post, Lesson, LessonFile, Upload, Permission, \
+    allowed_file
+from ..store import CHUNK_SIZE, put_file, blob_url, release
+from . import api
+from .decorators import permission_required
+from .errors import bad_request, forbidden, conflict
+
+
+# Large attachments are sent in pieces instead of one multipart body:
+#
+#   POST /uploads/ {"filename": ..., "size": ...}    -> 201, Location
+#   PUT  /uploads/<id>  (raw bytes, Content-Range)    -> new offset
+#   GET  /uploads/<id>                                -> offset to resume at
+#   POST /uploads/<id>/complete {"target": "post", "id": 1, "field": "file4"}
+#
+# Each chunk is streamed straight onto the end of the partial file, so
+# memory use does not depend on the chunk or file size, and a dropped
+# connection only loses the chunk in flight.  Completing moves the file into
+# the upload store and attaches it to an existing post, lesson or lesson
+# file, the same columns the upload forms fill in.
+
+UPLOAD_TARGETS = {
+    'post': (Post, ('file1', 'file2', 'file3', 'file4', 'file5')),
+    'lesson': (Lesson, ('file1', 'file2', 'file3', 'file4',
+                        'file5', 'file6', 'file7', 'file8')),
+    'lessonfile': (LessonFile, ('file',)),
+}
+
+
+def upload_response(upload, status=200):
+    response = jsonify(upload.to_json())
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(upload.offset)
+    return response
+
+
+def get_own_upload(id):
+    upload = Upload.query.get_or_404(id)
+    if upload.user_id != g.current_user.id:
+        return None
+    return upload
+
+
+def can_attach(user, row):
+    if user.can(Permission.ADMINISTER):
+        return True
+    if isinstance(row, Post):
+        return row.author_id == user.id
+    if isinstance(row, LessonFile):
+        row = Lesson.query.get(row.lesson_id)
+    return row is not None and row.teacher_id == user.id
+
+
+@api.route('/uploads/', methods=['POST'])
+@permission_required(Permission.WRITE_ARTICLES)
+def new_upload():
+    json_upload = request.json or {}
+    filename = json_upload.get('filename')
+    size = json_upload.get('size')
+    if not filename or len(filename) > 64 or not allowed_file(filename):
+        return bad_request('file type not allowed')
+    if not isinstance(size, int) or size < 0 or \
+            size > current_app.config['FLASKY_UPLOAD_MAX_SIZE']:
+        return bad_request('invalid size')
+    upload = Upload(id=uuid.uuid4().hex, filename=filename, size=size,
+                    user_id=g.current_user.id)
+    directory = os.path.dirname(upload.path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    open(upload.path, 'wb').close()
+    db.session.add(upload)
+    db.session.commit()
+    response = upload_response(upload, 201)
+    response.headers['Location'] = url_for('api.get_upload', id=upload.id,
+                                           _external=True)
+    return response
+
+
+@api.route('/uploads/<id>')
+@permission_required(Permission.WRITE_ARTICLES)
+def get_upload(id):
+    upload = get_own_upload(id)
+    if upload is None:
+        return forbidden('权限不够')
+    return upload_response(upload)
+
+
+@api.route('/uploads/<id>', methods=['PUT'])
+@permission_required(Permission.WRITE_ARTICLES)
+def put_upload_chunk(id):
+    upload = get_own_upload(id)
+    if upload is None:
+        return forbidden('权限不够')
+    offset = upload.offset
+    length = request.content_length
+    if length is None:
+        return bad_request('Content-Length required')
+    content_range = parse_content_range_header(
+        request.headers.get('Content-Range'))
+    if content_range is not None and content_range.start is not None:
+        if content_range.start != offset:
+            response = conflict('expected offset %d' % offset)
+            response.headers['Upload-Offset'] = str(offset)
+            return response
+        if content_range.stop - content_range.start != length or \
+                content_range.length not in (None, upload.size):
+            return bad_request('Content-Range does not match the upload')
+    if offset + length > upload.size:
+        return bad_request('chunk runs past the end of the upload')
+    with open(upload.path, 'ab') as f:
+        while length > 0:
+            chunk = request.stream.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            f.write(chunk)
+            length -= len(chunk)
+    upload.timestamp = datetime.utcnow()
+    db.session.add(upload)
+    return upload_response(upload)
+
+
+@api.route('/uploads/<id>/complete', methods=['POST'])
+@permission_required(Permission.WRITE_ARTICLES)
+def complete_upload(id):
+    upload = get_own_upload(id)
+    if upload is None:
+        return forbidden('权限不够')
+    if upload.offset != upload.size:
+        response = conflict('upload is incomplete')
+        response.headers['Upload-Offset'] = str(upload.offset)
+        return response
+    json_target = request.json or {}
+    target = UPLOAD_TARGETS.get(json_target.get('target'))
+    field = json_target.get('field', 'file')
+    if target is None or field not in target[1]:
+        return bad_request('invalid target')
+    row = target[0].query.get_or_404(json_target.get('id'))
+    if not can_attach(g.current_user, row):
+        return forbidden('权限不够')
+
+    blob, created = put_file(upload.path, upload.filename)
+    release(getattr(row, field))
+    setattr(row, field, blob_url(blob))
+    setattr(row, field.replace('file', 'filename', 1), upload.filename)
+    db.session.delete(upload)
+    db.session.commit()
+    return jsonify({'url': blob_url(blob), 'filename': upload.filename,
+                    'size': blob.size, 'sha256': blob.sha256})
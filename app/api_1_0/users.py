@@ -1,6 +1,7 @@
 from flask import jsonify, request, current_app, url_for
 from . import api
-from ..models import User, Post,Student,Letter
+from ..models import User, Post,Student,Letter,Timeline
+from ..pagination import KeysetPagination
 
 
 @api.route('/users/<int:id>')
@@ -29,44 +30,49 @@ def get_user_by_username(username):
 @api.route('/users/<int:id>/posts/')
 def get_user_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    pagination = KeysetPagination(user.posts, (Post.timestamp, Post.id),
+        request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_user_posts', page=page-1, _external=True)
+        prev = url_for('api.get_user_posts', id=id,
+                       cursor=pagination.prev_cursor, _external=True)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_user_posts', page=page+1, _external=True)
-    return jsonify({
+        next = url_for('api.get_user_posts', id=id,
+                       cursor=pagination.next_cursor, _external=True)
+    json_posts = {
         'posts': [post.to_json() for post in posts],
         'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+        'next': next
+    }
+    if request.args.get('count'):
+        json_posts['count'] = pagination.total
+    return jsonify(json_posts)
 
 
 @api.route('/users/<int:id>/timeline/')
 def get_user_followed_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    pagination = KeysetPagination(user.followed_posts,
+        (Timeline.timestamp, Timeline.post_id), request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+        key=lambda post: (post.timestamp, post.id))
     posts = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_user_followed_posts', page=page-1,
-                       _external=True)
+        prev = url_for('api.get_user_followed_posts', id=id,
+                       cursor=pagination.prev_cursor, _external=True)
     next = None
     if pagination.has_next:
-        next = url_for('api.get_user_followed_posts', page=page+1,
-                       _external=True)
-    return jsonify({
+        next = url_for('api.get_user_followed_posts', id=id,
+                       cursor=pagination.next_cursor, _external=True)
+    json_posts = {
         'posts': [post.to_json() for post in posts],
         'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+        'next': next
+    }
+    if request.args.get('count'):
+        json_posts['count'] = pagination.total
+    return jsonify(json_posts)
@@ -0,0 +1,159 @@
+import colorsys
+import hashlib
+import io
+import os
+import re
+from flask import current_app, request, url_for, send_from_directory, \
+    abort
+from PIL import Image, ImageDraw, ImageOps
+from .images import write
+from .render import LRUCache
+
+
+# Avatars are served from local, pre-sized renditions instead of gravatar.
+# An upload is cropped square and written once per size under a name taken
+# from a hash of its bytes:
+#
+#   avatar/3f9a...c1.40.jpg     avatar/3f9a...c1.80.jpg     ...200.jpg
+#
+# User.avatar_file keeps "3f9a...c1.jpg" and avatar_url() derives the
+# rendition for the size a template asks for.  Users without an upload get
+# an identicon drawn from avatar_hash.  Identicons are drawn in memory on
+# each request, never written to disk, since anyone can ask for any hash.
+# Both names change whenever the picture does, so they are served with
+# far-future cache headers.  avatar_url() is memoized on the fields it
+# reads, so long post lists do not rebuild the same URL row after row.
+
+SIZES = (40, 80, 200)
+MAX_AGE = 365 * 24 * 3600
+IDENTICON_CELLS = 5
+
+IDENTICON_NAME = re.compile(r'^([0-9a-f]{32})\.(\d+)\.png$')
+
+urls = LRUCache('FLASKY_AVATAR_URL_CACHE_SIZE')
+
+
+def rendition_size(size):
+    for s in SIZES:
+        if s >= size:
+            return s
+    return SIZES[-1]
+
+
+def avatar_folder():
+    return os.path.join(current_app.static_folder, 'avatar')
+
+
+def save_avatar(file):
+    data = file.read()
+    key = hashlib.sha256(data).hexdigest()[:32]
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            image = ImageOps.exif_transpose(original)
+            image.load()
+    except (IOError, OSError, ValueError):
+        return None
+    image.info = {}
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    ext = '.png' if image.mode in ('RGBA', 'LA') else '.jpg'
+    folder = avatar_folder()
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    quality = current_app.config['FLASKY_IMAGE_QUALITY']
+    for size in SIZES:
+        path = os.path.join(folder, '%s.%d%s' % (key, size, ext))
+        if not os.path.exists(path):   # same picture uploaded before
+            write(ImageOps.fit(image, (size, size), Image.LANCZOS),
+                  path, quality)
+    return key + ext
+
+
+def build_url(avatar_file, avatar_hash, size):
+    if avatar_file and '/' in avatar_file:
+        # uploaded before renditions; see migrate_legacy()
+        return avatar_file
+    if avatar_file:
+        base, ext = os.path.splitext(avatar_file)
+        return url_for('main.avatar', filename='%s.%d%s' % (base, size, ext))
+    return url_for('main.identicon', filename='%s.%d.png' % (avatar_hash,
+                                                             size))
+
+
+def avatar_url(user, size=40):
+    size = rendition_size(size)
+    avatar_hash = user.avatar_hash or hashlib.md5(
+        user.email.encode('utf-8')).hexdigest()
+    key = (user.avatar_file, avatar_hash, size)
+    url = urls.get(key)
+    if url is None:
+        url = build_url(user.avatar_file, avatar_hash, size)
+        urls.set(key, url)
+    return url
+
+
+def identicon(avatar_hash, size):
+    digest = bytearray.fromhex(avatar_hash)
+    r, g, b = colorsys.hls_to_rgb(digest[0] / 255.0, 0.5, 0.6)
+    color = (int(r * 255), int(g * 255), int(b * 255))
+    image = Image.new('RGB', (size, size), (240, 240, 240))
+    draw = ImageDraw.Draw(image)
+    cell = size / (IDENTICON_CELLS + 1.0)
+    half = (IDENTICON_CELLS + 1) // 2
+    for i in range(IDENTICON_CELLS * half):
+        if not digest[1 + i] & 1:
+            continue
+        row, column = divmod(i, half)
+        # mirrored left to right
+        for c in set((column, IDENTICON_CELLS - 1 - column)):
+            x = cell / 2 + c * cell
+            y = cell / 2 + row * cell
+            draw.rectangle([int(round(x)), int(round(y)),
+                            int(round(x + cell)) - 1,
+                            int(round(y + cell)) - 1], fill=color)
+    return image
+
+
+def cached(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    response.headers['Cache-Control'] += ', immutable'
+    return response
+
+
+def send_avatar(filename):
+    return cached(send_from_directory(avatar_folder(), filename,
+                                      cache_timeout=MAX_AGE))
+
+
+def send_identicon(filename):
+    match = IDENTICON_NAME.match(filename)
+    if match is None or int(match.group(2)) not in SIZES:
+        abort(404)
+    response = current_app.response_class(mimetype='image/png')
+    response.set_etag(filename)
+    response.make_conditional(request)
+    if response.status_code == 200:
+        data = io.BytesIO()
+        identicon(match.group(1), int(match.group(2))).save(data, 'PNG')
+        response.set_data(data.getvalue())
+    return cached(response)
+
+
+def migrate_legacy(users):
+    prefix = current_app.static_url_path + '/'
+    n = 0
+    for user in users:
+        if not user.avatar_file or not user.avatar_file.startswith(prefix):
+            continue
+        path = os.path.join(current_app.static_folder,
+                            user.avatar_file[len(prefix):])
+        try:
+            with open(path, 'rb') as f:
+                avatar_file = save_avatar(f)
+        except (IOError, OSError):
+            avatar_file = None
+        if avatar_file is not None:
+            user.avatar_file = avatar_file
+            n += 1
+    return n
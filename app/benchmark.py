@@ -0,0 +1,175 @@
+import json
+import resource
+import time
+from base64 import b64encode
+from datetime import datetime
+from . import db, fake
+from .metrics import metrics
+from .models import User, Post, Comment, Follow, Teacher, Lesson, \
+    NewLesson, Student, Timeline
+
+
+# Route-level load benchmark.  seed() fills the database with a sized
+# app.fake dataset plus a known user, teacher and class to point the routes at;
+# run() drives each route through the test client and reports latency
+# percentiles and queries per request (from app.metrics); report() adds the
+# process's peak RSS for the whole run (ru_maxrss only ever grows, so it
+# cannot be split by route) and returns a JSON-serializable dict, so runs
+# can be diffed across commits.
+
+ROUTES = (
+    ('main.index', '/'),
+    ('main.blog', '/blog'),
+    ('main.user', '/user/{username}'),
+    ('main.post', '/post/{post_id}'),
+    ('main.lesson', '/lesson/{lesson_id}'),
+    ('main.teacher', '/teacher/{teacher_id}'),
+    ('main.current_lesson', '/current-lesson/{newlesson_id}'),
+    ('main.collection', '/collection/{user_id}'),
+    ('main.comments_on_me', '/comments-on-me/{user_id}'),
+    ('api.get_posts', '/api/v1.0/posts/'),
+    ('api.get_post', '/api/v1.0/posts/{post_id}'),
+    ('api.get_post_comments', '/api/v1.0/posts/{post_id}/comments/'),
+    ('api.get_user', '/api/v1.0/users/{user_id}'),
+    ('api.get_user_posts', '/api/v1.0/users/{user_id}/posts/'),
+    ('api.get_user_followed_posts', '/api/v1.0/users/{user_id}/timeline/'),
+)
+
+EMAIL = 'bench@example.com'
+PASSWORD = 'bench'
+
+
+def seed(scale=1.0, seed=None):
+    fake.generate(scale, seed)
+
+    user = User(email=EMAIL, username='bench', password=PASSWORD,
+                name='Bench', confirmed=True)
+    teacher = User(email='bench-teacher@example.com',
+                   username='bench-teacher', password=PASSWORD,
+                   name='Bench Teacher', confirmed=True, teacher=True)
+    db.session.add_all([user, teacher])
+    db.session.commit()
+    db.session.add(Teacher(teacher_id=teacher.id, about_teacher='teacher'))
+    lesson = Lesson(lesson_name='bench', about_lesson='lesson',
+                    teacher_id=teacher.id)
+    db.session.add(lesson)
+    db.session.commit()
+    newlesson = NewLesson(lesson_id=lesson.id, year='2017', season='spring',
+                          room_row=6, room_column=8)
+    db.session.add(newlesson)
+    db.session.commit()
+    db.session.add(Student(student_id=user.id, newlesson_id=newlesson.id,
+                           seat='0101', confirm=True))
+
+    # give the bench user a busy timeline and something to comment on
+    for other in User.query.filter(User.id != user.id).limit(50):
+        db.session.add(Follow(follower=user, followed=other))
+    post = Post(body='bench', author=user,
+                tag='newlessons_%d' % newlesson.id)
+    db.session.add(post)
+    db.session.commit()
+    for other in User.query.filter(User.id != user.id).limit(20):
+        db.session.add(Comment(body='comment', post=post, author=other))
+    db.session.commit()
+
+    User.add_self_follows()
+    User.reconcile_counters()
+    Teacher.rebuild_stats()
+    Timeline.rebuild()
+
+
+def targets():
+    user = User.query.filter_by(email=EMAIL).first()
+    if user is None:
+        return None
+    student = Student.query.filter_by(student_id=user.id).first()
+    newlesson = NewLesson.query.get(student.newlesson_id)
+    lesson = Lesson.query.get(newlesson.lesson_id)
+    return {
+        'username': user.username,
+        'user_id': user.id,
+        'post_id': Post.query.filter_by(author_id=user.id).first().id,
+        'lesson_id': lesson.id,
+        'teacher_id': Teacher.query.filter_by(
+            teacher_id=lesson.teacher_id).first().id,
+        'newlesson_id': newlesson.id,
+    }
+
+
+def dataset():
+    return dict((model.__tablename__, model.query.count())
+                for model in (User, Post, Comment, Follow, Lesson,
+                              NewLesson, Student))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(p / 100.0 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(app, ids, requests=50, english=True, routes=ROUTES):
+    sample_rate = app.config['FLASKY_METRICS_SAMPLE_RATE']
+    app.config['FLASKY_METRICS_SAMPLE_RATE'] = 1.0
+    client = app.test_client(use_cookies=True)
+    if english:
+        client.set_cookie('localhost', 'english', 'yes')
+    client.post('/login', data={'email': EMAIL, 'password': PASSWORD})
+    headers = {
+        'Authorization': 'Basic ' + b64encode(
+            (EMAIL + ':' + PASSWORD).encode('utf-8')).decode('utf-8'),
+        'Accept': 'application/json',
+    }
+    results = {}
+    try:
+        for endpoint, url in routes:
+            url = url.format(**ids)
+            kwargs = {'headers': headers} if endpoint.startswith('api.') \
+                else {}
+            client.get(url, **kwargs)   # warm up caches
+            metrics.clear()
+            latencies = []
+            statuses = {}
+            for i in range(requests):
+                started = time.time()
+                response = client.get(url, **kwargs)
+                latencies.append(time.time() - started)
+                statuses[response.status_code] = \
+                    statuses.get(response.status_code, 0) + 1
+            queries = sum(histograms['queries'].sum
+                          for histograms in metrics.endpoints.values())
+            results[endpoint] = {
+                'url': url,
+                'requests': requests,
+                'status': dict((str(code), n)
+                               for code, n in statuses.items()),
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'queries_per_request': float(queries) / requests,
+            }
+    finally:
+        app.config['FLASKY_METRICS_SAMPLE_RATE'] = sample_rate
+    return results
+
+
+def report(results, counts, commit=None):
+    return {
+        'commit': commit,
+        'timestamp': datetime.utcnow().isoformat(),
+        'dataset': counts,
+        'peak_rss_kb': peak_rss(),
+        'routes': results,
+    }
+
+
+def save(data, path):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
@@ -1,20 +1,155 @@
-from threading import Thread
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email import charset
 from flask import current_app, render_template
 from flask_mail import Message
-from . import mail
+from . import db, mail
+from .models import OutboxMessage
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+# Mail is not sent from the request.  send_email() renders the message into
+# the outbox table and wakes a small pool of worker threads
+# (FLASKY_MAIL_WORKERS, 0 sends inline), which:
+#
+# - claim up to FLASKY_MAIL_BATCH_SIZE due messages at a time, so several
+#   app processes can share one outbox without sending anything twice;
+# - send a batch, and the batches queued behind it, over one SMTP
+#   connection instead of connecting and logging in once per message;
+# - on a temporary failure push next_attempt back, doubling from
+#   FLASKY_MAIL_RETRY_DELAY up to FLASKY_MAIL_RETRY_MAX_DELAY, and give up
+#   after FLASKY_MAIL_MAX_ATTEMPTS or when the server refuses with a 5xx.
+#
+# A registration burst therefore costs one row per user and at most a few
+# threads and SMTP sessions.  Messages left behind by a restart are picked
+# up by the next poll or by "manage.py send_mail".  app/mailsink.py is a
+# local SMTP server that keeps what it receives, for tests and development.
+
+# a claimed message is sent again if its worker has not finished with it
+LEASE = timedelta(minutes=5)
+
+# Flask-Mail registers utf-8 with no body encoding, so a Chinese body goes
+# out as raw 8-bit text, which Flask-Mail 0.9.0 hands smtplib as a str it
+# cannot encode.  Quoted-printable keeps messages 7-bit and still readable.
+charset.add_charset('utf-8', charset.SHORTEST, charset.QP, 'utf-8')
+
+workers = []
+workers_lock = threading.Lock()
+wakeup = threading.Event()
 
 
 def send_email(to, subject, template, **kwargs):
     app = current_app._get_current_object()
-    msg = Message(app.config['FLASKY_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
-                  sender=app.config['FLASKY_MAIL_SENDER'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    message = OutboxMessage(
+        sender=app.config['FLASKY_MAIL_SENDER'], recipient=to,
+        subject=app.config['FLASKY_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
+        body=render_template(template + '.txt', **kwargs),
+        html=render_template(template + '.html', **kwargs))
+    db.session.add(message)
+    db.session.commit()
+    wake(app)
+    return message
+
+
+def wake(app):
+    count = app.config['FLASKY_MAIL_WORKERS']
+    if not count:
+        return send_pending()
+    with workers_lock:
+        while len(workers) < count:
+            worker = threading.Thread(target=work, args=[app])
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+    wakeup.set()
+
+
+def work(app):
+    with app.app_context():
+        while True:
+            wakeup.wait(app.config['FLASKY_MAIL_POLL_INTERVAL'])
+            wakeup.clear()
+            try:
+                send_pending()
+            except Exception:
+                app.logger.exception('Cannot send mail')
+            finally:
+                db.session.remove()
+
+
+def claim(limit):
+    now = datetime.utcnow()
+    batch = []
+    for message in OutboxMessage.query.filter(
+            OutboxMessage.next_attempt <= now).order_by(
+            OutboxMessage.next_attempt).limit(limit).all():
+        # of several workers reading the same row only one moves it on
+        if OutboxMessage.query.filter_by(
+                id=message.id, next_attempt=message.next_attempt).update(
+                {'next_attempt': now + LEASE}, synchronize_session=False):
+            batch.append(message)
+    db.session.commit()
+    return batch
+
+
+def retry(message, error, permanent=False):
+    config = current_app.config
+    message.attempts = (message.attempts or 0) + 1
+    message.last_error = str(error)[:256]
+    if permanent or message.attempts >= config['FLASKY_MAIL_MAX_ATTEMPTS']:
+        message.next_attempt = None
+        current_app.logger.warning('Giving up mail to %s: %s' %
+                                   (message.recipient, error))
+    else:
+        delay = min(config['FLASKY_MAIL_RETRY_DELAY'] *
+                    2 ** (message.attempts - 1),
+                    config['FLASKY_MAIL_RETRY_MAX_DELAY'])
+        message.next_attempt = datetime.utcnow() + timedelta(seconds=delay)
+
+
+def deliver(connection, message):
+    try:
+        connection.send(Message(message.subject, sender=message.sender,
+                                recipients=[message.recipient],
+                                body=message.body, html=message.html))
+    except smtplib.SMTPRecipientsRefused as e:
+        retry(message, e, permanent=True)
+    except smtplib.SMTPResponseException as e:
+        retry(message, e, permanent=e.smtp_code >= 500)
+    except OSError:
+        # the connection dropped (SMTPException is an OSError too)
+        raise
+    except Exception as e:
+        # a message that cannot be built or sent must not take the batch
+        # (or, sending inline, the request) down with it
+        current_app.logger.exception('Cannot send mail to %s' %
+                                     message.recipient)
+        retry(message, e)
+    else:
+        db.session.delete(message)
+        return True
+    return False
+
+
+def send_pending():
+    batch_size = current_app.config['FLASKY_MAIL_BATCH_SIZE']
+    sent = 0
+    batch = claim(batch_size)
+    if not batch:
+        return sent
+    try:
+        with mail.connect() as connection:
+            while batch:
+                while batch:
+                    if deliver(connection, batch[0]):
+                        sent += 1
+                    batch.pop(0)
+                db.session.commit()
+                batch = claim(batch_size)
+    except Exception as e:
+        # could not connect, log in, or the connection dropped
+        current_app.logger.warning('Cannot send mail: %s' % e)
+        for message in batch:
+            retry(message, e)
+        db.session.commit()
+    return sent
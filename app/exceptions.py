@@ -1,2 +1,6 @@
 class ValidationError(ValueError):
     pass
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
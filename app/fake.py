@@ -0,0 +1,285 @@
+import hashlib
+import random
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+from . import db, search
+from .main.seatmap import format_seat
+from .models import Role, User, Follow, Post, Comment, AtMe, Teacher, \
+    Lesson, NewLesson, Student, Timeline
+from .render import render_markdown
+
+
+# Bulk synthetic data.  The per-model generate_fake helpers commit after
+# every row and find each author with an OFFSET scan, which is fine for ten
+# rows and hopeless for a million.  Generator builds plain dicts with ids
+# assigned up front, so relationships need no round trips, and writes them
+# with bulk_insert_mappings in chunks.  Mapper events do not fire for bulk
+# inserts, so the denormalized counters and timelines are rebuilt once at
+# the end.  Text comes from a small pool rendered once, so the Markdown
+# pipeline is not the bottleneck either.
+
+# row counts at scale 1; --scale 100 gives 100k users and 1M posts
+SIZES = {
+    'users': 1000,
+    'posts': 10000,
+    'comments': 20000,
+    'teachers': 20,
+}
+FOLLOWS_PER_USER = 20
+LESSONS_PER_TEACHER = 3
+CLASSES_PER_LESSON = 2
+STUDENTS_PER_CLASS = 30
+ROOM_ROWS = 6
+ROOM_COLUMNS = 8
+CLASS_POST_RATIO = 0.1
+HOMEWORK_RATIO = 0.5
+MENTION_RATIO = 0.1
+POOL_SIZE = 200
+PASSWORD = 'password'
+
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def insert(model, rows, chunk):
+    n = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= chunk:
+            db.session.bulk_insert_mappings(model, batch)
+            db.session.commit()
+            n += len(batch)
+            batch = []
+    if batch:
+        db.session.bulk_insert_mappings(model, batch)
+        db.session.commit()
+        n += len(batch)
+    return n
+
+
+class Generator(object):
+    def __init__(self, scale=1.0, seed=None, now=None):
+        from forgery_py.dictionaries_loader import get_dictionary
+
+        self.rng = random.Random(seed)
+        self.now = now or datetime.utcnow()
+        self.start = self.now - timedelta(days=365)
+        self.sizes = dict((name, max(int(size * scale), 1))
+                          for name, size in SIZES.items())
+        self.sizes['users'] = max(self.sizes['users'], STUDENTS_PER_CLASS + 1)
+        self.sizes['teachers'] = min(self.sizes['teachers'],
+                                     self.sizes['users'])
+
+        # draw from forgery_py's word lists with our own generator so a
+        # seed reproduces the same dataset
+        def words(name):
+            return [word.strip() for word in get_dictionary(name)]
+        sentences = words('lorem_ipsum')
+        first_names = words('male_first_names') + words('female_first_names')
+        last_names = words('last_names')
+        self.texts = []
+        for i in range(POOL_SIZE):
+            text = ' '.join(self.rng.choice(sentences)
+                            for j in range(self.rng.randint(1, 5)))
+            self.texts.append((text, render_markdown(text)))
+        self.names = ['%s %s' % (self.rng.choice(first_names),
+                                 self.rng.choice(last_names))
+                      for i in range(POOL_SIZE)]
+        self.cities = words('cities')
+        self.password_hash = generate_password_hash(PASSWORD)
+        self.role_id = Role.query.filter_by(default=True).first().id
+
+        self.user0 = next_id(User)
+        self.post0 = next_id(Post)
+        self.comment0 = next_id(Comment)
+        self.teacher0 = next_id(Teacher)
+        self.lesson0 = next_id(Lesson)
+        self.newlesson0 = next_id(NewLesson)
+        self.student0 = next_id(Student)
+        self.atme0 = next_id(AtMe)
+
+    def text(self):
+        return self.rng.choice(self.texts)
+
+    # "@userN " comes through Markdown and bleach unchanged, so mentions
+    # reuse the pool's HTML instead of rendering every comment
+    def mention(self, username, text, html):
+        text = '@%s %s' % (username, text)
+        if html.startswith('<p>'):
+            return text, '<p>@%s %s' % (username, html[3:])
+        return text, render_markdown(text)
+
+    def user_id(self):
+        return self.user0 + self.rng.randrange(self.sizes['users'])
+
+    def username(self, user_id):
+        return 'user%d' % user_id
+
+    def teacher_ids(self):
+        return range(self.user0, self.user0 + self.sizes['teachers'])
+
+    def lesson_ids(self):
+        n = self.sizes['teachers'] * LESSONS_PER_TEACHER
+        return range(self.lesson0, self.lesson0 + n)
+
+    def newlesson_ids(self):
+        n = len(self.lesson_ids()) * CLASSES_PER_LESSON
+        return range(self.newlesson0, self.newlesson0 + n)
+
+    # posts are spread evenly over the last year in id order, so a
+    # comment can be dated after its post without looking the post up
+    def post_time(self, post_id):
+        span = (self.now - self.start).total_seconds()
+        offset = (post_id - self.post0) * span / self.sizes['posts']
+        return self.start + timedelta(seconds=offset)
+
+    def users(self):
+        teachers = self.sizes['teachers']
+        for i in range(self.sizes['users']):
+            user_id = self.user0 + i
+            email = 'user%d@example.com' % user_id
+            yield {
+                'id': user_id,
+                'email': email,
+                'username': self.username(user_id),
+                'password_hash': self.password_hash,
+                'role_id': self.role_id,
+                'confirmed': True,
+                'teacher': i < teachers,
+                'name': self.rng.choice(self.names),
+                'location': self.rng.choice(self.cities),
+                'about_me': self.text()[0],
+                'member_since': self.start -
+                    timedelta(days=self.rng.randint(0, 365)),
+                'last_seen': self.now -
+                    timedelta(minutes=self.rng.randint(0, 60 * 24 * 30)),
+                'avatar_hash': hashlib.md5(email.encode('utf-8')).hexdigest(),
+            }
+
+    def follows(self):
+        n = self.sizes['users']
+        k = min(FOLLOWS_PER_USER, n - 1)
+        for i in range(n):
+            follower_id = self.user0 + i
+            yield {'follower_id': follower_id, 'followed_id': follower_id,
+                   'timestamp': self.start}
+            for j in self.rng.sample(range(n - 1), k):
+                # skip over the follower itself
+                followed_id = self.user0 + (j if j < i else j + 1)
+                yield {'follower_id': follower_id,
+                       'followed_id': followed_id,
+                       'timestamp': self.start + timedelta(
+                           days=self.rng.randint(0, 365))}
+
+    def teachers(self):
+        for i, user_id in enumerate(self.teacher_ids()):
+            text, html = self.text()
+            yield {'id': self.teacher0 + i, 'teacher_id': user_id,
+                   'school': self.rng.choice(self.cities),
+                   'field': self.rng.choice(self.names),
+                   'about_teacher': text, 'about_teacher_html': html,
+                   'timestamp': self.start}
+
+    def lessons(self):
+        teachers = list(self.teacher_ids())
+        for i, lesson_id in enumerate(self.lesson_ids()):
+            text, html = self.text()
+            yield {'id': lesson_id,
+                   'teacher_id': teachers[i // LESSONS_PER_TEACHER],
+                   'lesson_name': 'Lesson %d' % lesson_id,
+                   'about_lesson': text, 'about_lesson_html': html,
+                   'timestamp': self.start}
+
+    def newlessons(self):
+        lessons = list(self.lesson_ids())
+        for i, newlesson_id in enumerate(self.newlesson_ids()):
+            yield {'id': newlesson_id,
+                   'lesson_id': lessons[i // CLASSES_PER_LESSON],
+                   'year': str(self.now.year),
+                   'season': self.rng.choice(['春', '夏', '秋', '冬']),
+                   'room_row': ROOM_ROWS, 'room_column': ROOM_COLUMNS,
+                   'timestamp': self.start}
+
+    def students(self):
+        student_id = self.student0
+        teachers = self.sizes['teachers']
+        pupils = range(self.user0 + teachers, self.user0 + self.sizes['users'])
+        seats = [format_seat(row, column)
+                 for row in range(1, ROOM_ROWS + 1)
+                 for column in range(1, ROOM_COLUMNS + 1)]
+        for newlesson_id in self.newlesson_ids():
+            members = self.rng.sample(pupils, min(STUDENTS_PER_CLASS,
+                                                  len(pupils)))
+            self.rng.shuffle(seats)
+            for i, user_id in enumerate(members):
+                row = {'id': student_id, 'student_id': user_id,
+                       'newlesson_id': newlesson_id, 'confirm': True,
+                       'seat': seats[i] if i < len(seats) else None,
+                       'absence': self.rng.randint(0, 3),
+                       'timestamp': self.start}
+                if self.rng.random() < HOMEWORK_RATIO:
+                    text, html = self.text()
+                    row.update(topic='Homework %d' % newlesson_id,
+                               body=text, body_html=html,
+                               score=self.rng.randint(60, 100))
+                yield row
+                student_id += 1
+
+    def posts(self):
+        newlessons = self.newlesson_ids()
+        for i in range(self.sizes['posts']):
+            post_id = self.post0 + i
+            text, html = self.text()
+            row = {'id': post_id, 'author_id': self.user_id(),
+                   'body': text, 'body_html': html, 'private': False,
+                   'timestamp': self.post_time(post_id)}
+            if newlessons and self.rng.random() < CLASS_POST_RATIO:
+                newlesson_id = self.rng.choice(newlessons)
+                row.update(tag='newlessons_%d' % newlesson_id,
+                           newlesson_id=newlesson_id)
+            yield row
+
+    def comments(self):
+        # AtMe rows are collected here and inserted after the comments
+        self.atmes = []
+        for i in range(self.sizes['comments']):
+            comment_id = self.comment0 + i
+            post_id = self.post0 + self.rng.randrange(self.sizes['posts'])
+            author_id = self.user_id()
+            timestamp = min(self.post_time(post_id) + timedelta(
+                minutes=self.rng.randint(1, 60 * 24 * 7)), self.now)
+            text, html = self.text()
+            if self.rng.random() < MENTION_RATIO:
+                mentioned = self.username(self.user_id())
+                text, html = self.mention(mentioned, text, html)
+                self.atmes.append({
+                    'id': self.atme0 + len(self.atmes),
+                    'comment_id': comment_id,
+                    'username_whoatme': self.username(author_id),
+                    'username': mentioned, 'timestamp': timestamp})
+            yield {'id': comment_id, 'post_id': post_id,
+                   'author_id': author_id, 'body': text, 'body_html': html,
+                   'disabled': False, 'timestamp': timestamp}
+
+
+def generate(scale=1.0, seed=None, chunk=10000):
+    generator = Generator(scale, seed)
+    counts = {}
+    for model, rows in ((User, generator.users),
+                        (Follow, generator.follows),
+                        (Teacher, generator.teachers),
+                        (Lesson, generator.lessons),
+                        (NewLesson, generator.newlessons),
+                        (Student, generator.students),
+                        (Post, generator.posts),
+                        (Comment, generator.comments)):
+        counts[model.__tablename__] = insert(model, rows(), chunk)
+    counts[AtMe.__tablename__] = insert(AtMe, generator.atmes, chunk)
+
+    User.reconcile_counters()
+    Teacher.rebuild_stats()
+    Timeline.rebuild()
+    search.rebuild()
+    return counts
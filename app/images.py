@@ -0,0 +1,170 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, g
+from jinja2 import Markup
+from PIL import Image, ImageOps
+from . import store
+
+
+# Uploaded pictures are written to the upload store (app/store.py) as they
+# arrive and the request returns straight away; decoding and resizing happen
+# on a small thread pool (FLASKY_IMAGE_WORKERS, 0 runs inline).  Each blob
+# gets a fixed set of renditions next to it:
+#
+#   store/3f/x.jpg          the upload, byte for byte (its name is its hash)
+#   store/3f/x.full.jpg     full: bounded to 1024x1024
+#   store/3f/x.card.jpg     card: what post, lesson and teacher pages show
+#   store/3f/x.thumb.jpg    thumb: avatar-sized
+#   store/3f/x.card.webp    and the same again as WebP if FLASKY_IMAGE_WEBP
+#
+# All of them are re-encoded from pixels, so EXIF (GPS, camera serials) is
+# dropped after the orientation has been applied.  Templates ask for a size
+# with image_url(); until a rendition exists it falls back to the upload.
+
+IMAGE_EXTENSIONS = ('.bmp', '.jif', '.jpg', '.jpeg', '.png')
+RENDITIONS = (
+    ('full', (1024, 1024)),
+    ('card', (512, 512)),
+    ('thumb', (80, 80)),
+)
+
+executor = None
+executor_lock = threading.Lock()
+ready = set()
+
+
+def rendition_name(filename, size, format=None):
+    base, ext = os.path.splitext(filename)
+    if format is None:
+        format = 'png' if ext.lower() == '.png' else 'jpg'
+    return '%s.%s.%s' % (base, size, format)
+
+
+def static_path(url):
+    prefix = current_app.static_url_path + '/'
+    if url is None or not url.startswith(prefix):
+        return None
+    return os.path.join(current_app.static_folder, url[len(prefix):])
+
+
+def processed(path):
+    return os.path.exists(rendition_name(path, RENDITIONS[-1][0]))
+
+
+def save_image(file):
+    blob, created = store.put(file.stream, file.filename)
+    # a repeated upload shares the blob and its renditions, but the blob
+    # may have been stored by save_file() without any
+    if created or not processed(store.blob_path(blob)):
+        schedule(store.blob_path(blob))
+    return store.blob_url(blob)
+
+
+def remove(path):
+    names = [path]
+    for size, box in RENDITIONS:
+        names.append(rendition_name(path, size))
+        names.append(rendition_name(path, size, 'webp'))
+    for name in names:
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+def schedule(path):
+    global executor
+    config = current_app.config
+    args = (path, config['FLASKY_IMAGE_WEBP'], config['FLASKY_IMAGE_QUALITY'],
+            current_app.logger)
+    workers = config['FLASKY_IMAGE_WORKERS']
+    if not workers:
+        return process(*args)
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=workers)
+    return executor.submit(process, *args)
+
+
+def write(image, path, quality):
+    if path.endswith('.jpg') and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format=Image.registered_extensions().get(
+                os.path.splitext(path)[1].lower(), 'JPEG'),
+                quality=quality, optimize=True)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def process(path, webp=False, quality=85, logger=None):
+    try:
+        with Image.open(path) as original:
+            image = ImageOps.exif_transpose(original)
+            image.load()
+        # pixels only: no EXIF, comments or thumbnails carried over
+        image.info = {}
+        for size, box in RENDITIONS:
+            rendition = image.copy()
+            rendition.thumbnail(box, Image.LANCZOS)
+            write(rendition, rendition_name(path, size), quality)
+            if webp:
+                write(rendition, rendition_name(path, size, 'webp'), quality)
+        return True
+    except (IOError, OSError, ValueError) as e:
+        if logger is not None:
+            logger.warning('Cannot process image %s: %s' % (path, e))
+        return False
+
+
+def rendition_url(url, size, format=None):
+    if not url:
+        return None
+    rendition = rendition_name(url, size, format)
+    if rendition in ready:
+        return rendition
+    path = static_path(rendition)
+    if path is not None and os.path.exists(path):
+        ready.add(rendition)
+        return rendition
+    return None
+
+
+def image_url(url, size='full'):
+    if not url or static_path(url) is None:
+        return url
+    rendition = rendition_url(url, size)
+    if rendition is None:
+        # keep the fallback out of cached fragments so the rendition is
+        # picked up once it has been generated
+        g.fragment_volatile = True
+        return url
+    return rendition
+
+
+def picture(url, size, caller):
+    html = caller()
+    webp = rendition_url(url, size, 'webp')
+    if webp is None:
+        return html
+    return Markup('<picture><source srcset="%s" type="image/webp">%s'
+                  '</picture>') % (webp, html)
+
+
+def pending(folder):
+    directory = os.path.join(current_app.static_folder, folder)
+    if not os.path.isdir(directory):
+        return
+    names = set(os.listdir(directory))
+    for name in sorted(names):
+        base, ext = os.path.splitext(name)
+        if ext.lower() not in IMAGE_EXTENSIONS or '.' in base:
+            continue     # not an image, or a rendition
+        if rendition_name(name, RENDITIONS[-1][0]) not in names:
+            yield os.path.join(directory, name)
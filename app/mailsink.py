@@ -0,0 +1,99 @@
+import re
+import socketserver
+import threading
+
+
+# A local stand-in for the SMTP server: it accepts every message and keeps
+# it in memory instead of delivering it.
+#
+#   sink = MailSink(('127.0.0.1', 0)).start()
+#   ... point MAIL_SERVER / MAIL_PORT at sink.port, send ...
+#   sink.messages     [(sender, [recipients], raw message bytes), ...]
+#
+# It speaks as much SMTP as smtplib needs (no TLS or AUTH, so use it with
+# MAIL_USE_SSL and MAIL_USE_TLS off), counts connections so tests can check
+# they are reused, and refuses the addresses in refuse with a 550.
+# "manage.py mailsink" runs one in the foreground for development.
+
+ADDRESS = re.compile(r'<([^>]*)>')
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line.rstrip(b'\r\n') == b'.':
+                return b''.join(lines)
+            if line.startswith(b'.'):
+                line = line[1:]
+            lines.append(line)
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 mailsink ready')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            match = ADDRESS.search(command)
+            if verb in ('HELO', 'EHLO', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'MAIL':
+                sender, recipients = match and match.group(1), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipient = match and match.group(1)
+                if recipient in server.refuse:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(recipient)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self.read_data()
+                with server.lock:
+                    server.messages.append((sender, recipients, data))
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class MailSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 1025)):
+        socketserver.ThreadingTCPServer.__init__(self, address, SMTPHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.refuse = set()
+        self.connections = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -4,8 +4,14 @@ main = Blueprint('main', __name__)
 
 from . import views, errors
 from ..models import Permission
+from ..render import cached_fragment
+from ..images import image_url, picture
+from ..avatars import avatar_url
+from ..media import media_url
 
 
 @main.app_context_processor
 def inject_permissions():
-    return dict(Permission=Permission)
+    return dict(Permission=Permission, cached_fragment=cached_fragment,
+                image_url=image_url, picture=picture, avatar_url=avatar_url,
+                media_url=media_url)
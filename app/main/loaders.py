@@ -0,0 +1,62 @@
+from .. import db
+from ..models import User, NewLesson, LessonFile, Post, Student
+
+
+# The lesson and teacher pages list every file, discussion and student under
+# a set of lessons.  Each helper below loads one level of that tree for all
+# lessons at once, so a page costs the same few queries however many
+# lessons, classes or students it shows.
+
+def group_by(rows, key):
+    groups = {}
+    for row in rows:
+        groups.setdefault(key(row), []).append(row)
+    return groups
+
+
+def load_newlessons(lessons):
+    ids = [lesson.id for lesson in lessons]
+    if not ids:
+        return {}
+    return group_by(NewLesson.query.filter(NewLesson.lesson_id.in_(ids)).
+                    order_by(NewLesson.timestamp.desc()).all(),
+                    lambda newlesson: newlesson.lesson_id)
+
+
+def load_lesson_files(lessons):
+    ids = [lesson.id for lesson in lessons]
+    if not ids:
+        return []
+    files = group_by(LessonFile.query.filter(LessonFile.lesson_id.in_(ids)).
+                     order_by(LessonFile.timestamp.desc()).all(),
+                     lambda lessonfile: lessonfile.lesson_id)
+    return [[lesson, lf] for lesson in lessons
+            for lf in files.get(lesson.id, [])]
+
+
+def load_lesson_discussions(lessons, newlessons):
+    ids = [nl.id for lesson in lessons for nl in newlessons.get(lesson.id, [])]
+    if not ids:
+        return []
+    posts = group_by(db.session.query(Post, User).
+                     outerjoin(User, User.id == Post.author_id).
+                     filter(Post.newlesson_id.in_(ids)).
+                     order_by(Post.timestamp.desc()).all(),
+                     lambda row: row[0].newlesson_id)
+    return [[lesson, nl, p, u] for lesson in lessons
+            for nl in newlessons.get(lesson.id, [])
+            for p, u in posts.get(nl.id, [])]
+
+
+def load_lesson_students(lessons, newlessons):
+    ids = [nl.id for lesson in lessons for nl in newlessons.get(lesson.id, [])]
+    if not ids:
+        return []
+    students = group_by(db.session.query(Student, User).
+                        outerjoin(User, User.id == Student.student_id).
+                        filter(Student.newlesson_id.in_(ids)).
+                        order_by(Student.timestamp.desc()).all(),
+                        lambda row: row[0].newlesson_id)
+    return [[lesson, nl, u, s] for lesson in lessons
+            for nl in newlessons.get(lesson.id, [])
+            for s, u in students.get(nl.id, [])]
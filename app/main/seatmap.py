@@ -0,0 +1,76 @@
+from .. import db
+from ..models import User, Student
+
+
+# Seats are stored on Student as "RRCC" strings ("0102" is row 1, column 2).
+# SeatMap parses them once into (row, column) keys so drawing the classroom
+# is a single pass over its cells.
+
+def parse_seat(seat):
+    if seat is None or len(seat) != 4 or not seat.isdigit():
+        return None
+    return int(seat[0:2]), int(seat[2:4])
+
+
+def format_seat(row, column):
+    return '%02d%02d' % (row, column)
+
+
+class SeatMap(object):
+    def __init__(self, newlesson, roster):
+        self.rows = newlesson.room_row or 0
+        self.columns = newlesson.room_column or 0
+        self.occupants = {}
+        for student, user in roster:
+            key = parse_seat(student.seat)
+            if key is not None and key not in self.occupants:
+                self.occupants[key] = (student, user)
+
+    @staticmethod
+    def load_roster(newlesson):
+        return db.session.query(Student, User).\
+            outerjoin(User, User.id == Student.student_id).\
+            filter(Student.newlesson_id == newlesson.id).\
+            order_by(Student.id).all()
+
+    @staticmethod
+    def load(newlesson):
+        return SeatMap(newlesson, SeatMap.load_roster(newlesson))
+
+    def occupant(self, seat):
+        key = parse_seat(seat)
+        if key is None:
+            return None
+        return self.occupants.get(key)
+
+    def cells(self):
+        for row in range(1, self.rows + 1):
+            for column in range(1, self.columns + 1):
+                yield row, column, self.occupants.get((row, column))
+
+    # flat row-major lists, the shape current_lesson.html indexes into
+    def seats(self):
+        seats = []
+        for row, column, occupant in self.cells():
+            if occupant is not None and occupant[1] is not None:
+                seats.append(occupant[1].name)
+            else:
+                seats.append(format_seat(row, column))
+        return seats
+
+    def absences(self):
+        return [occupant[0].absence if occupant else ''
+                for row, column, occupant in self.cells()]
+
+    def to_json(self):
+        grid = [[None] * self.columns for row in range(self.rows)]
+        for row, column, occupant in self.cells():
+            cell = {'seat': format_seat(row, column)}
+            if occupant is not None:
+                student, user = occupant
+                cell['absence'] = student.absence
+                if user is not None:
+                    cell['username'] = user.username
+                    cell['name'] = user.name
+            grid[row - 1][column - 1] = cell
+        return {'rows': self.rows, 'columns': self.columns, 'grid': grid}
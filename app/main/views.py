@@ -1,10 +1,10 @@
 from flask import render_template, redirect, request, url_for, flash,\
-                    abort, current_app, make_response
+                    abort, current_app, make_response, g, jsonify
 from flask_login import login_user, logout_user, login_required, current_user
 from .. import db
 from ..models import User,allowed_file,Teacher,Role,Lesson, Permission, Post, \
                     Comment,NewLesson,Student,CollectPost,Follow,LessonFile,\
-                    AtMe
+                    AtMe,Timeline,ClickTime
 from ..email import send_email
 from .forms import LoginForm, RegistrationForm, ChangePasswordForm,\
     PasswordResetRequestForm, PasswordResetForm, ChangeEmailForm,AddTeacherForm,\
@@ -16,20 +16,34 @@ from .forms import LoginForm, RegistrationForm, ChangePasswordForm,\
     PostFormE, CommentFormE, PostFormE2,AddLessonFormE,NewLessonFormE,\
     LessonFileForm,LessonFileFormE,CriticismForm,CriticismFormE
 from ..decorators import admin_required
-from PIL import Image
+from ..exceptions import QueryBudgetExceeded
+from ..pagination import KeysetPagination
+from ..presence import last_seen
+from ..images import save_image
+from ..store import save_file, release
+from ..media import send_media
+from ..avatars import save_avatar, send_avatar, send_identicon, avatar_url
+from ..metrics import metrics
+from ..search import search as search_documents
+from ..mentions import record_mentions, suggest
 from flask_sqlalchemy import get_debug_queries
 from . import main
+from .loaders import load_newlessons, load_lesson_files, \
+    load_lesson_discussions, load_lesson_students
+from .seatmap import SeatMap
 from ..decorators import permission_required
 from werkzeug import secure_filename
 from werkzeug.datastructures import CombinedMultiDict
-import flask,os,random,time,datetime
+import flask,os,random,time,datetime,hmac
 
 
 
 @main.before_app_request
 def before_request():
+    g.queries_before = len(get_debug_queries())
+    metrics.start()
     if current_user.is_authenticated:
-        current_user.ping()
+        last_seen.touch(current_user._get_current_object())
         if not current_user.confirmed \
                 and request.endpoint \
                 and request.endpoint[:5] != 'main.' \
@@ -93,11 +107,9 @@ def index():
         form = PostFormE(values)
     else:
         form = PostForm(values)
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.filter(Post.private == False).\
-                          order_by(Post.timestamp.desc()).paginate(
-                          page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-                                                           error_out=False)
+    pagination = KeysetPagination(Post.query.filter(Post.private == False),
+                          (Post.timestamp, Post.id), request.args.get('cursor'),
+                          per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
 #    if current_user.is_anonymous:
 #        return redirect(url_for('main.about'))
@@ -114,11 +126,9 @@ def homepage():
         form = PostFormE(values)
     else:
         form = PostForm(values)
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.filter(Post.private == False).\
-                          order_by(Post.timestamp.desc()).paginate(
-                          page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-                                                           error_out=False)
+    pagination = KeysetPagination(Post.query.filter(Post.private == False),
+                          (Post.timestamp, Post.id), request.args.get('cursor'),
+                          per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
     return render_template('homepage.html', form=form, posts=posts,
                            pagination=pagination,english=english)
@@ -326,15 +336,16 @@ def change_avatar():
     english=request.cookies.get('english')
     if request.method == 'POST':
         file = request.files['file']
-        size = (1024, 1024)
-        im = Image.open(file)
-        im.thumbnail(size)
         
         if file and allowed_file(file.filename):
-            filename1 = current_user.email.replace('@','__').replace('.','__') + '.' + file.filename.split('.')[-1]
-            im.save(os.path.join('app/static', 'avatar', filename1))
-            current_user.avatar_file = url_for('static', 
-                                               filename='%s/%s' % ('avatar', filename1))
+            avatar_file = save_avatar(file)
+            if avatar_file is None:
+                if english == "yes":
+                    flash('Invalid request.')
+                else:
+                    flash('请求无效。')
+                return render_template('change_avatar.html',english=english)
+            current_user.avatar_file = avatar_file
             db.session.commit()
             current_user.is_avatar_default = False
             if english == "yes":
@@ -345,21 +356,32 @@ def change_avatar():
     return render_template('change_avatar.html',english=english)
 
 
+@main.route('/media/<path:filename>')
+def media(filename):
+    return send_media(filename)
+
+
+@main.route('/avatar/<filename>')
+def avatar(filename):
+    return send_avatar(filename)
+
+
+@main.route('/avatar/identicon/<filename>')
+def identicon(filename):
+    return send_identicon(filename)
+
+
 @main.route('/edit-pic', methods=['GET', 'POST'])
 @login_required
 def change_pic():
     english=request.cookies.get('english')
     if request.method == 'POST':
         file = request.files['file']
-        size = (1024, 1024)
-        im = Image.open(file)
-        im.thumbnail(size)
         teacher = Teacher.query.filter_by(teacher_id=current_user.id).first()
         
         if file and allowed_file(file.filename):
-            filename1 = current_user.email.replace('@','__').replace('.','__') + '.' + file.filename.split('.')[-1]
-            im.save(os.path.join('app/static', 'teacher_pic', filename1))
-            teacher.pic = url_for('static',filename='%s/%s' % ('teacher_pic', filename1))
+            release(teacher.pic)
+            teacher.pic = save_image(file)
             db.session.commit()
             current_user.is_avatar_default = False
             if english == "yes":
@@ -375,21 +397,10 @@ def change_lesson_pic(id):
     english=request.cookies.get('english')
     if request.method == 'POST':
         file = request.files['file']
-        size = (1024, 1024)
-        im = Image.open(file)
-        im.thumbnail(size)
         lesson = Lesson.query.filter_by(id=id).first()    
         if file and allowed_file(file.filename):
-            filename = file.filename
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' + str(time.time()).replace('.','_') + '.' + filename.split('.')[-1]
-            im.save(os.path.join('app/static', 'lesson', filename1))
-            try:
-                os.remove("/root/517shangke/app"+lesson.pic)
-            except:
-                pass
-
-            lesson.pic = url_for('static',filename='%s/%s' % ('lesson', filename1))
+            release(lesson.pic)
+            lesson.pic = save_image(file)
             db.session.commit()
             current_user.is_avatar_default = False
             if english == "yes":
@@ -528,6 +539,33 @@ def after_request(response):
                 '查询缓慢：%s\n参数：%s\n时间：%fs\n上下文：%s\n'
                 % (query.statement, query.parameters, query.duration,
                    query.context))
+    metrics.finish(request.endpoint)
+    budget = current_app.config['FLASKY_QUERY_BUDGETS'].get(request.endpoint)
+    count = len(get_debug_queries()) - g.get('queries_before', 0)
+    if budget is not None and count > budget:
+        message = '%s ran %d queries, budget is %d' % (request.endpoint,
+                                                        count, budget)
+        if current_app.testing:
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    if last_seen.due():
+        last_seen.flush()
+    return response
+
+
+@main.route('/metrics')
+def request_metrics():
+    # not by address: behind the front end server every client is 127.0.0.1
+    token = current_app.config['FLASKY_METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if not (token and hmac.compare_digest(
+                authorization.encode('utf-8'),
+                ('Bearer ' + token).encode('utf-8')) or
+            current_user.is_authenticated and
+            current_user.is_administrator()):
+        abort(404)
+    response = make_response(metrics.render())
+    response.mimetype = 'text/plain'
     return response
 
 
@@ -602,6 +640,18 @@ def jiangangwu():
     english=request.cookies.get('english')
     return render_template("jiangangwu.html", english=english)
 
+@main.route('/search')
+def search():
+    english=request.cookies.get('english')
+    q = request.args.get('q', '')
+    kind = request.args.get('kind') or None
+    page = request.args.get('page', 1, type=int)
+    pagination = search_documents(q, kind, page,
+        per_page=current_app.config['FLASKY_SEARCH_RESULTS_PER_PAGE'])
+    return render_template('search.html', q=q, kind=kind,
+                           hits=pagination.items, pagination=pagination,
+                           english=english)
+
 @main.route('/blog', methods=['GET', 'POST'])
 def blog():
     english=request.cookies.get('english')
@@ -610,20 +660,20 @@ def blog():
         form = PostFormE(values)
     else:
         form = PostForm(values)
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     show_followed = False
     if current_user.is_authenticated:
         show_followed = bool(request.cookies.get('show_followed', ''))
     if show_followed:
-        pagination = current_user.followed_posts.filter(Post.private == False).\
-                          order_by(Post.timestamp.desc()).paginate(
-                          page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-                                                           error_out=False)
+        pagination = KeysetPagination(
+                          current_user.followed_posts.filter(Post.private == False),
+                          (Timeline.timestamp, Timeline.post_id), cursor,
+                          per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+                          key=lambda post: (post.timestamp, post.id))
     else:
-        pagination = Post.query.filter(Post.private == False).\
-                          order_by(Post.timestamp.desc()).paginate(
-                          page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-                                                           error_out=False)
+        pagination = KeysetPagination(Post.query.filter(Post.private == False),
+                          (Post.timestamp, Post.id), cursor,
+                          per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
     return render_template('blog.html', form=form, posts=posts,
                            show_followed=show_followed, pagination=pagination, english=english)
@@ -634,7 +684,7 @@ def suggestion():
     english=request.cookies.get('english')
     page = request.args.get('page', 1, type=int)
     pagination = current_user.followed_posts.filter(Post.tag == 'suggestion').\
-                          order_by(Post.timestamp.desc()).paginate(
+                          order_by(Timeline.timestamp.desc()).paginate(
                           page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
                                                            error_out=False)
     posts = pagination.items
@@ -694,6 +744,8 @@ def user(username):
     pagination_atme = AtMe.query.filter_by(username=username).paginate(page, \
                                         per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
                                                            error_out=False)
+    if show_my_private == '3' and current_user == user:
+        ClickTime.mark_read(user.id, 'atme')
     return render_template('user.html', user=user, users=users, atme_bodies=atme_bodies,\
                            posts=posts,posts_private=posts_private,openedlessons=openedlessons,\
                        pagination=pagination,pagination_private=pagination_private,pagination_atme=pagination_atme,\
@@ -795,29 +847,19 @@ def user_posts(username):
 @login_required
 def comments_on_me(user_id):
     english=request.cookies.get('english')
-#    page = request.args.get('page', 1, type=int)
-    user = User.query.filter_by(id=user_id).first()
-    posts = Post.query.filter_by(author_id=user.id).all()    
-    post_comments = []
-    post_comments2 = []
-    timestamps = []
-    for post in posts:
-        comments = Comment.query.filter_by(post_id=post.id).all()
-        if len(comments) != 0:
-            for comment in comments:
-                post_comments.append([post,comment])
-                timestamps.append(comment.timestamp)
-    if len(post_comments) != 0:
-        timestamps2 = sorted(timestamps,reverse=True)
-        for t in timestamps2:
-            post_comments2.append(post_comments[timestamps.index(t)])
-#    pagination = Comment
-#    Post.query.join(Comment, Comment.post_id == user.id)\
-#            .filter(Comment.author_id == user.id).order_by(Post.timestamp.desc()).paginate(
-#            page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-#            error_out=False)
-    return render_template('comments_on_me.html', post_comments2=post_comments2, english=english)
-#                           pagination=pagination)
+    user = User.query.get_or_404(user_id)
+    if current_user == user:
+        ClickTime.mark_read(user.id, 'comments_on_me')
+    # one posts-comments join, newest comment first, with each comment's
+    # post and author loaded in the same query
+    query = user.received_comments().options(
+        db.contains_eager(Comment.post), db.joinedload(Comment.author))
+    pagination = KeysetPagination(query, (Comment.timestamp, Comment.id),
+        request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
+    return render_template('comments_on_me.html', user=user,
+                           comments=pagination.items, pagination=pagination,
+                           english=english)
 
 @main.route('/sent-comments/<int:user_id>')
 @login_required
@@ -846,15 +888,8 @@ def sent_comments(user_id):
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
 def post(id):
     english=request.cookies.get('english')
-    if current_user.is_authenticated:
-        collect = CollectPost.query.filter_by(post_id=id).filter_by(user_id=current_user.id).first()
-    else:
-       collect = None 
-    if collect == None:
-        is_collect = 0
-    else:
-        is_collect = 1
     post = Post.query.get_or_404(id)
+    is_collect = int(post.id in current_user.bookmarked([post]))
     if current_user.is_authenticated:
         if current_user.id != post.author_id and post.private == True:
             if english == "yes":
@@ -871,32 +906,19 @@ def post(id):
                           post=post,
                           author=current_user._get_current_object())
         db.session.add(comment)
+        record_mentions(comment)
         if english == "yes":
             flash('The comment has been uploaded.')
         else:
             flash('评论已经上传。')
-        body = form.body.data
-#        comment = Comment.query.filter_by(body=form.body.data).filter_by(post_id=post.id).first()
-        ats = body.split('@')[1:]
-        if len(ats) > 0:
-            for at in body.split('@'):
-                username = at.split(' ')[0]
-                user = User.query.filter_by(username=username).first()
-                if user is not None:
-                    atme = AtMe(comment_id=comment.id,username=username, username_whoatme=current_user.username)
-                    db.session.add(atme)
-        return redirect(url_for('.post', id=post.id, page=-1))
-    page = request.args.get('page', 1, type=int)
-    if page == -1:
-        page = (post.comments.count() - 1) // \
-            current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+        return redirect(url_for('.post', id=post.id))
+    pagination = KeysetPagination(post.comments,
+        (Comment.timestamp, Comment.id), request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
     comments = pagination.items
-    if post.tag != None and 'newlessons' in post.tag:
+    if post.newlesson_id is not None:
         flag = 1
-        newlesson_id = int(post.tag.split('_')[1])
+        newlesson_id = post.newlesson_id
         newlesson = NewLesson.query.filter_by(id=newlesson_id).first()
         lesson = Lesson.query.filter_by(id=newlesson.lesson_id).first()
         return render_template('post.html', post=post, form=form, is_collect=is_collect, \
@@ -910,6 +932,25 @@ def post(id):
                       is_collect=is_collect, comments=comments, pagination=pagination, english=english)
 
 
+@main.route('/notifications')
+@login_required
+def notifications():
+    response = jsonify(ClickTime.unread(current_user.id))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    # polled by the navbar; unchanged counts cost a 304 and no body
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@main.route('/mention-suggestions')
+@login_required
+def mention_suggestions():
+    users = suggest(request.args.get('q', ''))
+    return jsonify({'users': [{'username': u.username, 'name': u.name,
+                               'avatar': avatar_url(u, 40)} for u in users]})
+
+
 @main.route('/write/<string:tag>', methods=['GET', 'POST'])
 @login_required
 def write(tag):
@@ -930,15 +971,8 @@ def write(tag):
                     author=current_user._get_current_object())
         if request.method == 'POST':
             pic = request.files['pic']
-            size = (1024, 1024) 
             if pic and allowed_file(pic.filename):
-                im = Image.open(pic)
-                im.thumbnail(size)        
-                filename = secure_filename(pic.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' + str(time.time()).replace('.','_') + '.' + filename.split('.')[-1]
-                im.save(os.path.join('app/static', 'post', filename1))
-                post.pic = url_for('static',filename='%s/%s' % ('post', filename1))
+                post.pic = save_image(pic)
                 
         db.session.add(post)
         if english == "yes":
@@ -949,8 +983,8 @@ def write(tag):
             return redirect(url_for('.user',username=current_user.username))
         if 'suggestion' in tag:
             return redirect(url_for('.suggestion'))
-        if 'newlessons' in tag:
-            return redirect(url_for('.current_lesson',newlesson_id=int(tag.split('_')[1]),tag=tag))
+        if post.newlesson_id is not None:
+            return redirect(url_for('.current_lesson',newlesson_id=post.newlesson_id,tag=tag))
             
     return render_template('write.html', form=form,enctype=enctype,tag=tag, english=english)
 
@@ -974,91 +1008,44 @@ def write2(tag):
                     author=current_user._get_current_object())
         if request.method == 'POST':
             pic = request.files['pic']
-            size = (1024, 1024) 
             if pic and allowed_file(pic.filename):
-                im = Image.open(pic)
-                im.thumbnail(size)        
-                filename = secure_filename(pic.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' + str(time.time()).replace('.','_') + '.' + filename.split('.')[-1]
-                im.save(os.path.join('app/static', 'post', filename1))
-                post.pic = url_for('static',filename='%s/%s' % ('post', filename1))
+                post.pic = save_image(pic)
     
             pic1 = request.files['pic1']
             if pic1 and allowed_file(pic1.filename):
-                im = Image.open(pic1)
-                im.thumbnail(size)        
-                filename = secure_filename(pic1.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' + str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                im.save(os.path.join('app/static', 'post', filename1))
-                post.pic1 = url_for('static',filename='%s/%s' % ('post', filename1))
+                post.pic1 = save_image(pic1)
     
             pic2 = request.files['pic2']
-            size = (1024, 1024) 
             if pic2 and allowed_file(pic2.filename):
-                im = Image.open(pic2)
-                im.thumbnail(size)        
-                filename = secure_filename(pic2.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' + str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                im.save(os.path.join('app/static', 'post', filename1))
-                post.pic2 = url_for('static',filename='%s/%s' % ('post', filename1))
+                post.pic2 = save_image(pic2)
     
             pic3 = request.files['pic3']
-            size = (1024, 1024) 
             if pic3 and allowed_file(pic3.filename):
-                im = Image.open(pic3)
-                im.thumbnail(size)        
-                filename = secure_filename(pic3.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' + str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                im.save(os.path.join('app/static', 'post', filename1))
-                post.pic3 = url_for('static',filename='%s/%s' % ('post', filename1))
+                post.pic3 = save_image(pic3)
     
             file1 = request.files['file1']
             if file1 and allowed_file(file1.filename):
-                filename = secure_filename(file1.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file1.save(os.path.join('app/static', 'file', filename1))
-                post.file1 = url_for('static',filename='%s/%s' % ('file', filename1))
+                post.file1 = save_file(file1)
                 post.filename1 = file1.filename        
     
             file2 = request.files['file2']
             if file2 and allowed_file(file2.filename):
-                filename = secure_filename(file2.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file2.save(os.path.join('app/static', 'file', filename1))
-                post.file2 = url_for('static',filename='%s/%s' % ('file', filename1))
+                post.file2 = save_file(file2)
                 post.filename2 = file2.filename        
     
             file3 = request.files['file3']
             if file3 and allowed_file(file3.filename):
-                filename = secure_filename(file3.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file3.save(os.path.join('app/static', 'audio', filename1))
-                post.file3 = url_for('static',filename='%s/%s' % ('audio', filename1))
+                post.file3 = save_file(file3)
                 post.filename3 = file3.filename        
     
             file4 = request.files['file4']
             if file4 and allowed_file(file4.filename):
-                filename = secure_filename(file4.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file4.save(os.path.join('app/static', 'video', filename1))
-                post.file4 = url_for('static',filename='%s/%s' % ('video', filename1))
+                post.file4 = save_file(file4)
                 post.filename4 = file4.filename
     
             file5 = request.files['file5']
             if file5 and allowed_file(file5.filename):
-                filename = secure_filename(file5.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file5.save(os.path.join('app/static', 'file', filename1))
-                post.file5 = url_for('static',filename='%s/%s' % ('file', filename1))
+                post.file5 = save_file(file5)
                 post.filename5 = file5.filename
 
         db.session.add(post)
@@ -1070,8 +1057,8 @@ def write2(tag):
             return redirect(url_for('.user',username=current_user.username))
         if 'suggestion' in tag:
             return redirect(url_for('.suggestion'))
-        if 'newlesson' in tag:
-            return redirect(url_for('.current_lesson',newlesson_id=int(tag.split('_')[1]),tag=tag))
+        if post.newlesson_id is not None:
+            return redirect(url_for('.current_lesson',newlesson_id=post.newlesson_id,tag=tag))
     return render_template('write2.html', form=form,enctype=enctype,tag=tag, english=english)
 
 
@@ -1094,19 +1081,9 @@ def edit(id):
         post.private = form.private.data
 
         pic = request.files['pic']
-        size = (1024, 1024) 
         if pic and allowed_file(pic.filename):
-            im = Image.open(pic)
-            im.thumbnail(size)        
-            filename = secure_filename(pic.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' + str(time.time()).replace('.','_') + '.' + filename.split('.')[-1]
-            im.save(os.path.join('app/static', 'post', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.pic)
-            except:
-                pass
-            post.pic = url_for('static',filename='%s/%s' % ('post', filename1))
+            release(post.pic)
+            post.pic = save_image(pic)
       
         db.session.add(post)
         if english == "yes":
@@ -1115,8 +1092,8 @@ def edit(id):
             flash('帖子已经修改。')
         if post.tag != None and 'suggestion' in post.tag:
             return redirect(url_for('.suggestion'))
-        elif post.tag != None and 'newlessons' in post.tag:
-            return redirect(url_for('.current_lesson',newlesson_id=int(post.tag.split('_')[1]),tag=post.tag))
+        elif post.newlesson_id is not None:
+            return redirect(url_for('.current_lesson',newlesson_id=post.newlesson_id,tag=post.tag))
         else:
             return redirect(url_for('.post', id=post.id))
     form.topic.data = post.topic
@@ -1143,137 +1120,61 @@ def edit2(id):
         post.private = form.private.data
 
         pic = request.files['pic']
-        size = (1024, 1024) 
         if pic and allowed_file(pic.filename):
-            im = Image.open(pic)
-            im.thumbnail(size)        
-            filename = secure_filename(pic.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' + str(time.time()).replace('.','_') + '.' + filename.split('.')[-1]
-            im.save(os.path.join('app/static', 'post', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.pic)
-            except:
-                pass    
-                    
-            post.pic = url_for('static',filename='%s/%s' % ('post', filename1))
+            release(post.pic)
+            post.pic = save_image(pic)
 
         pic1 = request.files['pic1']
-        size = (1024, 1024) 
         if pic1 and allowed_file(pic1.filename):
-            im = Image.open(pic1)
-            im.thumbnail(size)        
-            filename = secure_filename(pic1.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' + str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-            im.save(os.path.join('app/static', 'post', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.pic1)
-            except:
-                pass
-            post.pic1 = url_for('static',filename='%s/%s' % ('post', filename1))
+            release(post.pic1)
+            post.pic1 = save_image(pic1)
 
         pic2 = request.files['pic2']
-        size = (1024, 1024) 
         if pic2 and allowed_file(pic2.filename):
-            im = Image.open(pic2)
-            im.thumbnail(size)        
-            filename = secure_filename(pic2.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' + str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-            im.save(os.path.join('app/static', 'post', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.pic2)
-            except:
-                pass
-            post.pic2 = url_for('static',filename='%s/%s' % ('post', filename1))
+            release(post.pic2)
+            post.pic2 = save_image(pic2)
 
         pic3 = request.files['pic3']
-        size = (1024, 1024) 
         if pic3 and allowed_file(pic3.filename):
-            im = Image.open(pic3)
-            im.thumbnail(size)        
-            filename = secure_filename(pic3.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' + str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-            im.save(os.path.join('app/static', 'post', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.pic3)
-            except:
-                pass
-            post.pic3 = url_for('static',filename='%s/%s' % ('post', filename1))
+            release(post.pic3)
+            post.pic3 = save_image(pic3)
 
         file1 = request.files['file1']
         if file1 and allowed_file(file1.filename):
-            filename = secure_filename(file1.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-            file1.save(os.path.join('app/static', 'file', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.file1)
-            except:
-                pass
-            post.file1 = url_for('static',filename='%s/%s' % ('file', filename1))
+            release(post.file1)
+            post.file1 = save_file(file1)
             post.filename1 = file1.filename        
 
         file2 = request.files['file2']
         if file2 and allowed_file(file2.filename):
-            filename = secure_filename(file2.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-            file2.save(os.path.join('app/static', 'file', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.file2)
-            except:
-                pass
-            post.file2 = url_for('static',filename='%s/%s' % ('file', filename1))
+            release(post.file2)
+            post.file2 = save_file(file2)
             post.filename2 = file2.filename        
 
         file3 = request.files['file3']
         if file3 and allowed_file(file3.filename):
-            filename = secure_filename(file3.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-            file3.save(os.path.join('app/static', 'audio', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.file3)
-            except:
-                pass
-            post.file3 = url_for('static',filename='%s/%s' % ('audio', filename1))
+            release(post.file3)
+            post.file3 = save_file(file3)
             post.filename3 = file3.filename        
 
         file4 = request.files['file4']
         if file4 and allowed_file(file4.filename):
-            filename = secure_filename(file4.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-            file4.save(os.path.join('app/static', 'video', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.file4)
-            except:
-                pass
-            post.file4 = url_for('static',filename='%s/%s' % ('video', filename1))
+            release(post.file4)
+            post.file4 = save_file(file4)
             post.filename4 = file4.filename
 
         file5 = request.files['file5']
         if file5 and allowed_file(file5.filename):
-            filename = secure_filename(file5.filename)
-            filename1 = current_user.email.replace('@','__').replace('.','__') \
-                        + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-            file5.save(os.path.join('app/static', 'file', filename1))
-            try:
-                os.remove("/root/517shangke/app"+post.file5)
-            except:
-                pass
-            post.file5 = url_for('static',filename='%s/%s' % ('file', filename1))
+            release(post.file5)
+            post.file5 = save_file(file5)
             post.filename5 = file5.filename
             
         db.session.commit()
         flash('帖子已经修改。')
         if post.tag != None and 'suggestion' in post.tag:
             return redirect(url_for('.suggestion'))
-        elif post.tag != None and 'newlessons' in post.tag:
-            return redirect(url_for('.current_lesson',newlesson_id=int(post.tag.split('_')[1]),tag=post.tag))
+        elif post.newlesson_id is not None:
+            return redirect(url_for('.current_lesson',newlesson_id=post.newlesson_id,tag=post.tag))
         else:
             return redirect(url_for('.post', id=post.id))
     form.topic.data = post.topic
@@ -1346,10 +1247,11 @@ def followers(username):
         else:
             flash('无效用户。')
         return redirect(url_for('.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followers.paginate(
-        page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
-        error_out=False)
+    if current_user == user:
+        ClickTime.mark_read(user.id, 'followed_by')
+    pagination = KeysetPagination(user.followers,
+        (Follow.timestamp, Follow.follower_id), request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'])
     follows = [{'user': item.follower, 'timestamp': item.timestamp}
                for item in pagination.items]
     return render_template('followers.html', user=user, 
@@ -1367,10 +1269,9 @@ def followed_by(username):
         else:
             flash('无效用户。')
         return redirect(url_for('.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed.paginate(
-        page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
-        error_out=False)
+    pagination = KeysetPagination(user.followed,
+        (Follow.timestamp, Follow.followed_id), request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'])
     follows = [{'user': item.followed, 'timestamp': item.timestamp}
                for item in pagination.items]
     return render_template('followered-by.html', user=user, 
@@ -1389,7 +1290,10 @@ def show_write():
 @main.route('/del-user/<int:id>')
 @login_required
 def del_user(id):
-    User.query.filter_by(id=id).delete()
+    # a per-row delete so the search and counter listeners run
+    user = User.query.filter_by(id=id).first()
+    if user is not None:
+        db.session.delete(user)
     db.session.commit()
     return redirect(url_for('.user',username=current_user.username))
 
@@ -1397,7 +1301,10 @@ def del_user(id):
 @main.route('/del-teacher/<int:id>')
 @login_required
 def del_teacher(id):
-    Teacher.query.filter_by(id=id).delete()
+    # a per-row delete so the upload refcount and search listeners run
+    teacher = Teacher.query.filter_by(id=id).first()
+    if teacher is not None:
+        db.session.delete(teacher)
     current_user.teacher = 0
     db.session.commit()
     return redirect(url_for('.user',username=current_user.username))
@@ -1408,51 +1315,16 @@ def del_teacher(id):
 def del_post(id):
     post = Post.query.filter_by(id=id).first()
     tag = post.tag
-    if post.pic != None:
-        try:
-            os.remove("/root/517shangke/app"+post.pic)
-        except:
-            pass    
-    if post.pic1 != None:
-        try:
-            os.remove("/root/517shangke/app"+post.pic1)
-        except:
-            pass    
-    if post.pic2 != None:
-        try:
-            os.remove("/root/517shangke/app"+post.pic2)
-        except:
-            pass    
-    if post.pic3 != None:
-        try:
-            os.remove("/root/517shangke/app"+post.pic3)
-        except:
-            pass    
-    if post.file1 != None:
-        try:
-            os.remove("/root/517shangke/app"+post.file1)
-        except:
-            pass    
-    if post.file2 != None:
-        try:
-            os.remove("/root/517shangke/app"+post.file2)
-        except:
-            pass    
-    if post.file3 != None:
-        try:
-            os.remove("/root/517shangke/app"+post.file3)
-        except:
-            pass    
-    if post.file4 != None:
-        try:
-            os.remove("/root/517shangke/app"+post.file4)
-        except:
-            pass    
-    if post.file5 != None:
-        try:
-            os.remove("/root/517shangke/app"+post.file5)
-        except:
-            pass     
+    newlesson_id = post.newlesson_id
+    release(post.pic)
+    release(post.pic1)
+    release(post.pic2)
+    release(post.pic3)
+    release(post.file1)
+    release(post.file2)
+    release(post.file3)
+    release(post.file4)
+    release(post.file5)
     db.session.delete(Post.query.get_or_404(id))
     db.session.commit()
     if 'posts' in tag:
@@ -1460,13 +1332,14 @@ def del_post(id):
     if 'suggestion' in tag:
         return redirect(url_for('.suggestion'))
     else:
-        return redirect(url_for('.current_lesson',newlesson_id=int(tag.split('_')[1]),tag=tag))
+        return redirect(url_for('.current_lesson',newlesson_id=newlesson_id,tag=tag))
 
 
 @main.route('/del-comment/<int:id>/<int:id2>')
 @login_required
 def del_comment(id,id2):
-    AtMe.query.filter_by(comment_id=id).delete()
+    for atme in AtMe.query.filter_by(comment_id=id).all():
+        db.session.delete(atme)
     db.session.delete(Comment.query.get_or_404(id))
     db.session.commit()
     return redirect(url_for('.post',id=id2))
@@ -1494,89 +1367,50 @@ def open_lesson():
                         about_lesson=form.about_lesson.data,teacher_id=current_user.id)
         if request.method == 'POST':
             pic = request.files['pic']
-            size = (1024, 1024) 
             if pic and allowed_file(pic.filename):
-                im = Image.open(pic)
-                im.thumbnail(size)        
-                filename = secure_filename(pic.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' + str(time.time()).replace('.','_') + '.' + filename.split('.')[-1]
-                im.save(os.path.join('app/static', 'lesson', filename1))
-                lesson.pic = url_for('static',filename='%s/%s' % ('lesson', filename1))      
+                lesson.pic = save_image(pic)      
 
             file1 = request.files['file1']
             if file1 and allowed_file(file1.filename):
-                filename = secure_filename(file1.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file1.save(os.path.join('app/static', 'file', filename1))
-                lesson.file1 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                lesson.file1 = save_file(file1)
                 lesson.filename1 = file1.filename        
     
             file2 = request.files['file2']
             if file2 and allowed_file(file2.filename):
-                filename = secure_filename(file2.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file2.save(os.path.join('app/static', 'file', filename1))
-                lesson.file2 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                lesson.file2 = save_file(file2)
                 lesson.filename2 = file2.filename        
     
             file3 = request.files['file3']
             if file3 and allowed_file(file3.filename):
-                filename = secure_filename(file3.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file3.save(os.path.join('app/static', 'file', filename1))
-                lesson.file3 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                lesson.file3 = save_file(file3)
                 lesson.filename3 = file3.filename      
     
             file4 = request.files['file4']
             if file4 and allowed_file(file4.filename):
-                filename = secure_filename(file4.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file4.save(os.path.join('app/static', 'file', filename1))
-                lesson.file4 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                lesson.file4 = save_file(file4)
                 lesson.filename4 = file4.filename
 
             file5 = request.files['file5']
             if file5 and allowed_file(file5.filename):
-                filename = secure_filename(file5.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file5.save(os.path.join('app/static', 'lessonfile', filename1))
-                lesson.file5 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                lesson.file5 = save_file(file5)
                 lesson.filename5 = file5.filename
                 
     
             file6 = request.files['file6']
             if file6 and allowed_file(file6.filename):
-                filename = secure_filename(file6.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file6.save(os.path.join('app/static', 'lessonfile', filename1))
-                lesson.file6 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                lesson.file6 = save_file(file6)
                 lesson.filename6 = file6.filename
                 
     
             file7 = request.files['file7']
             if file7 and allowed_file(file7.filename):
-                filename = secure_filename(file7.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file7.save(os.path.join('app/static', 'lessonfile', filename1))
-                lesson.file7 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                lesson.file7 = save_file(file7)
                 lesson.filename7 = file7.filename
                 
     
             file8 = request.files['file8']
             if file8 and allowed_file(file8.filename):
-                filename = secure_filename(file8.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file8.save(os.path.join('app/static', 'lessonfile', filename1))
-                lesson.file8 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                lesson.file8 = save_file(file8)
                 lesson.filename8 = file8.filename
                                     
         db.session.add(lesson)
@@ -1601,125 +1435,59 @@ def edit_lesson(id):
         lesson.teacher_id = current_user.id
         if request.method == 'POST':
             pic = request.files['pic']
-            size = (1024, 1024) 
             if pic and allowed_file(pic.filename):
-                im = Image.open(pic)
-                im.thumbnail(size)        
-                filename = secure_filename(pic.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' + str(time.time()).replace('.','_') + '.' + filename.split('.')[-1]
-                im.save(os.path.join('app/static', 'lesson', filename1))
-                try:
-                    os.remove("/root/517shangke/app"+post.pic)
-                except:
-                    pass
-                lesson.pic = url_for('static',filename='%s/%s' % ('lesson', filename1))   
+                release(lesson.pic)
+                lesson.pic = save_image(pic)   
 
             file1 = request.files['file1']
             if file1 and allowed_file(file1.filename):
-                filename = secure_filename(file1.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file1.save(os.path.join('app/static', 'lessonfile', filename1))
-                try:
-                    os.remove("/root/517shangke/app"+post.file1)
-                except:
-                    pass
-                lesson.file1 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                release(lesson.file1)
+                lesson.file1 = save_file(file1)
                 lesson.filename1 = file1.filename        
     
             file2 = request.files['file2']
             if file2 and allowed_file(file2.filename):
-                filename = secure_filename(file2.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file2.save(os.path.join('app/static', 'lessonfile', filename1))
-                try:
-                    os.remove("/root/517shangke/app"+post.file2)
-                except:
-                    pass
-                lesson.file2 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                release(lesson.file2)
+                lesson.file2 = save_file(file2)
                 lesson.filename2 = file2.filename        
     
             file3 = request.files['file3']
             if file3 and allowed_file(file3.filename):
-                filename = secure_filename(file3.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file3.save(os.path.join('app/static', 'lessonfile', filename1))
-                try:
-                    os.remove("/root/517shangke/app"+post.file3)
-                except:
-                    pass
-                lesson.file3 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                release(lesson.file3)
+                lesson.file3 = save_file(file3)
                 lesson.filename3 = file3.filename      
  
             file4 = request.files['file4']
             if file4 and allowed_file(file4.filename):
-                filename = secure_filename(file4.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file4.save(os.path.join('app/static', 'file', filename1))
-                try:
-                    os.remove("/root/517shangke/app"+post.file4)
-                except:
-                    pass
-                lesson.file4 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                release(lesson.file4)
+                lesson.file4 = save_file(file4)
                 lesson.filename4 = file4.filename
 
             file5 = request.files['file5']
             if file5 and allowed_file(file5.filename):
-                filename = secure_filename(file5.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file5.save(os.path.join('app/static', 'lessonfile', filename1))
-                try:
-                    os.remove("/root/517shangke/app"+post.file5)
-                except:
-                    pass
-                lesson.file5 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                release(lesson.file5)
+                lesson.file5 = save_file(file5)
                 lesson.filename5 = file5.filename
                 
     
             file6 = request.files['file6']
             if file6 and allowed_file(file6.filename):
-                filename = secure_filename(file6.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file6.save(os.path.join('app/static', 'lessonfile', filename1))
-                try:
-                    os.remove("/root/517shangke/app"+post.file6)
-                except:
-                    pass
-                lesson.file6 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                release(lesson.file6)
+                lesson.file6 = save_file(file6)
                 lesson.filename6 = file6.filename
                 
     
             file7 = request.files['file7']
             if file7 and allowed_file(file7.filename):
-                filename = secure_filename(file7.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file7.save(os.path.join('app/static', 'lessonfile', filename1))
-                try:
-                    os.remove("/root/517shangke/app"+post.file7)
-                except:
-                    pass
-                lesson.file7 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                release(lesson.file7)
+                lesson.file7 = save_file(file7)
                 lesson.filename7 = file7.filename
                 
     
             file8 = request.files['file8']
             if file8 and allowed_file(file8.filename):
-                filename = secure_filename(file8.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file8.save(os.path.join('app/static', 'lessonfile', filename1))
-                try:
-                    os.remove("/root/517shangke/app"+post.file8)
-                except:
-                    pass
-                lesson.file8 = url_for('static',filename='%s/%s' % ('lessonfile', filename1))
+                release(lesson.file8)
+                lesson.file8 = save_file(file8)
                 lesson.filename8 = file8.filename
                                     
         db.session.add(lesson)
@@ -1733,46 +1501,14 @@ def edit_lesson(id):
 @login_required
 def del_lesson(id):
     lesson = Lesson.query.filter_by(id=id).first()
-    if lesson.file1 != None:
-        try:
-            os.remove("/root/517shangke/app"+lesson.file1)
-        except:
-            pass    
-    if lesson.file2 != None:
-        try:
-            os.remove("/root/517shangke/app"+lesson.file2)
-        except:
-            pass    
-    if lesson.file3 != None:
-        try:
-            os.remove("/root/517shangke/app"+lesson.file3)
-        except:
-            pass    
-    if lesson.file4 != None:
-        try:
-            os.remove("/root/517shangke/app"+lesson.file4)
-        except:
-            pass    
-    if lesson.file5 != None:
-        try:
-            os.remove("/root/517shangke/app"+lesson.file5)
-        except:
-            pass     
-    if lesson.file6 != None:
-        try:
-            os.remove("/root/517shangke/app"+lesson.file6)
-        except:
-            pass    
-    if lesson.file7 != None:
-        try:
-            os.remove("/root/517shangke/app"+lesson.file7)
-        except:
-            pass    
-    if lesson.file8 != None:
-        try:
-            os.remove("/root/517shangke/app"+lesson.file8)
-        except:
-            pass             
+    release(lesson.file1)
+    release(lesson.file2)
+    release(lesson.file3)
+    release(lesson.file4)
+    release(lesson.file5)
+    release(lesson.file6)
+    release(lesson.file7)
+    release(lesson.file8)
     db.session.delete(Lesson.query.get_or_404(id))
     db.session.commit()
     teacher = Teacher.query.filter_by(teacher_id=current_user.id).first()
@@ -1810,34 +1546,19 @@ def lesson(id):
     lesson = Lesson.query.filter_by(id=id).first()
     user_teacher = User.query.filter_by(id=lesson.teacher_id).first()   
     teacher = Teacher.query.filter_by(teacher_id=lesson.teacher_id).first()
-    newlessons = NewLesson.query.filter_by(lesson_id=id).all()
+    newlessons_by_lesson = load_newlessons([lesson])
+    newlessons = newlessons_by_lesson.get(lesson.id, [])
     show_all_class = "0"
     show_all_class = request.cookies.get('show_all_class', '')
-    students = []
-    if current_user.is_authenticated:
-        students = Student.query.filter_by(student_id=current_user.id).all() 
     mylessons = []
-    for s in students:
-        nl = NewLesson.query.filter_by(id=s.newlesson_id).first()
-        if nl in newlessons:
-            mylessons.append(nl)
-    lesson_files = []
-    lessonfiles = LessonFile.query.filter_by(lesson_id=id).order_by(LessonFile.timestamp.desc()).all()
-    for lf in lessonfiles:
-        lesson_files.append([lesson,lf])
-    lesson_discussions = []
-    for newlesson in newlessons:
-        posts = Post.query.filter_by(tag="newlessons_"+str(newlesson.id)).order_by(Post.timestamp.desc()).all()
-        for p in posts:
-            user2 = User.query.filter_by(id=p.author_id).first()
-            lesson_discussions.append([lesson,newlesson,p,user2])
-    lesson_students = []
-    newlessons = NewLesson.query.filter_by(lesson_id=lesson.id).order_by(NewLesson.timestamp.desc()).all()
-    for newlesson in newlessons:
-        students = Student.query.filter_by(newlesson_id=newlesson.id).order_by(Student.timestamp.desc()).all()
-        for student in students:
-            user3 = User.query.filter_by(id=student.student_id).first()
-            lesson_students.append([lesson,newlesson,user3])
+    if current_user.is_authenticated and newlessons:
+        joined = set(s.newlesson_id for s in Student.query.\
+                     filter_by(student_id=current_user.id).\
+                     filter(Student.newlesson_id.in_([nl.id for nl in newlessons])))
+        mylessons = [nl for nl in newlessons if nl.id in joined]
+    lesson_files = load_lesson_files([lesson])
+    lesson_discussions = load_lesson_discussions([lesson], newlessons_by_lesson)
+    lesson_students = load_lesson_students([lesson], newlessons_by_lesson)
     return render_template('lesson.html',lesson=lesson,user_teacher=user_teacher,\
                            lesson_files=lesson_files,lesson_discussions=lesson_discussions,\
                            lesson_students=lesson_students,\
@@ -1914,15 +1635,17 @@ def current_lesson(newlesson_id):
     newlesson = NewLesson.query.filter_by(id=newlesson_id).first()
     lesson = Lesson.query.filter_by(id=newlesson.lesson_id).first()   
     teacher = User.query.filter_by(id=lesson.teacher_id).first()    
-    students = Student.query.filter_by(newlesson_id=newlesson_id).all()
+    roster = SeatMap.load_roster(newlesson)
+    students = [s for s, u in roster]
+    users = dict((s.student_id, u) for s, u in roster)
 
     page = request.args.get('page', 1, type=int)
-    pagination = Post.query.filter(Post.tag == "newlessons_"+str(newlesson_id)).\
+    pagination = Post.query.filter(Post.newlesson_id == newlesson_id).\
                           order_by(Post.timestamp.desc()).paginate(
                           page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
                                                            error_out=False)
     posts = pagination.items
-    pagination_teacher = Post.query.filter(Post.tag == "newlessons_"+str(newlesson_id)).\
+    pagination_teacher = Post.query.filter(Post.newlesson_id == newlesson_id).\
                                           filter_by(author_id=teacher.id).\
                           order_by(Post.timestamp.desc()).paginate(
                           page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
@@ -1933,65 +1656,46 @@ def current_lesson(newlesson_id):
 
     student = None
     if current_user.is_authenticated:
-        ss  = Student.query.filter_by(student_id=current_user.id).all()
-        if len(ss) != 0:
-            for s in ss:
-                if s in students:
-                    student = s
+        for s in students:
+            if s.student_id == current_user.id:
+                student = s
+    if student is not None and \
+            show_lesson_discussion not in ('1', '2', '3', '4'):
+        ClickTime.mark_discussion_read(current_user.id, newlesson_id)
     
     users_confirmed_posts = []
     for s in students:
         if s.confirm:
             if Post.query.filter_by(topic=s.topic).filter_by(author_id=s.student_id).first():
-                users_confirmed_posts.append([s,User.query.filter_by(id=s.student_id).first(),\
+                users_confirmed_posts.append([s,users[s.student_id],\
                                         Post.query.filter_by(topic=s.topic).first().id])
     users_confirmed = []
     users_unconfirmed = []
     for s in students:
         if s.confirm:
-            users_confirmed.append(User.query.filter_by(id=s.student_id).first())            
+            users_confirmed.append(users[s.student_id])            
         else:
-            users_unconfirmed.append(User.query.filter_by(id=s.student_id).first())
+            users_unconfirmed.append(users[s.student_id])
     if len(students)>1:
         n = random.randint(0,len(students)-1)
-        replier = User.query.filter_by(id=students[n].student_id).first()
+        replier = users[students[n].student_id]
     else:
         replier = ""
 
     if request.method == 'POST':
         if current_user==teacher:
-            seat = request.form['seat']
-            student = Student.query.filter_by(seat=seat).first()
-            student.absence = student.absence + 1
-            db.session.commit()           
-        else:
+            occupant = SeatMap(newlesson, roster).occupant(request.form['seat'])
+            if occupant is not None:
+                occupant[0].absence = occupant[0].absence + 1
+                db.session.commit()           
+        elif student is not None:
             student.seat = request.form['seat']
             db.session.commit()
+        roster = SeatMap.load_roster(newlesson)
         
-    seats = []
-    absences = []
-    for i in range(newlesson.room_row):
-        if i < 9:
-            row = "0" + str(i+1)
-        else:
-            row = str(i+1)
-        for j in range(newlesson.room_column):
-            if j < 9:
-                column = "0" + str(j+1)
-            else:
-                column = str(j+1)            
-            flag = 0
-            seat = row + column
-            for s in students:
-                if s.seat != None:
-                    if i+1==int(s.seat[0:2]) and j+1==int(s.seat[2:4]):
-                        seats.append(User.query.filter_by(id=s.student_id).first().name)
-                        absences.append(s.absence)
-                        flag = 1
-                        break
-            if flag == 0:
-                seats.append(seat)
-                absences.append('')
+    seat_map = SeatMap(newlesson, roster)
+    seats = seat_map.seats()
+    absences = seat_map.absences()
     return render_template('current_lesson.html',teacher=teacher,lesson=lesson,\
                                student=student,posts=posts,posts_teacher=posts_teacher,\
                                users_confirmed=users_confirmed,users_unconfirmed=users_unconfirmed,\
@@ -2000,6 +1704,13 @@ def current_lesson(newlesson_id):
                                newlesson=newlesson, show_lesson_discussion=show_lesson_discussion,english=english)        
                
 
+@main.route('/current-lesson/<int:newlesson_id>/seats')
+@login_required
+def current_lesson_seats(newlesson_id):
+    newlesson = NewLesson.query.get_or_404(newlesson_id)
+    return jsonify(SeatMap.load(newlesson).to_json())
+
+
 @main.route('/show-lesson-discussion/<int:newlesson_id>')
 def show_lesson_discussion(newlesson_id):
     resp = make_response(redirect(url_for('main.current_lesson',newlesson_id=newlesson_id)))
@@ -2273,49 +1984,29 @@ def update_topic(newlesson_id):
         if request.method == 'POST':
             file1 = request.files['file1']
             if file1 and allowed_file(file1.filename):
-                filename = secure_filename(file1.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file1.save(os.path.join('app/static', 'post', filename1))
-                student.file1 = url_for('static',filename='%s/%s' % ('post', filename1))
+                student.file1 = save_file(file1)
                 student.filename1 = file1.filename        
     
             file2 = request.files['file2']
             if file2 and allowed_file(file2.filename):
-                filename = secure_filename(file2.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file2.save(os.path.join('app/static', 'post', filename1))
-                student.file2 = url_for('static',filename='%s/%s' % ('post', filename1))
+                student.file2 = save_file(file2)
                 student.filename2 = file2.filename        
     
             file3 = request.files['file3']
             if file3 and allowed_file(file3.filename):
-                filename = secure_filename(file3.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file3.save(os.path.join('app/static', 'post', filename1))
-                student.file3 = url_for('static',filename='%s/%s' % ('post', filename1))
+                student.file3 = save_file(file3)
                 student.filename3 = file3.filename      
     
             file4 = request.files['file4']
             if file4 and allowed_file(file4.filename):
-                filename = secure_filename(file4.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file4.save(os.path.join('app/static', 'file', filename1))
-                student.file4 = url_for('static',filename='%s/%s' % ('post', filename1))
+                student.file4 = save_file(file4)
                 student.filename4 = file4.filename
     
             file5 = request.files['file5']
             if file5 and allowed_file(file5.filename):
-                filename = secure_filename(file5.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file5.save(os.path.join('app/static', 'post', filename1))
-                student.file5 = url_for('static',filename='%s/%s' % ('post', filename1))
+                student.file5 = save_file(file5)
                 student.filename5 = file5.filename
-        if post != None and post.author_id == current_user.id and post.tag == 'newlessons_'+ str(newlesson_id):
+        if post != None and post.author_id == current_user.id and post.newlesson_id == newlesson_id:
             post.topic = student.topic
             post.body = student.body
             post.file1 = student.file1
@@ -2407,11 +2098,7 @@ def upload_lesson_file(id):
         if request.method == 'POST':
             file = request.files['file']
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file.save(os.path.join('app/static', 'lesson', filename1))
-                lessonfile.file = url_for('static',filename='%s/%s' % ('lesson', filename1))
+                lessonfile.file = save_file(file)
                 lessonfile.filename = file.filename               
         db.session.add(lessonfile)   
         return redirect(url_for('main.lesson',id=id))
@@ -2435,11 +2122,7 @@ def edit_lesson_file(file_id,lesson_id):
         if request.method == 'POST':
             file = request.files['file']
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                filename1 = current_user.email.replace('@','__').replace('.','__') \
-                            + '__' +str(time.time()).replace('.','') + '.' + filename.split('.')[-1]
-                file.save(os.path.join('app/static', 'lesson', filename1))
-                lessonfile.file = url_for('static',filename='%s/%s' % ('lesson', filename1))
+                lessonfile.file = save_file(file)
                 lessonfile.filename = file.filename               
         db.session.commit()   
         return redirect(url_for('main.lesson',id=lesson_id))
@@ -2451,7 +2134,8 @@ def edit_lesson_file(file_id,lesson_id):
 @main.route('/del-lesson-file/<int:file_id>/<int:lesson_id>', methods=['GET', 'POST'])
 @login_required
 def del_lesson_file(file_id,lesson_id):
-    LessonFile.query.filter_by(id=file_id).delete()
+    lessonfile = LessonFile.query.get_or_404(file_id)
+    db.session.delete(lessonfile)
     return redirect(url_for('main.lesson',id=lesson_id))
 
     
@@ -2613,31 +2297,11 @@ def teacher(id):
     show_opened_lesson = request.cookies.get('show_opened_lesson', '')
     teacher = Teacher.query.filter_by(id=id).first_or_404()
     user = User.query.filter_by(id=teacher.teacher_id).first_or_404()
-    lessons = Lesson.query.filter_by(teacher_id=id).order_by(Lesson.timestamp.desc()).all()
-    lesson_files = []
-    if lessons is not None:
-        for lesson in lessons:
-            lessonfiles = LessonFile.query.filter_by(lesson_id=lesson.id).order_by(LessonFile.timestamp.desc()).all()
-            for lf in lessonfiles:
-                lesson_files.append([lesson,lf])
-    lesson_discussions = []
-    if lessons is not None:
-        for lesson in lessons:
-            newlessons = NewLesson.query.filter_by(lesson_id=lesson.id).order_by(NewLesson.timestamp.desc()).all()
-            for newlesson in newlessons:
-                posts = Post.query.filter_by(tag="newlessons_"+str(newlesson.id)).order_by(Post.timestamp.desc()).all()
-                for p in posts:
-                    user2 = User.query.filter_by(id=p.author_id).first()
-                    lesson_discussions.append([lesson,newlesson,p,user2])
-    lesson_students = []
-    if lessons is not None:
-        for lesson in lessons:
-            newlessons = NewLesson.query.filter_by(lesson_id=lesson.id).order_by(NewLesson.timestamp.desc()).all()
-            for newlesson in newlessons:
-                students = Student.query.filter_by(newlesson_id=newlesson.id).order_by(Student.timestamp.desc()).all()
-                for student in students:
-                    user3 = User.query.filter_by(id=student.student_id).first()
-                    lesson_students.append([lesson,newlesson,user3,student])
+    lessons = Lesson.query.filter_by(teacher_id=teacher.teacher_id).order_by(Lesson.timestamp.desc()).all()
+    newlessons = load_newlessons(lessons)
+    lesson_files = load_lesson_files(lessons)
+    lesson_discussions = load_lesson_discussions(lessons, newlessons)
+    lesson_students = load_lesson_students(lessons, newlessons)
     return render_template('teacher.html', teacher=teacher,user=user,lessons=lessons,\
                            lesson_files=lesson_files,lesson_discussions=lesson_discussions,\
                            lesson_students=lesson_students,
@@ -2713,8 +2377,9 @@ def show_open_lesson(username):
 def collect(post_id,is_collect):
     if is_collect:
         collectpost = CollectPost.query.filter_by(user_id=current_user.id).filter_by(post_id=post_id).first()
-        db.session.delete(collectpost)        
-    else:
+        if collectpost is not None:
+            db.session.delete(collectpost)
+    elif not current_user.bookmarked([Post.query.get_or_404(post_id)]):
         collectpost = CollectPost(user_id=current_user.id,post_id=post_id)
         db.session.add(collectpost)
     db.session.commit()
@@ -2729,24 +2394,18 @@ def collection(user_id):
         form = PostFormE(values)
     else:
         form = PostForm(values)
-    page = request.args.get('page', 1, type=int)
-    collectposts = CollectPost.query.filter_by(user_id=user_id).all()
-    posts = []
-    timestamps = []
-    for cp in collectposts:        
-        p = Post.query.filter_by(id=cp.post_id).filter_by(private=False).first()
-        if p is not None:
-            posts.append(p)
-            timestamps.append(cp.timestamp)
-    pagination = CollectPost.query.filter(CollectPost.user_id==current_user.id).order_by(CollectPost.timestamp.desc()).paginate(
-                          page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-                                                           error_out=False)
-    posts2 = []
-    if len(posts) != 0:
-        timestamps2 = sorted(timestamps,reverse=True)
-        for t in timestamps2:
-            posts2.append(posts[timestamps.index(t)])
-    return render_template('collection.html', form=form, posts=posts2, pagination=pagination, english=english)
+    user = User.query.get_or_404(user_id)
+    # newest bookmark first, each with its post and the post's author
+    query = user.bookmarks.filter(Post.private == False).options(
+        db.contains_eager(CollectPost.post).joinedload(Post.author))
+    pagination = KeysetPagination(query,
+        (CollectPost.timestamp, CollectPost.post_id),
+        request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
+    posts = [bookmark.post for bookmark in pagination.items]
+    return render_template('collection.html', form=form, user=user,
+                           posts=posts, pagination=pagination,
+                           english=english)
 
 @main.route('/white-board')
 def white_board():
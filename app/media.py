@@ -0,0 +1,138 @@
+import mimetypes
+import os
+import posixpath
+from datetime import datetime
+from flask import current_app, request, url_for, abort, safe_join
+from werkzeug.http import parse_range_header, parse_if_range_header
+from werkzeug.wsgi import FileWrapper
+from .store import FOLDER, static_path
+
+
+# Attachments (lecture videos, audio, documents) are served by /media/
+# rather than the static handler:
+#
+# - Responses carry a strong ETag and Last-Modified and answer If-None-Match,
+#   If-Modified-Since and If-Range, so a student scrubbing back through a
+#   video revalidates instead of downloading again.
+# - Range requests get 206 with just the bytes asked for.  Under a server
+#   that offers wsgi.file_wrapper the body is the file itself, seeked to the
+#   start of the range, and the server sends the Content-Length given (with
+#   sendfile(2) in gunicorn, so no bytes are copied through Python).  Other
+#   servers read it through RangeFile, which stops at the end of the range.
+# - With FLASKY_MEDIA_OFFLOAD set to 'x-accel-redirect' (nginx) or
+#   'x-sendfile' (Apache, lighttpd) the worker only checks the request and
+#   hands the transfer to the front end server.
+#
+# Uploads in the content store are named after their hash, so their ETag is
+# that hash and they are cached for a year; older uploads never change once
+# written either, so mtime, size and inode identify their contents.
+
+MEDIA_FOLDERS = (FOLDER, 'video', 'audio', 'lessonfile', 'file', 'post',
+                 'lesson')
+MAX_AGE = 365 * 24 * 3600
+
+
+class RangeFile(object):
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def media_url(url):
+    path = static_path(url)
+    if path is None:
+        return url
+    return url_for('main.media', filename=path)
+
+
+def media_etag(filename, stat):
+    if filename.startswith(FOLDER + '/'):
+        return os.path.splitext(os.path.basename(filename))[0]
+    return '%x-%x-%x' % (int(stat.st_mtime), stat.st_size, stat.st_ino)
+
+
+def byte_range(etag, last_modified, size):
+    # (start, stop) of a single satisfiable Range, None to send everything,
+    # or () when the range cannot be satisfied
+    range = parse_range_header(request.headers.get('Range'))
+    if range is None or range.units != 'bytes' or len(range.ranges) != 1:
+        return None
+    if_range = parse_if_range_header(request.headers.get('If-Range'))
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and \
+            if_range.date.replace(tzinfo=None) != last_modified:
+        return None
+    return range.range_for_length(size) or ()
+
+
+def send_media(filename):
+    filename = posixpath.normpath(filename)
+    if filename.split('/', 1)[0] not in MEDIA_FOLDERS:
+        abort(404)
+    path = safe_join(current_app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    stat = os.stat(path)
+    mimetype = mimetypes.guess_type(filename)[0] or \
+        'application/octet-stream'
+    offload = current_app.config['FLASKY_MEDIA_OFFLOAD']
+
+    response = current_app.response_class(mimetype=mimetype,
+                                          direct_passthrough=True)
+    etag = media_etag(filename, stat)
+    last_modified = datetime.utcfromtimestamp(int(stat.st_mtime))
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    if filename.startswith(FOLDER + '/'):
+        response.cache_control.max_age = MAX_AGE
+    else:
+        response.cache_control.max_age = \
+            current_app.get_send_file_max_age(filename)
+
+    if offload:
+        # the front end server handles ranges itself
+        response.make_conditional(request)
+        if response.status_code == 200:
+            if offload == 'x-accel-redirect':
+                response.headers['X-Accel-Redirect'] = \
+                    current_app.config['FLASKY_MEDIA_ACCEL_PREFIX'] + filename
+            else:
+                response.headers['X-Sendfile'] = path
+        return response
+
+    response.make_conditional(request)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if response.status_code != 200:
+        return response
+    range = byte_range(etag, last_modified, stat.st_size)
+    if range == ():
+        response.status_code = 416
+        response.headers['Content-Range'] = 'bytes */%d' % stat.st_size
+        response.content_length = 0
+        return response
+    start, stop = range or (0, stat.st_size)
+    if range:
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, stop - 1, stat.st_size)
+    response.content_length = stop - start
+    f = open(path, 'rb')
+    f.seek(start)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        response.response = file_wrapper(f, 8192)
+    else:
+        response.response = FileWrapper(RangeFile(f, stop - start))
+    return response
@@ -0,0 +1,73 @@
+import re
+from . import db
+from .models import User, AtMe, ClickTime, update_counters
+
+
+# @mentions in comments.
+#
+# MENTION finds every "@name" that is not part of an email address, using
+# the characters a username may contain (main/forms.py).  Chinese names are
+# often followed straight by text ("@张三你好"), so each match stands for
+# all of its prefixes, and the longest one that is a username wins.  Every
+# candidate of a comment is resolved with one IN query, and the AtMe rows
+# go in with one executemany once the comment has an id, followed by one
+# update of the mentioned users' atme_count and unread @me badges.
+# suggest() serves the comment box's autocomplete from the username index.
+
+MENTION = re.compile(u'(?<![\\w.@])@([\u4e00-\u9fa5A-Za-z0-9_.]{1,64})')
+MAX_MENTIONS = 10
+MAX_SUGGESTIONS = 8
+
+
+def candidates(text):
+    found = []
+    for match in MENTION.findall(text or '')[:MAX_MENTIONS]:
+        found.append([match[:n] for n in range(len(match), 0, -1)])
+    return found
+
+
+def resolve(text):
+    found = candidates(text)
+    if not found:
+        return []
+    names = set(name for prefixes in found for name in prefixes)
+    users = dict(db.session.query(User.username, User.id).filter(
+        User.username.in_(names)))
+    mentions = []
+    for prefixes in found:
+        for name in prefixes:
+            if name in users:
+                if (name, users[name]) not in mentions:
+                    mentions.append((name, users[name]))
+                break
+    return mentions
+
+
+def record_mentions(comment):
+    mentions = resolve(comment.body)
+    if not mentions:
+        return []
+    if comment.id is None:
+        db.session.flush()
+    author = comment.author.username
+    connection = db.session.connection()
+    connection.execute(AtMe.__table__.insert(), [
+        {'comment_id': comment.id, 'username': username,
+         'username_whoatme': author, 'timestamp': comment.timestamp}
+        for username, user_id in mentions])
+    # the executemany bypasses AtMe.on_counted and ClickTime.on_mentioned
+    users = User.__table__
+    ids = [user_id for username, user_id in mentions]
+    update_counters(connection, users, users.c.id.in_(ids), atme_count=1)
+    ClickTime.notify(connection, [user_id for username, user_id in mentions
+                                  if username != author], 'atme')
+    return [username for username, user_id in mentions]
+
+
+def suggest(prefix, limit=MAX_SUGGESTIONS):
+    if not prefix:
+        return []
+    # a range rather than LIKE so every database can use the index
+    return User.query.filter(User.username >= prefix,
+                             User.username < prefix + u'\uffff').\
+        order_by(User.username).limit(limit).all()
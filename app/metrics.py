@@ -0,0 +1,260 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from flask import current_app, g, has_app_context, before_render_template, \
+    template_rendered
+from sqlalchemy.engine import Engine
+from . import db
+
+
+# Per-endpoint request instrumentation.  A sampled request (see
+# FLASKY_METRICS_SAMPLE_RATE) counts its queries and DB time through engine
+# events, so it works whether or not SQLALCHEMY_RECORD_QUERIES is on, plus
+# template render time and wall time, and folds them into histograms keyed
+# by endpoint.  A statement issued FLASKY_METRICS_REPEAT_THRESHOLD or more
+# times in one request is recorded as an N+1 suspect.  Everything is
+# rendered as plain text for the /metrics view.
+#
+# Each process keeps its own numbers, and gunicorn runs several workers
+# behind one port, so a scrape only reaches one of them.  With
+# FLASKY_METRICS_DIR set, every worker writes its totals to
+# metrics-<pid>.json there after each sampled request and /metrics adds
+# up all the files, so any worker answers for the whole server.  Files of
+# workers that have exited are kept so the counters never go backwards;
+# empty the directory when the server is restarted.  Without it the
+# numbers are only those of the worker that answered.
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, state):
+        self.counts = [a + b for a, b in zip(self.counts, state['counts'])]
+        self.sum += state['sum']
+        self.count += state['count']
+
+    def state(self):
+        return {'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class RequestMetrics(object):
+    histograms = (
+        ('queries', 'flasky_request_queries', COUNT_BUCKETS),
+        ('db_time', 'flasky_request_db_seconds', TIME_BUCKETS),
+        ('template_time', 'flasky_request_template_seconds', TIME_BUCKETS),
+        ('wall_time', 'flasky_request_seconds', TIME_BUCKETS),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.suspects = {}
+
+    def start(self):
+        if random.random() >= current_app.config['FLASKY_METRICS_SAMPLE_RATE']:
+            return False
+        g.metrics = {'started': time.time(), 'queries': 0, 'db_time': 0.0,
+                     'template_time': 0.0, 'statements': Counter()}
+        return True
+
+    def finish(self, endpoint):
+        sample = g.pop('metrics', None)
+        if sample is None:
+            return None
+        sample['wall_time'] = time.time() - sample['started']
+        endpoint = endpoint or 'unknown'
+        threshold = current_app.config['FLASKY_METRICS_REPEAT_THRESHOLD']
+        repeated = [(statement, n)
+                    for statement, n in sample['statements'].items()
+                    if n >= threshold]
+        with self.lock:
+            histograms = self.endpoints.get(endpoint)
+            if histograms is None:
+                histograms = self.endpoints[endpoint] = dict(
+                    (field, Histogram(buckets))
+                    for field, name, buckets in self.histograms)
+            for field, histogram in histograms.items():
+                histogram.observe(sample[field])
+            for statement, n in repeated:
+                add_suspect(self.suspects, endpoint, statement, 1, n)
+            self.save()
+        for statement, n in repeated:
+            current_app.logger.warning(
+                'Possible N+1 in %s: statement ran %d times\n%s'
+                % (endpoint, n, statement))
+        return sample
+
+    def clear(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.suspects.clear()
+
+    def state(self):
+        return {
+            'endpoints': dict(
+                (endpoint, dict((field, histogram.state())
+                                for field, histogram in histograms.items()))
+                for endpoint, histograms in self.endpoints.items()),
+            'suspects': [[endpoint, statement, requests, most]
+                         for (endpoint, statement), (requests, most)
+                         in self.suspects.items()]}
+
+    def merge(self, state):
+        for endpoint, fields in state['endpoints'].items():
+            histograms = self.endpoints.setdefault(endpoint, dict(
+                (field, Histogram(buckets))
+                for field, name, buckets in self.histograms))
+            for field, histogram in histograms.items():
+                histogram.merge(fields[field])
+        for endpoint, statement, requests, most in state['suspects']:
+            add_suspect(self.suspects, endpoint, statement, requests, most)
+
+    def path(self):
+        directory = current_app.config['FLASKY_METRICS_DIR']
+        if not directory:
+            return None
+        return os.path.join(directory, 'metrics-%d.json' % os.getpid())
+
+    def save(self):
+        path = self.path()
+        if path is None:
+            return
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # write then rename so a scrape never reads a half-written file
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.state(), f)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            current_app.logger.warning('Cannot write metrics %s' % path)
+
+    def combined(self):
+        total = RequestMetrics()
+        with self.lock:
+            total.merge(self.state())
+        path = self.path()
+        if path is None:
+            return total
+        directory, own = os.path.split(path)
+        names = os.listdir(directory) if os.path.isdir(directory) else []
+        for name in sorted(names):
+            if name == own or not (name.startswith('metrics-') and
+                                   name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    total.merge(json.load(f))
+            except (IOError, OSError, ValueError):
+                current_app.logger.warning('Cannot read metrics %s' % name)
+        return total
+
+    def render(self):
+        return self.combined().text()
+
+    def text(self):
+        lines = []
+        with self.lock:
+            for field, name, buckets in self.histograms:
+                lines.append('# TYPE %s histogram' % name)
+                for endpoint in sorted(self.endpoints):
+                    histogram = self.endpoints[endpoint][field]
+                    label = 'endpoint="%s"' % escape(endpoint)
+                    for bound, total in histogram.cumulative():
+                        lines.append('%s_bucket{%s,le="%s"} %d'
+                                     % (name, label, bound, total))
+                    lines.append('%s_sum{%s} %s' % (name, label,
+                                                    histogram.sum))
+                    lines.append('%s_count{%s} %d' % (name, label,
+                                                      histogram.count))
+            lines.append('# TYPE flasky_repeated_statement_requests counter')
+            lines.append('# TYPE flasky_repeated_statement_max gauge')
+            for (endpoint, statement), (requests, most) in \
+                    sorted(self.suspects.items()):
+                label = 'endpoint="%s",statement="%s"' % (
+                    escape(endpoint), escape(statement[:200]))
+                lines.append('flasky_repeated_statement_requests{%s} %d'
+                             % (label, requests))
+                lines.append('flasky_repeated_statement_max{%s} %d'
+                             % (label, most))
+        return '\n'.join(lines) + '\n'
+
+
+def add_suspect(suspects, endpoint, statement, requests, most):
+    seen, seen_most = suspects.get((endpoint, statement), (0, 0))
+    suspects[(endpoint, statement)] = (seen + requests, max(seen_most, most))
+
+
+def escape(value):
+    return ' '.join(value.split()).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def current_sample():
+    if not has_app_context():
+        return None
+    return g.get('metrics')
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_sample() is not None:
+        conn.info.setdefault('metrics_started', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    sample = current_sample()
+    started = conn.info.get('metrics_started')
+    if sample is None or not started:
+        return
+    sample['queries'] += 1
+    sample['db_time'] += time.time() - started.pop()
+    sample['statements'][statement] += 1
+
+
+def on_before_render_template(sender, template, context, **extra):
+    sample = current_sample()
+    if sample is not None:
+        sample.setdefault('rendering', []).append(time.time())
+
+
+def on_template_rendered(sender, template, context, **extra):
+    sample = current_sample()
+    if sample is not None and sample.get('rendering'):
+        started = sample['rendering'].pop()
+        # a template rendered from inside another is already counted
+        if not sample['rendering']:
+            sample['template_time'] += time.time() - started
+
+
+db.event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+db.event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+before_render_template.connect(on_before_render_template)
+template_rendered.connect(on_template_rendered)
+
+metrics = RequestMetrics()
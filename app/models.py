@@ -1,13 +1,13 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import hashlib
+import os
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from markdown import markdown
-import bleach
 from flask import current_app, request, url_for
 from flask_login import UserMixin, AnonymousUserMixin
 from app.exceptions import ValidationError
 from . import db, login_manager
+from .render import render_markdown
 
 
 class Permission:
@@ -23,6 +23,33 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1] in Permission.ALLOWED_EXTENSIONS
 
 
+# badges read denormalized counter columns instead of running COUNT queries;
+# the ids below may be plain ids or scalar subqueries resolving to one
+def update_counters(connection, table, whereclause, **deltas):
+    deltas = dict((name, n) for name, n in deltas.items() if n)
+    if not deltas:
+        return
+    connection.execute(table.update().where(whereclause).values(
+        dict((table.c[name], table.c[name] + n) for name, n in deltas.items())))
+
+
+def update_user_counters(connection, user_id, **deltas):
+    if user_id is None:
+        return
+    users = User.__table__
+    update_counters(connection, users, users.c.id == user_id, **deltas)
+
+
+def count_rows(table, *criteria):
+    return db.select([db.func.count()]).select_from(table).\
+        where(db.and_(*criteria)).as_scalar()
+
+
+def sum_rows(column, *criteria):
+    return db.select([db.func.coalesce(db.func.sum(column), 0)]).\
+        where(db.and_(*criteria)).as_scalar()
+
+
 class Role(db.Model):
     __tablename__ = 'roles'
     __table_args__ = {"useexisting": True}
@@ -63,16 +90,44 @@ class Follow(db.Model):
     follower_id = db.Column(db.Integer, db.ForeignKey('users.id'),
                             primary_key=True)
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'),
-                            primary_key=True)
+                            primary_key=True, index=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @staticmethod
+    def on_counted(mapper, connection, target, n=1):
+        update_user_counters(connection, target.follower_id, followed_count=n)
+        update_user_counters(connection, target.followed_id, follower_count=n)
+
+    @staticmethod
+    def on_uncounted(mapper, connection, target):
+        Follow.on_counted(mapper, connection, target, n=-1)
+
+db.event.listen(Follow, 'after_insert', Follow.on_counted)
+db.event.listen(Follow, 'after_delete', Follow.on_uncounted)
+
+
+# Bookmarks.  A user's collection is read newest first from the
+# (user_id, timestamp) index, joined to the bookmarked posts.
 class CollectPost(db.Model):
     __tablename__ = 'collectposts'
-    __table_args__ = {"useexisting": True}
+    __table_args__ = (
+        db.Index('ix_collectposts_user_id_timestamp', 'user_id', 'timestamp'),
+        {"useexisting": True})
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'),primary_key=True)
     post_id = db.Column(db.Integer,db.ForeignKey('posts.id'),primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @staticmethod
+    def on_counted(mapper, connection, target, n=1):
+        update_user_counters(connection, target.user_id, collected_count=n)
+
+    @staticmethod
+    def on_uncounted(mapper, connection, target):
+        CollectPost.on_counted(mapper, connection, target, n=-1)
+
+db.event.listen(CollectPost, 'after_insert', CollectPost.on_counted)
+db.event.listen(CollectPost, 'after_delete', CollectPost.on_uncounted)
+
 
 class Letter(db.Model):
     __tablename__ = 'letters'
@@ -105,13 +160,7 @@ class Letter(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3','h4', 'p','br','u','del','tt','cite',
-                        'font','big','small','strike','sup','sub','span','img','kdb']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.body_html = render_markdown(value)
 
     def to_json(self):
         json_post = {
@@ -174,6 +223,16 @@ class User(UserMixin, db.Model):
     avatar_hash = db.Column(db.String(32))
     avatar_file = db.Column(db.String(64))
 
+    post_count = db.Column(db.Integer, default=0, server_default='0')
+    private_count = db.Column(db.Integer, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, default=0, server_default='0')
+    commented_count = db.Column(db.Integer, default=0, server_default='0')
+    commented_new_count = db.Column(db.Integer, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, default=0, server_default='0')
+    follower_count = db.Column(db.Integer, default=0, server_default='0')
+    atme_count = db.Column(db.Integer, default=0, server_default='0')
+    collected_count = db.Column(db.Integer, default=0, server_default='0')
+
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     letters = db.relationship('Letter', foreign_keys=[Letter.sendername], backref='sender', lazy='dynamic')
     letters = db.relationship('Letter', foreign_keys=[Letter.receivername], backref='receiver', lazy='dynamic')
@@ -199,26 +258,24 @@ class User(UserMixin, db.Model):
 
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id)\
-            .filter(Follow.follower_id == self.id)
+        return Post.query.join(Timeline, Timeline.post_id == Post.id)\
+            .filter(Timeline.user_id == self.id)
+
+    @property
+    def bookmarks(self):
+        return CollectPost.query.join(Post, Post.id == CollectPost.post_id)\
+            .filter(CollectPost.user_id == self.id)
+
+    def received_comments(self):
+        return Comment.query.join(Post, Post.id == Comment.post_id)\
+            .filter(Post.author_id == self.id)
 
     def n_commented(self):
-        lnth = 0
-        for post in Post.query.filter(self.id==Post.author_id).all():
-            comments = Comment.query.filter(post.id==Comment.post_id).all()
-            lnth += len(comments)
-        return lnth
+        return self.received_comments().count()
     
     def n_commented_new(self):
-        lnth = 0
-        posts = Post.query.filter_by(author_id=self.id).all()    
-        for post in posts:
-            comments = Comment.query.filter_by(post_id=post.id).all()
-            if len(comments) != 0:
-                for comment in comments:
-                    if comment.timestamp > self.last_seen:
-                        lnth += 1
-        return lnth
+        return self.received_comments()\
+            .filter(Comment.timestamp > self.last_seen).count()
     
     def n_collected(self):
         collections = CollectPost.query.filter(self.id==CollectPost.user_id).all()
@@ -227,8 +284,15 @@ class User(UserMixin, db.Model):
 
     def commented(self):
         commented_ = []
-        for post in Post.query.filter(self.id==Post.author_id).all():
-            commented_.append([post,Comment.query.filter(post.id==Comment.post_id).all()])
+        rows = db.session.query(Post, Comment)\
+            .outerjoin(Comment, Comment.post_id == Post.id)\
+            .filter(Post.author_id == self.id)\
+            .order_by(Post.id, Comment.id).all()
+        for post, comment in rows:
+            if not commented_ or commented_[-1][0] is not post:
+                commented_.append([post, []])
+            if comment is not None:
+                commented_[-1][1].append(comment)
         return commented_
 
     @staticmethod
@@ -261,6 +325,37 @@ class User(UserMixin, db.Model):
                 db.session.add(user)
                 db.session.commit()
 
+    @staticmethod
+    def reconcile_counters():
+        users = User.__table__
+        posts = Post.__table__
+        comments = Comment.__table__
+        follows = Follow.__table__
+        atmes = AtMe.__table__
+        collectposts = CollectPost.__table__
+        count = count_rows
+
+        db.session.execute(users.update().values(
+            post_count=count(posts, posts.c.author_id == users.c.id),
+            private_count=count(posts, posts.c.author_id == users.c.id,
+                                posts.c.private == True),
+            comment_count=count(comments, comments.c.author_id == users.c.id),
+            commented_count=count(
+                comments.join(posts, posts.c.id == comments.c.post_id),
+                posts.c.author_id == users.c.id),
+            commented_new_count=count(
+                comments.join(posts, posts.c.id == comments.c.post_id),
+                posts.c.author_id == users.c.id,
+                comments.c.timestamp > users.c.last_seen),
+            followed_count=count(follows, follows.c.follower_id == users.c.id),
+            follower_count=count(follows, follows.c.followed_id == users.c.id),
+            atme_count=count(atmes, atmes.c.username == users.c.username),
+            collected_count=count(collectposts,
+                                  collectposts.c.user_id == users.c.id)))
+        db.session.execute(posts.update().values(
+            comment_count=count(comments, comments.c.post_id == posts.c.id)))
+        db.session.commit()
+
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
         if self.role is None:
@@ -346,10 +441,6 @@ class User(UserMixin, db.Model):
     def is_administrator(self):
         return self.can(Permission.ADMINISTER)
 
-    def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
-
     def gravatar(self, size=100, default='identicon', rating='g'):
         if request.is_secure:
             url = 'https://secure.gravatar.com/avatar'
@@ -360,6 +451,10 @@ class User(UserMixin, db.Model):
         return '{url}/{hash}?s={size}&d={default}&r={rating}'.format(
             url=url, hash=hash, size=size, default=default, rating=rating)
 
+    def avatar_url(self, size=40):
+        from .avatars import avatar_url
+        return avatar_url(self, size)
+
     def follow(self, user):
         if not self.is_following(user):
             f = Follow(follower=self, followed=user)
@@ -377,6 +472,15 @@ class User(UserMixin, db.Model):
     def is_followed_by(self, user):
         return self.followers.filter_by(
             follower_id=user.id).first() is not None
+
+    def bookmarked(self, posts):
+        # the ids of those posts this user bookmarked, in one query
+        ids = set(post.id for post in posts)
+        if not ids:
+            return set()
+        return set(row[0] for row in db.session.query(CollectPost.post_id)
+                   .filter(CollectPost.user_id == self.id,
+                           CollectPost.post_id.in_(ids)))
             
     def to_json(self):
         json_user = {
@@ -387,7 +491,7 @@ class User(UserMixin, db.Model):
             'posts': url_for('api.get_user_posts', id=self.id, _external=True),
             'followed_posts': url_for('api.get_user_followed_posts',
                                       id=self.id, _external=True),
-            'post_count': self.posts.count()
+            'post_count': self.post_count
         }
         return json_user
 
@@ -414,6 +518,17 @@ class User(UserMixin, db.Model):
     def count_private(self):
         return Post.query.filter_by(author_id=self.id).filter_by(private=True).count()
 
+    # post cards show the author's name and avatar
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        state = db.inspect(target)
+        if any(state.attrs[name].history.has_changes() for name in
+               ('username', 'email', 'avatar_hash', 'avatar_file')):
+            Post.bump_versions(connection, target.id)
+
+db.event.listen(User, 'after_update', User.on_updated)
+
+
 class AnonymousUser(AnonymousUserMixin):
     def can(self, permissions):
         return False
@@ -421,6 +536,9 @@ class AnonymousUser(AnonymousUserMixin):
     def is_administrator(self):
         return False
 
+    def bookmarked(self, posts):
+        return set()
+
 login_manager.anonymous_user = AnonymousUser
 
 
@@ -431,36 +549,53 @@ def load_user(user_id):
 
 class Post(db.Model):
     __tablename__ = 'posts'
-    __table_args__ = {"useexisting": True}
+    __table_args__ = (
+        db.Index('ix_posts_newlesson_id_timestamp', 'newlesson_id', 'timestamp'),
+        {"useexisting": True})
     id = db.Column(db.Integer, primary_key=True)
     topic = db.Column(db.String(64))
 
-    pic = db.Column(db.String(64))  
-    pic1 = db.Column(db.String(64))  
-    pic2 = db.Column(db.String(64))  
-    pic3 = db.Column(db.String(64))  
-
-    file1 = db.Column(db.String(64))  
+    pic = db.column_property(db.Column(db.String(64)),
+                             active_history=True)
+    pic1 = db.column_property(db.Column(db.String(64)),
+                              active_history=True)
+    pic2 = db.column_property(db.Column(db.String(64)),
+                              active_history=True)
+    pic3 = db.column_property(db.Column(db.String(64)),
+                              active_history=True)
+
+    file1 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
     filename1 = db.Column(db.String(64))       
-    file2 = db.Column(db.String(64))  
+    file2 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
     filename2 = db.Column(db.String(64))       
-    file3 = db.Column(db.String(64))  
+    file3 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
     filename3 = db.Column(db.String(64))       
-    file4 = db.Column(db.String(64))  
+    file4 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
     filename4 = db.Column(db.String(64))       
-    file5 = db.Column(db.String(64))  
+    file5 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
     filename5 = db.Column(db.String(64))       
 
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
 
-    private = db.Column(db.Boolean, default=False)
+    private = db.column_property(db.Column(db.Boolean, default=False),
+                                 active_history=True)
     
     tag = db.Column(db.String(64))  
+    version = db.Column(db.Integer, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, default=0, server_default='0')
+    newlesson_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('newlessons.id')),
+        active_history=True)
 
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
 
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
     collectposts = db.relationship('CollectPost', backref='post', lazy='dynamic')
@@ -484,13 +619,7 @@ class Post(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3','h4', 'p','br','u','del','tt','cite',
-                        'font','big','small','strike','sup','sub','span','img','kdb']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.body_html = render_markdown(value)
 
     def to_json(self):
         json_post = {
@@ -515,12 +644,186 @@ class Post(db.Model):
         return Post(body=body)
 
 
+    @staticmethod
+    def newlesson_id_from_tag(tag):
+        if tag is not None and tag.startswith('newlessons_'):
+            try:
+                return int(tag.split('_')[1])
+            except ValueError:
+                return None
+        return None
+
+    # a new version retires the post's cached card in _posts.html
+    @staticmethod
+    def on_edited(mapper, connection, target):
+        if db.object_session(target).is_modified(
+                target, include_collections=False):
+            target.version = (target.version or 0) + 1
+
+    @staticmethod
+    def bump_versions(connection, author_id):
+        posts = Post.__table__
+        connection.execute(posts.update().
+                           where(posts.c.author_id == author_id).
+                           values(version=posts.c.version + 1))
+
+    # class posts keep their "newlessons_<id>" tag for routing, but are
+    # looked up through the indexed newlesson_id derived from it
+    @staticmethod
+    def on_changed_tag(target, value, oldvalue, initiator):
+        target.newlesson_id = Post.newlesson_id_from_tag(value)
+
+    @staticmethod
+    def on_counted(mapper, connection, target, n=1):
+        update_user_counters(connection, target.author_id, post_count=n,
+                             private_count=n if target.private else 0)
+        NewLesson.update_stats(connection, target.newlesson_id,
+                               discussion_count=n)
+
+    @staticmethod
+    def on_uncounted(mapper, connection, target):
+        Post.on_counted(mapper, connection, target, n=-1)
+
+    @staticmethod
+    def on_recounted(mapper, connection, target):
+        history = db.inspect(target).attrs.private.history
+        if history.has_changes():
+            was_private = bool(history.deleted and history.deleted[0])
+            update_user_counters(connection, target.author_id,
+                private_count=int(bool(target.private)) - int(was_private))
+        history = db.inspect(target).attrs.newlesson_id.history
+        if history.has_changes():
+            for newlesson_id in history.deleted:
+                NewLesson.update_stats(connection, newlesson_id,
+                                       discussion_count=-1)
+            NewLesson.update_stats(connection, target.newlesson_id,
+                                   discussion_count=1)
+
+
 db.event.listen(Post.body, 'set', Post.on_changed_body)
+db.event.listen(Post.tag, 'set', Post.on_changed_tag)
+db.event.listen(Post, 'before_update', Post.on_edited)
+db.event.listen(Post, 'after_insert', Post.on_counted)
+db.event.listen(Post, 'after_delete', Post.on_uncounted)
+db.event.listen(Post, 'after_update', Post.on_recounted)
+
+
+# Each user's followed posts are copied into timelines when they are written
+# (and when a follow starts or ends), so reading a timeline is a range scan
+# on (user_id, timestamp) instead of a join over every followed author.
+# A new post costs one INSERT ... SELECT however many followers its author
+# has; timelines are cut back to FLASKY_TIMELINE_LENGTH by trim_all()
+# ("manage.py trim_timelines") rather than one DELETE per follower.
+class Timeline(db.Model):
+    __tablename__ = 'timelines'
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp'),
+        {"useexisting": True})
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                        primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'),
+                        primary_key=True)
+    timestamp = db.Column(db.DateTime)
+
+    @staticmethod
+    def trim(connection, user_id):
+        timelines = Timeline.__table__
+        cutoff = connection.execute(
+            db.select([timelines.c.timestamp]).
+            where(timelines.c.user_id == user_id).
+            order_by(timelines.c.timestamp.desc()).
+            offset(current_app.config['FLASKY_TIMELINE_LENGTH'] - 1).
+            limit(1)).scalar()
+        if cutoff is not None:
+            connection.execute(timelines.delete().
+                               where(timelines.c.user_id == user_id).
+                               where(timelines.c.timestamp < cutoff))
+
+    @staticmethod
+    def trim_all():
+        connection = db.session.connection()
+        timelines = Timeline.__table__
+        # only the timelines that have grown past the limit
+        users = [row[0] for row in connection.execute(
+            db.select([timelines.c.user_id]).
+            group_by(timelines.c.user_id).
+            having(db.func.count() >
+                   current_app.config['FLASKY_TIMELINE_LENGTH']))]
+        for user_id in users:
+            Timeline.trim(connection, user_id)
+        db.session.commit()
+        return len(users)
+
+    @staticmethod
+    def on_posted(mapper, connection, target):
+        timelines = Timeline.__table__
+        follows = Follow.__table__
+        connection.execute(timelines.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([follows.c.follower_id, db.literal(target.id),
+                       db.literal(target.timestamp, db.DateTime)]).
+            where(follows.c.followed_id == target.author_id)))
+
+    @staticmethod
+    def on_post_deleted(mapper, connection, target):
+        timelines = Timeline.__table__
+        connection.execute(timelines.delete().
+                           where(timelines.c.post_id == target.id))
+
+    @staticmethod
+    def on_followed(mapper, connection, target):
+        timelines = Timeline.__table__
+        posts = Post.__table__
+        connection.execute(timelines.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([db.literal(target.follower_id), posts.c.id,
+                       posts.c.timestamp]).
+            where(posts.c.author_id == target.followed_id).
+            order_by(posts.c.timestamp.desc()).
+            limit(current_app.config['FLASKY_TIMELINE_LENGTH'])))
+        Timeline.trim(connection, target.follower_id)
+
+    @staticmethod
+    def on_unfollowed(mapper, connection, target):
+        timelines = Timeline.__table__
+        posts = Post.__table__
+        connection.execute(timelines.delete().
+                           where(timelines.c.user_id == target.follower_id).
+                           where(timelines.c.post_id.in_(
+                               db.select([posts.c.id]).
+                               where(posts.c.author_id ==
+                                     target.followed_id))))
+
+    @staticmethod
+    def rebuild():
+        connection = db.session.connection()
+        timelines = Timeline.__table__
+        posts = Post.__table__
+        follows = Follow.__table__
+        connection.execute(timelines.delete())
+        connection.execute(timelines.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([follows.c.follower_id, posts.c.id,
+                       posts.c.timestamp]).
+            where(posts.c.author_id == follows.c.followed_id)))
+        for row in connection.execute(
+                db.select([timelines.c.user_id]).distinct()):
+            Timeline.trim(connection, row[0])
+        db.session.commit()
+
+db.event.listen(Post, 'after_insert', Timeline.on_posted)
+db.event.listen(Post, 'before_delete', Timeline.on_post_deleted)
+db.event.listen(Follow, 'after_insert', Timeline.on_followed)
+db.event.listen(Follow, 'after_delete', Timeline.on_unfollowed)
 
 
 class Comment(db.Model):
     __tablename__ = 'comments'
-    __table_args__ = {"useexisting": True}
+    # (post_id, timestamp) serves both a post's comment thread and the
+    # comments received on a user's posts, newest first
+    __table_args__ = (
+        db.Index('ix_comments_post_id_timestamp', 'post_id', 'timestamp'),
+        {"useexisting": True})
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
@@ -528,20 +831,16 @@ class Comment(db.Model):
 
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    post_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('posts.id')),
+        active_history=True)
 
     atmes = db.relationship('AtMe', backref='comment', lazy='dynamic')
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3','h4', 'p','br','u','del','tt','cite',
-                        'font','big','small','strike','sup','sub','span','img','kdb']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.body_html = render_markdown(value)
 
     def to_json(self):
         json_comment = {
@@ -562,7 +861,70 @@ class Comment(db.Model):
             raise ValidationError('评论不能为空。')
         return Comment(body=body)
 
+    @staticmethod
+    def post_author_id(post_id):
+        if post_id is None:
+            return None
+        posts = Post.__table__
+        return db.select([posts.c.author_id]).\
+            where(posts.c.id == post_id).as_scalar()
+
+    @staticmethod
+    def on_counted(mapper, connection, target, n=1):
+        update_user_counters(connection, target.author_id, comment_count=n)
+        update_user_counters(connection, Comment.post_author_id(target.post_id),
+                             commented_count=n)
+        Comment.count_unread(connection, target.post_id, target.timestamp, n)
+        Comment.count_on_post(connection, target.post_id, n)
+
+    @staticmethod
+    def count_on_post(connection, post_id, n):
+        if post_id is None:
+            return
+        posts = Post.__table__
+        update_counters(connection, posts, posts.c.id == post_id,
+                        comment_count=n)
+
+    @staticmethod
+    def on_uncounted(mapper, connection, target):
+        Comment.on_counted(mapper, connection, target, n=-1)
+
+    # a comment is unread while it is newer than its post author's last_seen;
+    # presence.LastSeenTracker.flush() recounts it when a visit is recorded
+    @staticmethod
+    def count_unread(connection, post_id, timestamp, n):
+        author_id = Comment.post_author_id(post_id)
+        if author_id is None:
+            return
+        users = User.__table__
+        timestamp = timestamp or datetime.utcnow()
+        connection.execute(users.update().where(db.and_(
+            users.c.id == author_id,
+            db.or_(users.c.last_seen == None, users.c.last_seen < timestamp),
+            users.c.commented_new_count + n >= 0)).values(
+            commented_new_count=users.c.commented_new_count + n))
+
+    @staticmethod
+    def on_recounted(mapper, connection, target):
+        # deleting a post detaches its comments by nulling post_id
+        history = db.inspect(target).attrs.post_id.history
+        if history.has_changes():
+            for post_id in history.deleted:
+                update_user_counters(connection, Comment.post_author_id(post_id),
+                                     commented_count=-1)
+                Comment.count_unread(connection, post_id, target.timestamp, -1)
+                Comment.count_on_post(connection, post_id, -1)
+            update_user_counters(connection,
+                                 Comment.post_author_id(target.post_id),
+                                 commented_count=1)
+            Comment.count_unread(connection, target.post_id,
+                                 target.timestamp, 1)
+            Comment.count_on_post(connection, target.post_id, 1)
+
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(Comment, 'after_insert', Comment.on_counted)
+db.event.listen(Comment, 'after_delete', Comment.on_uncounted)
+db.event.listen(Comment, 'after_update', Comment.on_recounted)
 
 
 class Lesson(db.Model):
@@ -572,15 +934,24 @@ class Lesson(db.Model):
     lesson_name = db.Column(db.String(64))
     about_lesson = db.Column(db.Text())
     about_lesson_html = db.Column(db.Text)
-    pic = db.Column(db.String(64))  
-    file1 = db.Column(db.String(64))  
-    file2 = db.Column(db.String(64))  
-    file3 = db.Column(db.String(64))  
-    file4 = db.Column(db.String(64))  
-    file5 = db.Column(db.String(64))  
-    file6 = db.Column(db.String(64))  
-    file7 = db.Column(db.String(64))  
-    file8 = db.Column(db.String(64))  
+    pic = db.column_property(db.Column(db.String(64)),
+                             active_history=True)
+    file1 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file2 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file3 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file4 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file5 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file6 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file7 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file8 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
     filename1 = db.Column(db.String(64))  
     filename2 = db.Column(db.String(64))  
     filename3 = db.Column(db.String(64))  
@@ -591,7 +962,14 @@ class Lesson(db.Model):
     filename8 = db.Column(db.String(64))        
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
-    teacher_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    newlesson_count = db.Column(db.Integer, default=0, server_default='0')
+    file_count = db.Column(db.Integer, default=0, server_default='0')
+    discussion_count = db.Column(db.Integer, default=0, server_default='0')
+    student_count = db.Column(db.Integer, default=0, server_default='0')
+
+    teacher_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('users.id'), index=True),
+        active_history=True)
 
     newlessons = db.relationship('NewLesson', backref='newlesson', lazy='dynamic')
 
@@ -615,13 +993,7 @@ class Lesson(db.Model):
 
     @staticmethod
     def on_changed_about_lesson(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3','h4', 'p','br','u','del','tt','cite',
-                        'font','big','small','strike','sup','sub','span','img','kdb']
-        target.about_lesson_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.about_lesson_html = render_markdown(value)
 
     def to_json(self):
         json_post = {
@@ -646,24 +1018,66 @@ class Lesson(db.Model):
         return Lesson(about_lesson=about_lesson)
     
     def count_newlesson(self):
-        return NewLesson.query.filter_by(lesson_id=self.id).count()
+        return self.newlesson_count
     def count_file(self):
-        return LessonFile.query.filter_by(lesson_id=self.id).count()
+        return self.file_count
     def count_discussion(self):
-        newlessons = NewLesson.query.filter_by(lesson_id=self.id).all()
-        n = 0
-        for nl in newlessons:
-            n += Post.query.filter_by(tag="newlessons_" + str(nl.id)).count()
-        return n
+        return self.discussion_count
     def count_student(self):
-        newlessons = NewLesson.query.filter_by(lesson_id=self.id).all()
-        n = 0
-        for nl in newlessons:
-            n += Student.query.filter_by(newlesson_id=nl.id).count()
-        return n
+        return self.student_count
+
+    # class counters roll up into the lesson row and then the teacher row
+    @staticmethod
+    def update_stats(connection, lesson_id, **deltas):
+        if lesson_id is None:
+            return
+        lessons = Lesson.__table__
+        update_counters(connection, lessons, lessons.c.id == lesson_id, **deltas)
+        Teacher.update_stats(connection,
+                             db.select([lessons.c.teacher_id]).
+                             where(lessons.c.id == lesson_id).as_scalar(),
+                             lesson_count=deltas.get('lesson_count'),
+                             file_count=deltas.get('file_count'),
+                             discussion_count=deltas.get('discussion_count'),
+                             student_count=deltas.get('student_count'))
+
+    @staticmethod
+    def reconcile_stats(connection, lesson_id=None):
+        lessons = Lesson.__table__
+        newlessons = NewLesson.__table__
+        lessonfiles = LessonFile.__table__
+        in_lesson = newlessons.c.lesson_id == lessons.c.id
+        stmt = lessons.update().values(
+            newlesson_count=count_rows(newlessons, in_lesson),
+            file_count=count_rows(lessonfiles,
+                                  lessonfiles.c.lesson_id == lessons.c.id),
+            discussion_count=sum_rows(newlessons.c.discussion_count, in_lesson),
+            student_count=sum_rows(newlessons.c.student_count, in_lesson))
+        if lesson_id is not None:
+            stmt = stmt.where(lessons.c.id == lesson_id)
+        connection.execute(stmt)
+
+    # deleting or moving a lesson is rare, so just recount what it touched
+    @staticmethod
+    def on_restructured(mapper, connection, target):
+        history = db.inspect(target).attrs.teacher_id.history
+        for teacher_id in set(list(history.deleted) + [target.teacher_id]):
+            Teacher.reconcile_stats(connection, teacher_id)
+
+    @staticmethod
+    def on_moved(mapper, connection, target):
+        if db.inspect(target).attrs.teacher_id.history.has_changes():
+            Lesson.on_restructured(mapper, connection, target)
+
+    @staticmethod
+    def on_created(mapper, connection, target):
+        Teacher.update_stats(connection, target.teacher_id, lesson_count=1)
 
 
 db.event.listen(Lesson.about_lesson, 'set', Lesson.on_changed_about_lesson)
+db.event.listen(Lesson, 'after_insert', Lesson.on_created)
+db.event.listen(Lesson, 'after_delete', Lesson.on_restructured)
+db.event.listen(Lesson, 'after_update', Lesson.on_moved)
 
 
 class NewLesson(db.Model):
@@ -686,20 +1100,80 @@ class NewLesson(db.Model):
 #
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
-    lesson_id = db.Column(db.Integer, db.ForeignKey('lessons.id'))
+    student_count = db.Column(db.Integer, default=0, server_default='0')
+    seat_count = db.Column(db.Integer, default=0, server_default='0')
+    discussion_count = db.Column(db.Integer, default=0, server_default='0')
+    exercise_count = db.Column(db.Integer, default=0, server_default='0')
+
+    lesson_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('lessons.id'), index=True),
+        active_history=True)
 
     students_id = db.relationship('Student', backref='students', lazy='dynamic')
     
     def count_student(self):
-        return Student.query.filter_by(newlesson_id=self.id).count()
+        return self.student_count
     def count_seat(self):
-        return Student.query.filter_by(newlesson_id=self.id).count()-\
-    Student.query.filter_by(newlesson_id=self.id).filter_by(seat=None).count()
+        return self.seat_count
     def count_discussion(self):
-        return Post.query.filter_by(tag="newlessons_" + str(self.id)).count()
+        return self.discussion_count
     def count_exercise(self):
-        return Student.query.filter_by(newlesson_id=self.id).count()-\
-    Student.query.filter_by(newlesson_id=self.id).filter_by(topic=None).count()
+        return self.exercise_count
+
+    @staticmethod
+    def update_stats(connection, newlesson_id, **deltas):
+        if newlesson_id is None:
+            return
+        newlessons = NewLesson.__table__
+        update_counters(connection, newlessons,
+                        newlessons.c.id == newlesson_id, **deltas)
+        Lesson.update_stats(connection,
+                            db.select([newlessons.c.lesson_id]).
+                            where(newlessons.c.id == newlesson_id).as_scalar(),
+                            discussion_count=deltas.get('discussion_count'),
+                            student_count=deltas.get('student_count'))
+
+    @staticmethod
+    def reconcile_stats(connection, newlesson_id=None):
+        newlessons = NewLesson.__table__
+        students = Student.__table__
+        posts = Post.__table__
+        in_class = students.c.newlesson_id == newlessons.c.id
+        stmt = newlessons.update().values(
+            student_count=count_rows(students, in_class),
+            seat_count=count_rows(students, in_class,
+                                  students.c.seat != None),
+            exercise_count=count_rows(students, in_class,
+                                      students.c.topic != None),
+            discussion_count=count_rows(posts, posts.c.newlesson_id ==
+                                        newlessons.c.id))
+        if newlesson_id is not None:
+            stmt = stmt.where(newlessons.c.id == newlesson_id)
+        connection.execute(stmt)
+
+    @staticmethod
+    def on_restructured(mapper, connection, target):
+        history = db.inspect(target).attrs.lesson_id.history
+        for lesson_id in set(list(history.deleted) + [target.lesson_id]):
+            Lesson.reconcile_stats(connection, lesson_id)
+            lessons = Lesson.__table__
+            Teacher.reconcile_stats(connection,
+                                    db.select([lessons.c.teacher_id]).
+                                    where(lessons.c.id == lesson_id).
+                                    as_scalar())
+
+    @staticmethod
+    def on_moved(mapper, connection, target):
+        if db.inspect(target).attrs.lesson_id.history.has_changes():
+            NewLesson.on_restructured(mapper, connection, target)
+
+    @staticmethod
+    def on_created(mapper, connection, target):
+        Lesson.update_stats(connection, target.lesson_id, newlesson_count=1)
+
+db.event.listen(NewLesson, 'after_insert', NewLesson.on_created)
+db.event.listen(NewLesson, 'after_delete', NewLesson.on_restructured)
+db.event.listen(NewLesson, 'after_update', NewLesson.on_moved)
 
 
 
@@ -710,31 +1184,61 @@ class LessonFile(db.Model):
     
     filetype = db.Column(db.String(8))
     visibility = db.Column(db.String(8))
-    file = db.Column(db.String(64))
+    file = db.column_property(db.Column(db.String(64)),
+                              active_history=True)
     filename = db.Column(db.String(64))  
     about = db.Column(db.String(128))  
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
-    lesson_id = db.Column(db.Integer, db.ForeignKey('lessons.id'))
+    lesson_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('lessons.id'), index=True),
+        active_history=True)
+
+    @staticmethod
+    def on_counted(mapper, connection, target, n=1):
+        Lesson.update_stats(connection, target.lesson_id, file_count=n)
+
+    @staticmethod
+    def on_uncounted(mapper, connection, target):
+        LessonFile.on_counted(mapper, connection, target, n=-1)
+
+    @staticmethod
+    def on_recounted(mapper, connection, target):
+        history = db.inspect(target).attrs.lesson_id.history
+        if history.has_changes():
+            for lesson_id in history.deleted:
+                Lesson.update_stats(connection, lesson_id, file_count=-1)
+            Lesson.update_stats(connection, target.lesson_id, file_count=1)
+
+db.event.listen(LessonFile, 'after_insert', LessonFile.on_counted)
+db.event.listen(LessonFile, 'after_delete', LessonFile.on_uncounted)
+db.event.listen(LessonFile, 'after_update', LessonFile.on_recounted)
 
 
 class Student(db.Model):
     __tablename__ = 'students'
     __table_args__ = {"useexisting": True}
     id = db.Column(db.Integer, primary_key=True)
-    seat = db.Column(db.String(4))
+    seat = db.column_property(db.Column(db.String(4)), active_history=True)
     absence = db.Column(db.Integer,default=0)
     confirm = db.Column(db.Boolean, default=False)
+    # class posts since the student last opened the discussion tab
+    unread_discussion = db.Column(db.Integer, default=0, server_default='0')
 
-    topic = db.Column(db.String(64))  
+    topic = db.column_property(db.Column(db.String(64)), active_history=True)
     body = db.Column(db.Text())
     body_html = db.Column(db.Text())
     
-    file1 = db.Column(db.String(64))  
-    file2 = db.Column(db.String(64))  
-    file3 = db.Column(db.String(64))  
-    file4 = db.Column(db.String(64))  
-    file5 = db.Column(db.String(64))   
+    file1 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file2 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file3 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file4 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
+    file5 = db.column_property(db.Column(db.String(64)),
+                               active_history=True)
     
     filename1 = db.Column(db.String(64))  
     filename2 = db.Column(db.String(64))  
@@ -748,8 +1252,10 @@ class Student(db.Model):
     
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
-    student_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    newlesson_id = db.Column(db.Integer, db.ForeignKey('newlessons.id'))
+    student_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    newlesson_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('newlessons.id'), index=True),
+        active_history=True)
 
 
     @staticmethod
@@ -769,13 +1275,7 @@ class Student(db.Model):
 
     @staticmethod
     def on_changed_about_student(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3','h4', 'p','br','u','del','tt','cite',
-                        'font','big','small','strike','sup','sub','span','img','kdb']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.body_html = render_markdown(value)
 
     def to_json(self):
         json_post = {
@@ -797,8 +1297,45 @@ class Student(db.Model):
         if body is None or body == '':
             raise ValidationError('帖子不能为空。')
         return Student(body=body)
-    
-    
+
+    @staticmethod
+    def count_in_class(connection, newlesson_id, seated, exercised, n):
+        NewLesson.update_stats(connection, newlesson_id, student_count=n,
+                               seat_count=n if seated else 0,
+                               exercise_count=n if exercised else 0)
+
+    @staticmethod
+    def on_counted(mapper, connection, target, n=1):
+        Student.count_in_class(connection, target.newlesson_id,
+                               target.seat is not None,
+                               target.topic is not None, n)
+
+    @staticmethod
+    def on_uncounted(mapper, connection, target):
+        Student.on_counted(mapper, connection, target, n=-1)
+
+    @staticmethod
+    def on_recounted(mapper, connection, target):
+        state = db.inspect(target)
+
+        def before(name):
+            history = state.attrs[name].history
+            if history.has_changes():
+                return history.deleted[0] if history.deleted else None
+            return getattr(target, name)
+
+        old = (before('newlesson_id'), before('seat') is not None,
+               before('topic') is not None)
+        new = (target.newlesson_id, target.seat is not None,
+               target.topic is not None)
+        if old != new:
+            Student.count_in_class(connection, *old, n=-1)
+            Student.count_in_class(connection, *new, n=1)
+
+db.event.listen(Student, 'after_insert', Student.on_counted)
+db.event.listen(Student, 'after_delete', Student.on_uncounted)
+db.event.listen(Student, 'after_update', Student.on_recounted)
+
 
 class Teacher(db.Model):
     __tablename__ = 'teachers'
@@ -806,12 +1343,18 @@ class Teacher(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     school = db.Column(db.String(64))
     field = db.Column(db.String(64))  
-    pic = db.Column(db.String(64))  
+    pic = db.column_property(db.Column(db.String(64)),
+                             active_history=True)
     about_teacher = db.Column(db.Text())
     about_teacher_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
-    teacher_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    lesson_count = db.Column(db.Integer, default=0, server_default='0')
+    file_count = db.Column(db.Integer, default=0, server_default='0')
+    discussion_count = db.Column(db.Integer, default=0, server_default='0')
+    student_count = db.Column(db.Integer, default=0, server_default='0')
+
+    teacher_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
 
     @staticmethod
     def generate_fake(count=100):
@@ -830,13 +1373,7 @@ class Teacher(db.Model):
 
     @staticmethod
     def on_changed_about_teacher(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3','h4', 'p','br','u','del','tt','cite',
-                        'font','big','small','strike','sup','sub','span','img','kdb']
-        target.about_teacher_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.about_teacher_html = render_markdown(value)
 
     def to_json(self):
         json_post = {
@@ -862,34 +1399,51 @@ class Teacher(db.Model):
 
     
     def count_lesson(self):
-        return Lesson.query.filter_by(teacher_id=self.id).count()
+        return self.lesson_count
     def count_file(self):
-        lessons = Lesson.query.filter_by(teacher_id=self.id).all()
-        n = 0
-        if lessons is not None:
-            for lesson in lessons:
-                n += LessonFile.query.filter_by(lesson_id=lesson.id).count()
-        return n
+        return self.file_count
     def count_discussion(self):
-        lessons = Lesson.query.filter_by(teacher_id=self.id).all()
-        n = 0
-        if lessons is not None:
-            for lesson in lessons:
-                newlessons = NewLesson.query.filter_by(lesson_id=lesson.id).all()
-                for newlesson in newlessons:
-                    n += Post.query.filter_by(tag="newlessons_"+str(newlesson.id)).count()
-        return n
+        return self.discussion_count
     def count_student(self):
-        lessons = Lesson.query.filter_by(teacher_id=self.id).all()
-        n = 0
-        if lessons is not None:
-            for lesson in lessons:
-                newlessons = NewLesson.query.filter_by(lesson_id=lesson.id).all()
-                for newlesson in newlessons:
-                    n += Student.query.filter_by(newlesson_id=newlesson.id).count()
-        return n
+        return self.student_count
+
+    # teachers are keyed by their user id, the same id lessons.teacher_id holds
+    @staticmethod
+    def update_stats(connection, teacher_id, **deltas):
+        if teacher_id is None:
+            return
+        teachers = Teacher.__table__
+        update_counters(connection, teachers,
+                        teachers.c.teacher_id == teacher_id, **deltas)
+
+    @staticmethod
+    def reconcile_stats(connection, teacher_id=None):
+        teachers = Teacher.__table__
+        lessons = Lesson.__table__
+        taught = lessons.c.teacher_id == teachers.c.teacher_id
+        stmt = teachers.update().values(
+            lesson_count=count_rows(lessons, taught),
+            file_count=sum_rows(lessons.c.file_count, taught),
+            discussion_count=sum_rows(lessons.c.discussion_count, taught),
+            student_count=sum_rows(lessons.c.student_count, taught))
+        if teacher_id is not None:
+            stmt = stmt.where(teachers.c.teacher_id == teacher_id)
+        connection.execute(stmt)
+
+    @staticmethod
+    def rebuild_stats():
+        connection = db.session.connection()
+        NewLesson.reconcile_stats(connection)
+        Lesson.reconcile_stats(connection)
+        Teacher.reconcile_stats(connection)
+        db.session.commit()
+
+    @staticmethod
+    def on_created(mapper, connection, target):
+        Teacher.reconcile_stats(connection, target.teacher_id)
 
 db.event.listen(Teacher.about_teacher, 'set', Teacher.on_changed_about_teacher)
+db.event.listen(Teacher, 'after_insert', Teacher.on_created)
 
 
 class AtMe(db.Model):
@@ -900,9 +1454,30 @@ class AtMe(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     comment_id = db.Column(db.Integer, db.ForeignKey('comments.id'))
     username_whoatme = db.Column(db.String(64))
-    username = db.Column(db.String, db.ForeignKey('users.username'))
-    
+    username = db.Column(db.String, db.ForeignKey('users.username'),
+                         index=True)
+
+    @staticmethod
+    def on_counted(mapper, connection, target, n=1):
+        users = User.__table__
+        update_user_counters(connection,
+                             db.select([users.c.id]).
+                             where(users.c.username == target.username).
+                             as_scalar(),
+                             atme_count=n)
+
+    @staticmethod
+    def on_uncounted(mapper, connection, target):
+        AtMe.on_counted(mapper, connection, target, n=-1)
+
+db.event.listen(AtMe, 'after_insert', AtMe.on_counted)
+db.event.listen(AtMe, 'after_delete', AtMe.on_uncounted)
 
+
+# per user, when each "new since last click" page was last opened and how
+# much has arrived for it since: the writes below bump unread_* and
+# mark_read() clears them when the page is viewed.  Unread class discussion
+# is kept on each Student row, since it is read one class at a time.
 class ClickTime(db.Model):
     __tablename__ = 'clicktimes'
     __table_args__ = {"useexisting": True}
@@ -926,6 +1501,271 @@ class ClickTime(db.Model):
     current_lesson_show_lesson_seat = db.Column(db.DateTime)
     current_lesson_show_lesson_discussion = db.Column(db.DateTime)
 
+    unread_comments_on_me = db.Column(db.Integer, default=0,
+                                      server_default='0')
+    unread_followed_by = db.Column(db.Integer, default=0, server_default='0')
+    unread_atme = db.Column(db.Integer, default=0, server_default='0')
+
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # one row per user, created along with the user (see on_registered)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True,
+                        unique=True)
+
+    # notification category -> column holding its last click
+    CATEGORIES = {
+        'comments_on_me': 'user_comments_on_me',
+        'followed_by': 'user_followed_by',
+        'atme': 'user_show_my_atme',
+    }
+
+    @staticmethod
+    def notify(connection, user_ids, category, n=1):
+        user_ids = set(user_id for user_id in user_ids if user_id is not None)
+        if not user_ids:
+            return
+        clicktimes = ClickTime.__table__
+        column = clicktimes.c['unread_' + category]
+        connection.execute(clicktimes.update().
+                           where(clicktimes.c.user_id.in_(user_ids)).
+                           values({column: column + n}))
+
+    # the row exists before any notification, so notify() never has to
+    # insert one and two concurrent first notifications cannot race
+    @staticmethod
+    def on_registered(mapper, connection, target):
+        connection.execute(ClickTime.__table__.insert().values(
+            user_id=target.id))
+
+    @staticmethod
+    def on_commented(mapper, connection, target):
+        posts = Post.__table__
+        author_id = connection.execute(
+            db.select([posts.c.author_id]).
+            where(posts.c.id == target.post_id)).scalar()
+        if author_id != target.author_id:
+            ClickTime.notify(connection, [author_id], 'comments_on_me')
+
+    @staticmethod
+    def on_followed(mapper, connection, target):
+        # everyone follows themselves from registration on
+        if target.follower_id != target.followed_id:
+            ClickTime.notify(connection, [target.followed_id], 'followed_by')
+
+    @staticmethod
+    def on_mentioned(mapper, connection, target):
+        users = User.__table__
+        ClickTime.notify(connection, [row[0] for row in connection.execute(
+            db.select([users.c.id]).
+            where(users.c.username == target.username).
+            where(users.c.username != target.username_whoatme))], 'atme')
+
+    @staticmethod
+    def discussed(connection, newlesson_id, author_id, n=1):
+        if newlesson_id is None:
+            return
+        students = Student.__table__
+        unread = students.c.unread_discussion
+        if n > 0:
+            value = unread + n
+        else:
+            # a post may go after it was read; never below zero
+            value = db.case([(unread > -n, unread + n)], else_=0)
+        connection.execute(students.update().where(db.and_(
+            students.c.newlesson_id == newlesson_id,
+            students.c.student_id != author_id)).values(
+            unread_discussion=value))
+
+    @staticmethod
+    def on_discussed(mapper, connection, target):
+        ClickTime.discussed(connection, target.newlesson_id, target.author_id)
+
+    @staticmethod
+    def on_undiscussed(mapper, connection, target):
+        ClickTime.discussed(connection, target.newlesson_id, target.author_id,
+                            n=-1)
+
+    @staticmethod
+    def on_rediscussed(mapper, connection, target):
+        # a tag change moves the post into or out of a class
+        history = db.inspect(target).attrs.newlesson_id.history
+        if history.has_changes():
+            for newlesson_id in history.deleted:
+                ClickTime.discussed(connection, newlesson_id,
+                                    target.author_id, n=-1)
+            ClickTime.on_discussed(mapper, connection, target)
+
+    @staticmethod
+    def mark_read(user_id, category):
+        clicktimes = ClickTime.__table__
+        column = clicktimes.c['unread_' + category]
+        # a no-op, not a write, when there was nothing to clear
+        db.session.execute(clicktimes.update().where(db.and_(
+            clicktimes.c.user_id == user_id, column != 0)).values({
+                column: 0,
+                clicktimes.c[ClickTime.CATEGORIES[category]]:
+                    datetime.utcnow()}))
+
+    @staticmethod
+    def mark_discussion_read(user_id, newlesson_id):
+        students = Student.__table__
+        result = db.session.execute(students.update().where(db.and_(
+            students.c.student_id == user_id,
+            students.c.newlesson_id == newlesson_id,
+            students.c.unread_discussion != 0)).values(unread_discussion=0))
+        if result.rowcount:
+            clicktimes = ClickTime.__table__
+            db.session.execute(clicktimes.update().
+                               where(clicktimes.c.user_id == user_id).
+                               values(current_lesson_show_lesson_discussion=
+                                      datetime.utcnow()))
+
+    @staticmethod
+    def unread(user_id):
+        row = db.session.query(ClickTime.unread_comments_on_me,
+                               ClickTime.unread_followed_by,
+                               ClickTime.unread_atme).\
+            filter(ClickTime.user_id == user_id).first()
+        counts = dict(zip(('comments_on_me', 'followed_by', 'atme'),
+                          row or (0, 0, 0)))
+        counts['lesson_discussion'] = db.session.query(
+            db.func.coalesce(db.func.sum(Student.unread_discussion), 0)).\
+            filter(Student.student_id == user_id).scalar()
+        counts['total'] = sum(counts.values())
+        return counts
+
+db.event.listen(User, 'after_insert', ClickTime.on_registered)
+db.event.listen(Comment, 'after_insert', ClickTime.on_commented)
+db.event.listen(Follow, 'after_insert', ClickTime.on_followed)
+db.event.listen(AtMe, 'after_insert', ClickTime.on_mentioned)
+db.event.listen(Post, 'after_insert', ClickTime.on_discussed)
+db.event.listen(Post, 'after_delete', ClickTime.on_undiscussed)
+db.event.listen(Post, 'after_update', ClickTime.on_rediscussed)
+
+
+# one row per distinct upload in the content-addressed store (app/store.py);
+# refcount is the number of UPLOAD_COLUMNS pointing at it
+class Blob(db.Model):
+    __tablename__ = 'blobs'
+    __table_args__ = {"useexisting": True}
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, index=True)
+    path = db.Column(db.String(64), unique=True)
+    size = db.Column(db.BigInteger)
+    refcount = db.Column(db.Integer, default=0, server_default='0')
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    @staticmethod
+    def update_refcounts(connection, urls, n):
+        prefix = current_app.static_url_path + '/'
+        blobs = Blob.__table__
+        for url in urls:
+            if url and url.startswith(prefix + 'store/'):
+                update_counters(connection, blobs,
+                                blobs.c.path == url[len(prefix):], refcount=n)
+
+    @staticmethod
+    def on_counted(mapper, connection, target, n=1):
+        Blob.update_refcounts(connection, [
+            getattr(target, name) for name in UPLOAD_COLUMNS[type(target)]], n)
+
+    @staticmethod
+    def on_uncounted(mapper, connection, target):
+        Blob.on_counted(mapper, connection, target, n=-1)
+
+    @staticmethod
+    def on_recounted(mapper, connection, target):
+        state = db.inspect(target)
+        for name in UPLOAD_COLUMNS[type(target)]:
+            history = state.attrs[name].history
+            if history.has_changes():
+                Blob.update_refcounts(connection, history.deleted, -1)
+                Blob.update_refcounts(connection, history.added, 1)
+
+
+
+# a chunked upload in progress (api_1_0/uploads.py); the bytes received so
+# far are appended to a file in FLASKY_UPLOAD_DIR, whose length is the
+# offset a client resumes from
+class Upload(db.Model):
+    __tablename__ = 'uploads'
+    __table_args__ = {"useexisting": True}
+    id = db.Column(db.String(32), primary_key=True)
+    filename = db.Column(db.String(64))
+    size = db.Column(db.BigInteger)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+
+    @property
+    def path(self):
+        directory = current_app.config['FLASKY_UPLOAD_DIR'] or \
+            os.path.join(current_app.instance_path, 'uploads')
+        return os.path.join(directory, self.id)
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def to_json(self):
+        json_upload = {
+            'url': url_for('api.get_upload', id=self.id, _external=True),
+            'filename': self.filename,
+            'size': self.size,
+            'offset': self.offset,
+            'expires': self.timestamp + timedelta(
+                seconds=current_app.config['FLASKY_UPLOAD_EXPIRY']),
+        }
+        return json_upload
+
+
+# a message waiting to be sent by app/email.py; rows are deleted once the
+# SMTP server has accepted them, and next_attempt is cleared when a message
+# is given up on
+class OutboxMessage(db.Model):
+    __tablename__ = 'outbox'
+    __table_args__ = {"useexisting": True}
+    id = db.Column(db.Integer, primary_key=True)
+    sender = db.Column(db.String(128))
+    recipient = db.Column(db.String(128))
+    subject = db.Column(db.String(256))
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0, server_default='0')
+    next_attempt = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    last_error = db.Column(db.String(256))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# the inverted index app/search.py uses when the database has no full-text
+# search; doc is search.doc_key() and weight the number of times the term
+# occurs in it, words in a title counting more
+class SearchTerm(db.Model):
+    __tablename__ = 'search_terms'
+    __table_args__ = (
+        db.Index('ix_search_terms_doc', 'doc'),
+        {"useexisting": True})
+    term = db.Column(db.String(64), primary_key=True)
+    doc = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    weight = db.Column(db.Integer)
+
+
+# every column that holds the URL of an uploaded file; copying a URL to
+# another row or overwriting it keeps Blob.refcount right
+UPLOAD_COLUMNS = {
+    Post: ('pic', 'pic1', 'pic2', 'pic3',
+           'file1', 'file2', 'file3', 'file4', 'file5'),
+    Lesson: ('pic', 'file1', 'file2', 'file3', 'file4',
+             'file5', 'file6', 'file7', 'file8'),
+    LessonFile: ('file',),
+    Student: ('file1', 'file2', 'file3', 'file4', 'file5'),
+    Teacher: ('pic',),
+}
+
+for model in UPLOAD_COLUMNS:
+    db.event.listen(model, 'after_insert', Blob.on_counted)
+    db.event.listen(model, 'after_delete', Blob.on_uncounted)
+    db.event.listen(model, 'after_update', Blob.on_recounted)
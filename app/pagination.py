@@ -0,0 +1,94 @@
+import base64
+import json
+from datetime import datetime
+from . import db
+
+
+# Keyset ("seek") pagination: instead of OFFSET-ing into a sorted list, each
+# page starts right after the (timestamp, id) key of the last row shown, so
+# every page is one index range scan no matter how deep it is.  Cursors are
+# opaque strings handed to the client; the total is only counted on demand.
+class KeysetPagination(object):
+    def __init__(self, query, columns, cursor=None, per_page=20, key=None):
+        self.query = query
+        self.columns = columns
+        self.per_page = per_page
+        self.key = key or (lambda item: tuple(getattr(item, column.key)
+                                              for column in columns))
+        direction, values = self.decode(cursor)
+        backwards = direction == 'prev'
+        if values is not None:
+            query = query.filter(self.seek(values, backwards))
+        if backwards:
+            order = [column.asc() for column in columns]
+        else:
+            order = [column.desc() for column in columns]
+        items = query.order_by(None).order_by(*order).limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+            self.has_prev = more
+            self.has_next = bool(items)
+        else:
+            self.has_prev = values is not None and bool(items)
+            self.has_next = more
+        self.items = items
+        self.prev_cursor = None
+        self.next_cursor = None
+        if self.has_prev:
+            self.prev_cursor = self.encode('prev', self.key(items[0]))
+        if self.has_next:
+            self.next_cursor = self.encode('next', self.key(items[-1]))
+        self._total = None
+
+    @property
+    def total(self):
+        if self._total is None:
+            self._total = self.query.order_by(None).count()
+        return self._total
+
+    def seek(self, values, backwards):
+        # (c1, c2) < (v1, v2) spelled out as c1 < v1 OR (c1 = v1 AND c2 < v2)
+        clauses = []
+        for i, column in enumerate(self.columns):
+            if backwards:
+                clause = column > values[i]
+            else:
+                clause = column < values[i]
+            for previous, value in zip(self.columns[:i], values[:i]):
+                clause = db.and_(previous == value, clause)
+            clauses.append(clause)
+        return db.or_(*clauses)
+
+    def encode(self, direction, values):
+        values = [value.isoformat() if isinstance(value, datetime) else value
+                  for value in values]
+        return base64.urlsafe_b64encode(json.dumps(
+            [direction] + values).encode('utf-8')).decode('ascii')
+
+    def decode(self, cursor):
+        if not cursor:
+            return None, None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(
+                cursor.encode('ascii')).decode('utf-8'))
+            direction, values = data[0], data[1:]
+            if direction not in ('prev', 'next') or \
+                    len(values) != len(self.columns):
+                raise ValueError(cursor)
+            for i, column in enumerate(self.columns):
+                if isinstance(column.type, db.DateTime):
+                    values[i] = parse_datetime(values[i])
+            return direction, values
+        except (ValueError, TypeError, IndexError, UnicodeError):
+            return None, None
+
+
+def parse_datetime(value):
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError(value)
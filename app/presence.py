@@ -0,0 +1,87 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from . import db
+from .models import User, Post, Comment
+
+
+# Recording last_seen on every request turned each page view into an UPDATE
+# and COMMIT on users, which SQLite serializes across workers.  The tracker
+# keeps the latest visit per user in process and writes them all in one
+# batched UPDATE every FLASKY_LAST_SEEN_FLUSH_INTERVAL seconds.  Visits
+# within FLASKY_LAST_SEEN_THRESHOLD seconds of the stored value are ignored.
+# The UPDATE runs in a short transaction of its own, so a failing request
+# cannot roll it back and a failed flush puts its visits back for the next
+# one; whatever is still pending when the worker exits is flushed then.
+class LastSeenTracker(object):
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flushed_at = time.time()
+        self.app = None
+
+    def touch(self, user, now=None):
+        now = now or datetime.utcnow()
+        threshold = timedelta(
+            seconds=current_app.config['FLASKY_LAST_SEEN_THRESHOLD'])
+        with self.lock:
+            seen = self.pending.get(user.id, user.last_seen)
+            if seen is not None and now - seen < threshold:
+                return False
+            self.pending[user.id] = now
+            # test apps have dropped their tables by the time they exit
+            if self.app is None and not current_app.testing:
+                self.app = current_app._get_current_object()
+                atexit.register(self.flush_at_exit)
+            return True
+
+    def due(self):
+        return time.time() - self.flushed_at >= \
+            current_app.config['FLASKY_LAST_SEEN_FLUSH_INTERVAL']
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.time()
+        if not pending:
+            return 0
+        users = User.__table__
+        posts = Post.__table__
+        comments = Comment.__table__
+        seen = db.bindparam('seen')
+        # a visit clears the unread comment badge; recounting keeps
+        # comments that arrived after the visit but before the flush
+        unread = db.select([db.func.count()]).\
+            select_from(comments.join(posts, posts.c.id == comments.c.post_id)).\
+            where(posts.c.author_id == users.c.id).\
+            where(comments.c.timestamp > seen).as_scalar()
+        stmt = users.update().\
+            where(users.c.id == db.bindparam('user_id')).\
+            where(db.or_(users.c.last_seen == None, users.c.last_seen < seen)).\
+            values(last_seen=seen, commented_new_count=unread)
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(stmt, [
+                    {'user_id': user_id, 'seen': value}
+                    for user_id, value in pending.items()])
+        except Exception:
+            current_app.logger.exception('Cannot record last_seen')
+            self.requeue(pending)
+            return 0
+        return len(pending)
+
+    def requeue(self, pending):
+        with self.lock:
+            for user_id, value in pending.items():
+                # a visit recorded since the failed flush is newer; keep it
+                if self.pending.get(user_id, value) <= value:
+                    self.pending[user_id] = value
+
+    def flush_at_exit(self):
+        with self.app.app_context():
+            self.flush()
+
+
+last_seen = LastSeenTracker()
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from markdown import markdown
+import bleach
+from flask import current_app, g
+
+
+# Every rich-text field (posts, comments, letters, lesson/teacher/student
+# descriptions) is rendered the same way: Markdown, then bleach with one
+# shared whitelist, then linkify.  Rendered HTML is cached by a hash of the
+# source text and POLICY_VERSION, first in a small in-process LRU and then
+# on disk, so edits, API writes and generate_fake that repeat text already
+# seen skip the whole pipeline.  Bump POLICY_VERSION whenever ALLOWED_TAGS
+# or the pipeline changes so stale HTML is never served.
+
+POLICY_VERSION = '1'
+
+ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+                'h1', 'h2', 'h3','h4', 'p','br','u','del','tt','cite',
+                'font','big','small','strike','sup','sub','span','img','kdb']
+
+
+class LRUCache(object):
+    def __init__(self, size_setting):
+        self.size_setting = size_setting
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        size = current_app.config[self.size_setting]
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RenderCache(LRUCache):
+    def get(self, key):
+        html = LRUCache.get(self, key)
+        if html is None:
+            html = self.load(key)
+            if html is not None:
+                LRUCache.set(self, key, html)
+        return html
+
+    def set(self, key, html):
+        LRUCache.set(self, key, html)
+        self.store(key, html)
+
+    def path(self, key):
+        directory = current_app.config['FLASKY_RENDER_CACHE_DIR']
+        if not directory:
+            return None
+        return os.path.join(directory, key[:2], key + '.html')
+
+    def load(self, key):
+        path = self.path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+
+    def store(self, key, html):
+        path = self.path(key)
+        if path is None:
+            return
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # write then rename so readers never see a half-written file
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(html.encode('utf-8'))
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            current_app.logger.warning('Cannot write render cache %s' % path)
+
+
+cache = RenderCache('FLASKY_RENDER_CACHE_SIZE')
+
+
+def render_key(text):
+    return hashlib.sha256(
+        (POLICY_VERSION + '\0' + text).encode('utf-8')).hexdigest()
+
+
+def render_markdown(text):
+    if text is None:
+        return None
+    key = render_key(text)
+    html = cache.get(key)
+    if html is None:
+        html = bleach.linkify(bleach.clean(
+            markdown(text, output_format='html'),
+            tags=ALLOWED_TAGS, strip=True))
+        cache.set(key, html)
+    return html
+
+
+# Rendered template fragments, e.g. the post cards in _posts.html.  Callers
+# put every value the fragment depends on into the key (post.version is
+# bumped by model events), so entries never need explicit eviction.
+fragments = LRUCache('FLASKY_FRAGMENT_CACHE_SIZE')
+
+
+def cached_fragment(*key, **kwargs):
+    caller = kwargs['caller']
+    html = fragments.get(key)
+    if html is None:
+        # helpers rendering a temporary fallback (see images.image_url) set
+        # g.fragment_volatile to keep this rendering out of the cache
+        outer = g.get('fragment_volatile', False)
+        g.fragment_volatile = False
+        html = caller()
+        if not g.fragment_volatile:
+            fragments.set(key, html)
+        g.fragment_volatile = outer or g.fragment_volatile
+    return html
@@ -0,0 +1,277 @@
+import re
+from collections import Counter, OrderedDict, namedtuple
+from flask import url_for
+from flask_sqlalchemy import Pagination
+from . import db
+from .models import Post, Comment, Lesson, Teacher, User, SearchTerm
+
+
+# Search over posts, comments, lessons, teachers and users.
+#
+# Text is cut into terms before it reaches the database: runs of letters and
+# digits become lower-case words, runs of CJK characters become overlapping
+# bigrams ("上课时间" -> 上课 课时 时间), which finds Chinese words without a
+# dictionary.  A query is cut the same way and matches the documents that
+# contain all of its terms.
+#
+# On SQLite with FTS5 the terms go into the search_index virtual table and
+# results are ranked by bm25(), a title (topic, lesson name, school, name)
+# weighing TITLE_WEIGHT times the body.  Other databases use search_terms, a
+# plain inverted index with one row per term and document, ranked by the sum
+# over the query terms of weight / number of documents with the term.
+#
+# Each document is one row keyed by doc_key(kind, id), replaced by model
+# events whenever its text changes.  Private posts, disabled comments and
+# comments on private posts are left out; a post's comments are indexed
+# again when it changes privacy.  rebuild() indexes everything again after
+# a bulk load.
+
+KINDS = ('post', 'comment', 'lesson', 'teacher', 'user')
+MODELS = OrderedDict([('post', Post), ('comment', Comment),
+                      ('lesson', Lesson), ('teacher', Teacher),
+                      ('user', User)])
+KIND = dict((model, kind) for kind, model in MODELS.items())
+# (title columns, body columns) and what hides a row from search
+FIELDS = {
+    Post: (('topic',), ('body',)),
+    Comment: ((), ('body',)),
+    Lesson: (('lesson_name',), ('about_lesson',)),
+    Teacher: (('school', 'field'), ()),
+    User: (('name', 'username'), ()),
+}
+HIDDEN = {
+    Post: 'private',
+    Comment: 'disabled',
+}
+TITLE_WEIGHT = 10
+MAX_TERM_LENGTH = 64
+SNIPPET_LENGTH = 120
+
+CJK = u'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+TERM = re.compile(u'([%s]+)|([^\\W_%s]+)' % (CJK, CJK), re.UNICODE)
+
+Hit = namedtuple('Hit', 'kind item title text url')
+
+fts5 = {}
+
+
+def terms(text):
+    for cjk, word in TERM.findall((text or '').lower()):
+        if word:
+            yield word[:MAX_TERM_LENGTH]
+        elif len(cjk) == 1:
+            yield cjk
+        else:
+            for i in range(len(cjk) - 1):
+                yield cjk[i:i + 2]
+
+
+def query_terms(q):
+    return list(OrderedDict.fromkeys(terms(q)))
+
+
+def doc_key(kind, id):
+    return id * 8 + KINDS.index(kind)
+
+
+def has_fts5(connection):
+    url = str(connection.engine.url)
+    if url not in fts5:
+        fts5[url] = connection.dialect.name == 'sqlite' and any(
+            row[0] == 'ENABLE_FTS5'
+            for row in connection.execute('PRAGMA compile_options'))
+    return fts5[url]
+
+
+db.event.listen(db.metadata, 'after_create', db.DDL(
+    'CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(title, body)'
+).execute_if(callable_=lambda ddl, target, bind, **kw: has_fts5(bind)))
+db.event.listen(db.metadata, 'before_drop', db.DDL(
+    'DROP TABLE IF EXISTS search_index'
+).execute_if(callable_=lambda ddl, target, bind, **kw: has_fts5(bind)))
+
+
+def post_is_private(connection, post_id):
+    posts = Post.__table__
+    return bool(connection.execute(db.select([posts.c.private]).where(
+        posts.c.id == post_id)).scalar())
+
+
+def document(connection, target):
+    hidden = HIDDEN.get(type(target))
+    if hidden is not None and getattr(target, hidden):
+        return None
+    if type(target) is Comment and post_is_private(connection, target.post_id):
+        return None
+    title, body = FIELDS[type(target)]
+    return (' '.join(terms(' '.join(getattr(target, c) or '' for c in title))),
+            ' '.join(terms(' '.join(getattr(target, c) or '' for c in body))))
+
+
+def write(connection, key, doc):
+    if has_fts5(connection):
+        connection.execute(db.text(
+            'DELETE FROM search_index WHERE rowid = :key'), key=key)
+        if doc is not None:
+            connection.execute(db.text(
+                'INSERT INTO search_index (rowid, title, body) '
+                'VALUES (:key, :title, :body)'),
+                key=key, title=doc[0], body=doc[1])
+        return
+    table = SearchTerm.__table__
+    connection.execute(table.delete().where(table.c.doc == key))
+    if doc is not None:
+        weights = Counter()
+        for term in doc[0].split():
+            weights[term] += TITLE_WEIGHT
+        for term in doc[1].split():
+            weights[term] += 1
+        if weights:
+            connection.execute(table.insert(), [
+                {'term': term, 'doc': key, 'weight': weight}
+                for term, weight in weights.items()])
+
+
+def on_inserted(mapper, connection, target):
+    write(connection, doc_key(KIND[type(target)], target.id),
+          document(connection, target))
+
+
+def write_comments(connection, post):
+    comments = Comment.__table__
+    for row in connection.execute(db.select(
+            [comments.c.id, comments.c.body, comments.c.disabled]).where(
+            comments.c.post_id == post.id)):
+        doc = None
+        if not post.private and not row.disabled:
+            doc = ('', ' '.join(terms(row.body)))
+        write(connection, doc_key('comment', row.id), doc)
+
+
+def on_deleted(mapper, connection, target):
+    write(connection, doc_key(KIND[type(target)], target.id), None)
+
+
+def on_updated(mapper, connection, target):
+    title, body = FIELDS[type(target)]
+    columns = title + body + ((HIDDEN[type(target)],)
+                              if type(target) in HIDDEN else ())
+    state = db.inspect(target)
+    if any(state.attrs[c].history.has_changes() for c in columns):
+        on_inserted(mapper, connection, target)
+    if type(target) is Post and state.attrs.private.history.has_changes():
+        write_comments(connection, target)
+
+
+for model in MODELS.values():
+    db.event.listen(model, 'after_insert', on_inserted)
+    db.event.listen(model, 'after_update', on_updated)
+    db.event.listen(model, 'after_delete', on_deleted)
+
+
+def rebuild(chunk=1000):
+    connection = db.session.connection()
+    if has_fts5(connection):
+        connection.execute(db.text('DELETE FROM search_index'))
+    else:
+        connection.execute(SearchTerm.__table__.delete())
+    n = 0
+    for kind, model in MODELS.items():
+        for row in model.query.order_by(model.id).yield_per(chunk):
+            write(connection, doc_key(kind, row.id),
+                  document(connection, row))
+            n += 1
+    db.session.commit()
+    return n
+
+
+def ranked_keys(connection, words, kind, offset, limit):
+    if has_fts5(connection):
+        match = ' '.join('"%s"' % w.replace('"', '""') for w in words)
+        where = 'search_index MATCH :match'
+        params = {'match': match}
+        if kind is not None:
+            where += ' AND rowid % 8 = :code'
+            params['code'] = KINDS.index(kind)
+        total = connection.execute(db.text(
+            'SELECT count(*) FROM search_index WHERE ' + where),
+            **params).scalar()
+        keys = [row[0] for row in connection.execute(db.text(
+            'SELECT rowid FROM search_index WHERE ' + where +
+            ' ORDER BY bm25(search_index, %d, 1), rowid DESC'
+            ' LIMIT :limit OFFSET :offset' % TITLE_WEIGHT),
+            limit=limit, offset=offset, **params)]
+        return keys, total
+    documents = dict(db.session.query(
+        SearchTerm.term, db.func.count(SearchTerm.doc)).filter(
+        SearchTerm.term.in_(words)).group_by(SearchTerm.term))
+    if len(documents) < len(words):
+        return [], 0
+    score = db.func.sum(SearchTerm.weight * db.case(
+        [(SearchTerm.term == w, 1.0 / n) for w, n in documents.items()]))
+    query = db.session.query(SearchTerm.doc).filter(
+        SearchTerm.term.in_(words))
+    if kind is not None:
+        query = query.filter(SearchTerm.doc.op('%')(8) == KINDS.index(kind))
+    query = query.group_by(SearchTerm.doc).having(
+        db.func.count(SearchTerm.term) == len(words))
+    total = query.count()
+    keys = [row[0] for row in query.order_by(
+        score.desc(), SearchTerm.doc.desc()).offset(offset).limit(limit)]
+    return keys, total
+
+
+def snippet(text, words):
+    text = ' '.join((text or '').split())
+    lower = text.lower()
+    found = [i for i in (lower.find(w) for w in words) if i >= 0]
+    start = max(0, min(found or [0]) - SNIPPET_LENGTH // 4)
+    end = start + SNIPPET_LENGTH
+    return (u'…' if start else '') + text[start:end] + \
+        (u'…' if end < len(text) else '')
+
+
+def hit(kind, item, words, external=False):
+    if kind == 'post':
+        return Hit(kind, item, item.topic or snippet(item.body, [])[:40],
+                   snippet(item.body, words),
+                   url_for('main.post', id=item.id, _external=external))
+    if kind == 'comment':
+        return Hit(kind, item, item.author.username if item.author else '',
+                   snippet(item.body, words),
+                   url_for('main.post', id=item.post_id, _anchor='comments',
+                           _external=external))
+    if kind == 'lesson':
+        return Hit(kind, item, item.lesson_name,
+                   snippet(item.about_lesson, words),
+                   url_for('main.lesson', id=item.id, _external=external))
+    if kind == 'teacher':
+        return Hit(kind, item, item.school, item.field or '',
+                   url_for('main.teacher', id=item.id, _external=external))
+    return Hit(kind, item, item.name or item.username, item.username,
+               url_for('main.user', username=item.username,
+                       _external=external))
+
+
+def search(q, kind=None, page=1, per_page=20, external=False):
+    words = query_terms(q)
+    if kind not in MODELS:
+        kind = None
+    page = max(page, 1)
+    if not words:
+        return Pagination(None, page, per_page, 0, [])
+    keys, total = ranked_keys(db.session.connection(), words, kind,
+                              (page - 1) * per_page, per_page)
+    ids = {}
+    for key in keys:
+        ids.setdefault(KINDS[key % 8], []).append(key // 8)
+    rows = {}
+    for k, model_ids in ids.items():
+        query = MODELS[k].query.filter(MODELS[k].id.in_(model_ids))
+        if k in ('post', 'comment'):
+            query = query.options(db.joinedload(MODELS[k].author))
+        for row in query:
+            rows[doc_key(k, row.id)] = row
+    items = [hit(KINDS[key % 8], rows[key], words, external)
+             for key in keys if key in rows]
+    return Pagination(None, page, per_page, total, items)
@@ -0,0 +1,53 @@
+// @mention autocomplete for the comment box: typing "@pre" lists the users
+// whose name starts with "pre" (main.mention_suggestions); picking one
+// completes the name.
+(function ($) {
+    var box = $('textarea[name=body]');
+    var url = $('script[data-mention-url]').data('mention-url');
+    if (!box.length || !url) {
+        return;
+    }
+    var menu = $('<ul class="dropdown-menu"></ul>').insertAfter(box);
+    var pending = null;
+
+    function typed() {
+        var before = box.val().slice(0, box[0].selectionStart);
+        var match = /(^|[^\w.@])@([一-龥A-Za-z0-9_.]+)$/.exec(before);
+        return match ? match[2] : null;
+    }
+
+    box.parent().css('position', 'relative');
+    box.on('keyup click', function () {
+        var prefix = typed();
+        if (pending) {
+            pending.abort();
+        }
+        if (!prefix) {
+            menu.hide();
+            return;
+        }
+        pending = $.getJSON(url, {q: prefix}, function (data) {
+            menu.empty();
+            $.each(data.users, function (i, user) {
+                $('<li><a href="#"></a></li>').appendTo(menu).find('a')
+                    .text(user.username + (user.name ? ' (' + user.name + ')' : ''))
+                    .data('username', user.username);
+            });
+            menu.toggle(data.users.length > 0);
+        });
+    });
+    menu.on('mousedown', 'a', function (event) {
+        event.preventDefault();
+        var caret = box[0].selectionStart;
+        var text = box.val();
+        var start = caret - typed().length;
+        var name = $(this).data('username') + ' ';
+        box.val(text.slice(0, start) + name + text.slice(caret));
+        box[0].selectionStart = box[0].selectionEnd = start + name.length;
+        menu.hide();
+        box.focus();
+    });
+    box.on('blur', function () {
+        menu.hide();
+    });
+})(jQuery);
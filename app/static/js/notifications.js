@@ -0,0 +1,21 @@
+// Unread notification count on the navbar badge (main.notifications),
+// polled once a minute while the page is visible; the server answers 304
+// as long as nothing new has arrived.
+(function ($) {
+    var badge = $('#notification-badge');
+    if (!badge.length) {
+        return;
+    }
+
+    function poll() {
+        if (document.hidden) {
+            return;
+        }
+        $.getJSON(badge.data('url'), function (counts) {
+            badge.text(counts.total || '');
+        });
+    }
+
+    poll();
+    setInterval(poll, 60000);
+})(jQuery);
@@ -0,0 +1,49 @@
+// Seat map on the current lesson page, refreshed from
+// main.current_lesson_seats every 30 seconds while the page is visible, so
+// seats taken and absences marked by others show up without reloading the
+// whole page.  The teacher's table lists the rows and columns back to
+// front (facing the class), the students' table front to back.
+(function ($) {
+    var tables = $('table.seat-map');
+    if (!tables.length) {
+        return;
+    }
+
+    function label(value) {
+        return value === null || value === undefined ? '' : value;
+    }
+
+    function update(table, data) {
+        var cells = [];
+        $.each(data.grid, function (i, row) {
+            cells = cells.concat(row);
+        });
+        if (table.data('reversed')) {
+            cells.reverse();
+        }
+        var buttons = table.find('input[data-occupant]');
+        if (buttons.length !== cells.length) {
+            return;
+        }
+        buttons.each(function (i) {
+            var cell = cells[i];
+            var occupant = cell.username ? label(cell.name) : cell.seat;
+            $(this).attr('data-occupant', occupant);
+            $(this).val(label(cell.absence) + table.data('separator') +
+                        occupant);
+        });
+    }
+
+    function poll() {
+        if (document.hidden) {
+            return;
+        }
+        $.getJSON(tables.first().data('url'), function (data) {
+            tables.each(function () {
+                update($(this), data);
+            });
+        });
+    }
+
+    setInterval(poll, 30000);
+})(jQuery);
@@ -0,0 +1,188 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from flask import current_app, url_for
+from . import db, images
+from .models import Blob, Upload, UPLOAD_COLUMNS
+
+
+# Uploaded files live in one content-addressed store instead of a fresh
+# email__<time>.<ext> copy per upload:
+#
+#   static/store/3f/3f9a...c1.pdf
+#
+# put() hashes the upload while streaming it to a temporary file, then
+# either renames it into place or, if a blob with that SHA-256 already
+# exists, throws it away.  Blob.refcount is kept by model events on every
+# column that holds an upload URL (models.UPLOAD_COLUMNS), and collect()
+# deletes blobs nothing points at any more, so the same lecture PDF
+# attached to forty classes is stored once.
+# A blob never changes once written: the resized copies of pictures are
+# separate files next to it (app/images.py).  dedupe() moves uploads saved
+# before the store into it.
+
+FOLDER = 'store'
+CHUNK_SIZE = 64 * 1024
+# keeps /static/store/xx/<name>.<ext> inside the 64 character URL columns
+NAME_LENGTH = 40
+# unreferenced blobs younger than this may belong to a request in flight
+COLLECT_AFTER = timedelta(hours=1)
+PICTURE_COLUMNS = ('pic', 'pic1', 'pic2', 'pic3')
+
+
+def extension(filename):
+    ext = os.path.splitext(filename or '')[1].lower()
+    if 1 < len(ext) <= 7 and ext[1:].isalnum():
+        return ext
+    return ''
+
+
+def blob_url(blob):
+    return url_for('static', filename=blob.path)
+
+
+def blob_path(blob):
+    return os.path.join(current_app.static_folder, blob.path)
+
+
+def digest_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# takes over the file at path: it becomes the blob or, when the content is
+# already stored, is deleted
+def add(path, sha256, size, filename):
+    blob = Blob.query.filter_by(sha256=sha256).first()
+    if blob is not None:
+        os.remove(path)
+        blob.timestamp = datetime.utcnow()
+        db.session.add(blob)
+        return blob, False
+    blob = Blob(sha256=sha256, size=size, refcount=0,
+                path='%s/%s/%s%s' % (FOLDER, sha256[:2], sha256[:NAME_LENGTH],
+                                     extension(filename)))
+    target = blob_path(blob)
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    shutil.move(path, target)
+    # the row must exist before the model events count references to it
+    db.session.add(blob)
+    db.session.flush([blob])
+    return blob, True
+
+
+def put(stream, filename):
+    folder = os.path.join(current_app.static_folder, FOLDER)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except Exception:
+        os.remove(tmp)
+        raise
+    return add(tmp, digest.hexdigest(), size, filename)
+
+
+def put_file(path, filename):
+    return add(path, digest_file(path), os.path.getsize(path), filename)
+
+
+def save_file(file):
+    blob, created = put(file.stream, file.filename)
+    return blob_url(blob)
+
+
+def static_path(url):
+    prefix = current_app.static_url_path + '/'
+    if not url or not url.startswith(prefix):
+        return None
+    return url[len(prefix):]
+
+
+# called before a column holding url is overwritten or its row deleted;
+# blobs are released by the model events, but a file saved before the store
+# belonged to that row alone
+def release(url):
+    path = static_path(url)
+    if path is not None and not path.startswith(FOLDER + '/'):
+        images.remove(os.path.join(current_app.static_folder, path))
+
+
+def collect():
+    n = 0
+    for blob in Blob.query.filter(
+            Blob.refcount <= 0,
+            Blob.timestamp < datetime.utcnow() - COLLECT_AFTER):
+        images.remove(blob_path(blob))
+        db.session.delete(blob)
+        n += 1
+    return n
+
+
+# chunked uploads (api_1_0/uploads.py) nobody has touched for a while
+def expire_uploads():
+    expiry = timedelta(seconds=current_app.config['FLASKY_UPLOAD_EXPIRY'])
+    n = 0
+    for upload in Upload.query.filter(
+            Upload.timestamp < datetime.utcnow() - expiry):
+        try:
+            os.remove(upload.path)
+        except OSError:
+            pass
+        db.session.delete(upload)
+        n += 1
+    return n
+
+
+def dedupe():
+    config = current_app.config
+    stats = {'files': 0, 'blobs': 0, 'bytes_saved': 0}
+    moved = set()
+    for model, columns in UPLOAD_COLUMNS.items():
+        for row in model.query.all():
+            for column in columns:
+                path = static_path(getattr(row, column))
+                if path is None or path.startswith(FOLDER + '/'):
+                    continue
+                path = os.path.join(current_app.static_folder, path)
+                if not os.path.isfile(path):
+                    continue
+                with open(path, 'rb') as f:
+                    blob, created = put(f, path)
+                setattr(row, column, blob_url(blob))
+                if column in PICTURE_COLUMNS and \
+                        not images.processed(blob_path(blob)):
+                    images.process(blob_path(blob),
+                                   config['FLASKY_IMAGE_WEBP'],
+                                   config['FLASKY_IMAGE_QUALITY'],
+                                   current_app.logger)
+                if path not in moved:
+                    moved.add(path)
+                    stats['files'] += 1
+                    if created:
+                        stats['blobs'] += 1
+                    else:
+                        stats['bytes_saved'] += blob.size
+    db.session.commit()
+    for path in moved:
+        images.remove(path)
+    return stats
@@ -19,7 +19,39 @@ class Config:
     FLASKY_POSTS_PER_PAGE = 20
     FLASKY_FOLLOWERS_PER_PAGE = 50
     FLASKY_COMMENTS_PER_PAGE = 30
+    FLASKY_SEARCH_RESULTS_PER_PAGE = 20
     FLASKY_SLOW_DB_QUERY_TIME = 0.5
+    FLASKY_TIMELINE_LENGTH = 1000
+    FLASKY_RENDER_CACHE_SIZE = 1024
+    FLASKY_RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR')
+    FLASKY_FRAGMENT_CACHE_SIZE = 2048
+    FLASKY_LAST_SEEN_THRESHOLD = 60
+    FLASKY_LAST_SEEN_FLUSH_INTERVAL = 10
+    FLASKY_METRICS_SAMPLE_RATE = 0.1
+    FLASKY_METRICS_REPEAT_THRESHOLD = 10
+    # scrapers send "Authorization: Bearer <token>"; admins can just log in
+    FLASKY_METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # shared by the gunicorn workers so /metrics covers all of them
+    FLASKY_METRICS_DIR = os.environ.get('METRICS_DIR')
+    FLASKY_IMAGE_WORKERS = 2
+    FLASKY_IMAGE_WEBP = True
+    FLASKY_IMAGE_QUALITY = 85
+    FLASKY_AVATAR_URL_CACHE_SIZE = 10000
+    FLASKY_UPLOAD_DIR = os.environ.get('UPLOAD_DIR')
+    FLASKY_UPLOAD_MAX_SIZE = 2 * 1024 * 1024 * 1024
+    FLASKY_UPLOAD_EXPIRY = 24 * 3600
+    FLASKY_MEDIA_OFFLOAD = os.environ.get('MEDIA_OFFLOAD')
+    FLASKY_MEDIA_ACCEL_PREFIX = '/protected-media/'
+    FLASKY_MAIL_WORKERS = 2
+    FLASKY_MAIL_BATCH_SIZE = 50
+    FLASKY_MAIL_POLL_INTERVAL = 60
+    FLASKY_MAIL_MAX_ATTEMPTS = 8
+    FLASKY_MAIL_RETRY_DELAY = 60
+    FLASKY_MAIL_RETRY_MAX_DELAY = 3600
+    FLASKY_QUERY_BUDGETS = {
+        'main.lesson': 15,
+        'main.teacher': 15,
+    }
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024
     @staticmethod
     def init_app(app):
@@ -37,6 +69,15 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
     WTF_CSRF_ENABLED = False
+    FLASKY_IMAGE_WORKERS = 0
+    FLASKY_MAIL_WORKERS = 0
+
+
+class BenchmarkConfig(Config):
+    SSL_DISABLE = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL') or \
+        'sqlite:///' + os.path.join(basedir, 'data-bench.sqlite')
+    WTF_CSRF_ENABLED = False
 
 
 class ProductionConfig(Config):
@@ -102,6 +143,7 @@ class UnixConfig(ProductionConfig):
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
+    'benchmark': BenchmarkConfig,
     'production': ProductionConfig,
     'heroku': HerokuConfig,
     'unix': UnixConfig,
@@ -16,7 +16,8 @@ if os.path.exists('.env'):
 
 from app import create_app, db
 from app.models import User, Follow, Role, Permission, Post, Comment, Teacher,\
-                     Lesson,NewLesson,Student, CollectPost, AtMe , Letter,ClickTime
+                     Lesson,NewLesson,Student, CollectPost, AtMe , Letter,ClickTime,\
+                     Timeline
 from flask_script import Manager, Shell
 from flask_migrate import Migrate, MigrateCommand
 
@@ -66,6 +67,109 @@ def profile(length=25, profile_dir=None):
     app.run()
 
 
+@manager.command
+def benchmark(scale=1.0, seed=None, requests=50, output='benchmark.json',
+              reseed=False):
+    """Time the main routes against a seeded benchmark database."""
+    import subprocess
+    from app import benchmark as bench
+    bench_app = create_app('benchmark')
+    with bench_app.app_context():
+        if reseed:
+            db.drop_all()
+        db.create_all()
+        Role.insert_roles()
+        if bench.targets() is None:
+            print('Seeding at scale %s...' % scale)
+            bench.seed(scale, seed)
+        ids = bench.targets()
+        counts = bench.dataset()
+        db.session.remove()
+    results = bench.run(bench_app, ids, requests=requests)
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    data = bench.report(results, counts, commit)
+    bench.save(data, output)
+    for endpoint in sorted(results):
+        result = results[endpoint]
+        print('%-32s p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  %5.1f queries'
+              % (endpoint, result['p50'] * 1000, result['p95'] * 1000,
+                 result['p99'] * 1000, result['queries_per_request']))
+    print('Peak RSS %d kB' % data['peak_rss_kb'])
+    print('Results saved to %s' % output)
+
+
+@manager.command
+def fake(scale=1.0, seed=None):
+    """Bulk-insert a synthetic dataset (scale 1 is 1000 users)."""
+    from app.fake import generate
+    counts = generate(scale, seed)
+    for table in sorted(counts):
+        print('%-12s %d' % (table, counts[table]))
+
+
+@manager.command
+def render_images():
+    """Generate missing renditions for already uploaded pictures."""
+    from app.images import pending, process
+    for folder in ('post', 'lesson', 'teacher_pic', 'avatar'):
+        for path in pending(folder):
+            print(path)
+            process(path, app.config['FLASKY_IMAGE_WEBP'],
+                    app.config['FLASKY_IMAGE_QUALITY'], app.logger)
+
+
+@manager.command
+def migrate_avatars():
+    """Move avatars uploaded before renditions to content-hashed names."""
+    from app.avatars import migrate_legacy
+    from app.models import User
+    print(migrate_legacy(User.query.filter(User.avatar_file != None)))
+    db.session.commit()
+
+
+@manager.command
+def dedupe_uploads():
+    """Move uploads saved before the content store into it."""
+    from app.store import dedupe
+    stats = dedupe()
+    print('%(files)d files, %(blobs)d blobs, %(bytes_saved)d bytes saved' %
+          stats)
+
+
+@manager.command
+def collect_uploads():
+    """Delete stored uploads that nothing refers to any more."""
+    from app.store import collect, expire_uploads
+    print('%d blobs, %d abandoned uploads' % (collect(), expire_uploads()))
+    db.session.commit()
+
+
+@manager.command
+def send_mail():
+    """Send the messages waiting in the outbox."""
+    from app.email import send_pending
+    print(send_pending())
+
+
+@manager.command
+def mailsink(port=1025):
+    """Run a local SMTP server that keeps mail instead of sending it."""
+    from app.mailsink import MailSink
+    sink = MailSink(('127.0.0.1', int(port)))
+    print('Listening on 127.0.0.1:%d' % sink.port)
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        sink.server_close()
+    for sender, recipients, data in sink.messages:
+        print('%s -> %s, %d bytes' % (sender, ', '.join(recipients),
+                                      len(data)))
+
+
 @manager.command
 def deploy():
     """Run deployment tasks."""
@@ -81,6 +185,43 @@ def deploy():
     # create self-follows for all users
     User.add_self_follows()
 
+    # rebuild the denormalized profile counters
+    User.reconcile_counters()
+    Teacher.rebuild_stats()
+
+    # refill the followed-posts timelines
+    Timeline.rebuild()
+
+    # index anything written before search existed
+    from app.search import rebuild
+    rebuild()
+
+
+@manager.command
+def rebuild_timelines():
+    """Refill every user's followed-posts timeline from follows."""
+    Timeline.rebuild()
+
+
+@manager.command
+def trim_timelines():
+    """Cut timelines back to FLASKY_TIMELINE_LENGTH posts."""
+    print(Timeline.trim_all())
+
+
+@manager.command
+def reindex():
+    """Rebuild the search index from posts, comments, lessons and users."""
+    from app.search import rebuild
+    print(rebuild())
+
+
+@manager.command
+def reconcile_counters():
+    """Rebuild the counters shown on profile, lesson and teacher badges."""
+    User.reconcile_counters()
+    Teacher.rebuild_stats()
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,23 @@
+"""collectposts user_id timestamp index
+
+Revision ID: 07e3c9d5b816
+Revises: f6d2b8c4a705
+Create Date: 2026-10-18 21:12:06.731945
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '07e3c9d5b816'
+down_revision = 'f6d2b8c4a705'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_collectposts_user_id_timestamp', 'collectposts',
+                    ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_collectposts_user_id_timestamp', 'collectposts')
@@ -0,0 +1,31 @@
+"""user counters
+
+Revision ID: 3c1e5f0a7b21
+Revises: 51f5ccfba190
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c1e5f0a7b21'
+down_revision = '51f5ccfba190'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+counters = ['post_count', 'private_count', 'comment_count', 'commented_count',
+            'followed_count', 'follower_count', 'atme_count', 'collected_count']
+
+
+def upgrade():
+    for name in counters:
+        op.add_column('users', sa.Column(name, sa.Integer(), nullable=True,
+                                         server_default='0'))
+    # run `python manage.py reconcile_counters` afterwards to fill them in
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        for name in counters:
+            batch_op.drop_column(name)
@@ -0,0 +1,26 @@
+"""received comments
+
+Revision ID: 4a7d2c9e1f03
+Revises: 3c1e5f0a7b21
+Create Date: 2026-10-18 10:41:05.532810
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a7d2c9e1f03'
+down_revision = '3c1e5f0a7b21'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('users', sa.Column('commented_new_count', sa.Integer(),
+                                     nullable=True, server_default='0'))
+    op.create_index('ix_comments_post_id', 'comments', ['post_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_comments_post_id', 'comments')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('commented_new_count')
@@ -0,0 +1,38 @@
+"""lesson stats
+
+Revision ID: 5b8e3f1a2c64
+Revises: 4a7d2c9e1f03
+Create Date: 2026-10-18 11:20:47.108352
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e3f1a2c64'
+down_revision = '4a7d2c9e1f03'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+STATS = {
+    'newlessons': ('student_count', 'seat_count', 'discussion_count',
+                   'exercise_count'),
+    'lessons': ('newlesson_count', 'file_count', 'discussion_count',
+                'student_count'),
+    'teachers': ('lesson_count', 'file_count', 'discussion_count',
+                 'student_count'),
+}
+
+
+def upgrade():
+    for table, columns in STATS.items():
+        for column in columns:
+            op.add_column(table, sa.Column(column, sa.Integer(),
+                                           nullable=True, server_default='0'))
+
+
+def downgrade():
+    for table, columns in STATS.items():
+        with op.batch_alter_table(table) as batch_op:
+            for column in columns:
+                batch_op.drop_column(column)
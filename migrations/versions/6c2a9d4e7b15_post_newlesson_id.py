@@ -0,0 +1,68 @@
+"""post newlesson id
+
+Revision ID: 6c2a9d4e7b15
+Revises: 5b8e3f1a2c64
+Create Date: 2026-10-18 12:05:19.664023
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6c2a9d4e7b15'
+down_revision = '5b8e3f1a2c64'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+BATCH_SIZE = 1000
+
+posts = sa.table('posts',
+                 sa.column('id', sa.Integer),
+                 sa.column('tag', sa.String),
+                 sa.column('newlesson_id', sa.Integer))
+
+
+def backfill(connection):
+    # walk the class posts in id order, BATCH_SIZE rows at a time, so only
+    # one batch is held in memory and each UPDATE stays small.  It all still
+    # runs in the migration's one transaction, committed at the end.
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([posts.c.id, posts.c.tag]).
+            where(posts.c.id > last_id).
+            where(posts.c.tag.like('newlessons\\_%', escape='\\')).
+            order_by(posts.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        params = []
+        for id, tag in rows:
+            try:
+                params.append({'post_id': id,
+                               'value': int(tag.split('_')[1])})
+            except ValueError:
+                pass
+        if params:
+            connection.execute(
+                posts.update().
+                where(posts.c.id == sa.bindparam('post_id')).
+                values(newlesson_id=sa.bindparam('value')), params)
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.add_column(sa.Column('newlesson_id', sa.Integer(),
+                                      nullable=True))
+        batch_op.create_foreign_key('fk_posts_newlesson_id', 'newlessons',
+                                    ['newlesson_id'], ['id'])
+    backfill(op.get_bind())
+    op.create_index('ix_posts_newlesson_id_timestamp', 'posts',
+                    ['newlesson_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_posts_newlesson_id_timestamp', 'posts')
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_constraint('fk_posts_newlesson_id', type_='foreignkey')
+        batch_op.drop_column('newlesson_id')
@@ -0,0 +1,32 @@
+"""timelines
+
+Revision ID: 7d3b0e5f8c26
+Revises: 6c2a9d4e7b15
+Create Date: 2026-10-18 13:02:41.377190
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d3b0e5f8c26'
+down_revision = '6c2a9d4e7b15'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('timelines',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timelines_user_id_timestamp', 'timelines',
+                    ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_timelines_user_id_timestamp', 'timelines')
+    op.drop_table('timelines')
@@ -0,0 +1,29 @@
+"""post fragment versions
+
+Revision ID: 8e4c1f6a9d37
+Revises: 7d3b0e5f8c26
+Create Date: 2026-10-18 14:26:08.915532
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e4c1f6a9d37'
+down_revision = '7d3b0e5f8c26'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('version', sa.Integer(), nullable=True,
+                                     server_default='0'))
+    op.add_column('posts', sa.Column('comment_count', sa.Integer(),
+                                     nullable=True, server_default='0'))
+    op.execute('UPDATE posts SET comment_count = (SELECT count(*) '
+               'FROM comments WHERE comments.post_id = posts.id)')
+
+
+def downgrade():
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('comment_count')
+        batch_op.drop_column('version')
@@ -0,0 +1,39 @@
+"""foreign key indexes
+
+Revision ID: 9f5d2a7b0e48
+Revises: 8e4c1f6a9d37
+Create Date: 2026-10-18 15:02:41.327815
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9f5d2a7b0e48'
+down_revision = '8e4c1f6a9d37'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+INDEXES = [
+    ('follows', 'followed_id'),
+    ('posts', 'author_id'),
+    ('comments', 'author_id'),
+    ('atmes', 'username'),
+    ('lessons', 'teacher_id'),
+    ('newlessons', 'lesson_id'),
+    ('lessonfiles', 'lesson_id'),
+    ('students', 'student_id'),
+    ('students', 'newlesson_id'),
+    ('teachers', 'teacher_id'),
+]
+
+
+def upgrade():
+    for table, column in INDEXES:
+        op.create_index('ix_%s_%s' % (table, column), table, [column],
+                        unique=False)
+
+
+def downgrade():
+    for table, column in reversed(INDEXES):
+        op.drop_index('ix_%s_%s' % (table, column), table_name=table)
@@ -0,0 +1,36 @@
+"""blob store
+
+Revision ID: a0e6b3c8f159
+Revises: 9f5d2a7b0e48
+Create Date: 2026-10-18 16:11:27.604318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a0e6b3c8f159'
+down_revision = '9f5d2a7b0e48'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('blobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sha256', sa.String(length=64), nullable=True),
+    sa.Column('path', sa.String(length=64), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('refcount', sa.Integer(), nullable=True, server_default='0'),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('path')
+    )
+    op.create_index('ix_blobs_sha256', 'blobs', ['sha256'], unique=True)
+    op.create_index('ix_blobs_timestamp', 'blobs', ['timestamp'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_blobs_timestamp', 'blobs')
+    op.drop_index('ix_blobs_sha256', 'blobs')
+    op.drop_table('blobs')
@@ -0,0 +1,36 @@
+"""chunked uploads
+
+Revision ID: b1f7c4d9e26a
+Revises: a0e6b3c8f159
+Create Date: 2026-10-18 17:03:52.118046
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b1f7c4d9e26a'
+down_revision = 'a0e6b3c8f159'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('uploads',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('filename', sa.String(length=64), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_uploads_timestamp', 'uploads', ['timestamp'],
+                    unique=False)
+    op.create_index('ix_uploads_user_id', 'uploads', ['user_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_uploads_user_id', 'uploads')
+    op.drop_index('ix_uploads_timestamp', 'uploads')
+    op.drop_table('uploads')
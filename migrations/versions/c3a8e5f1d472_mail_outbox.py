@@ -0,0 +1,37 @@
+"""mail outbox
+
+Revision ID: c3a8e5f1d472
+Revises: b1f7c4d9e26a
+Create Date: 2026-10-18 18:21:07.553914
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3a8e5f1d472'
+down_revision = 'b1f7c4d9e26a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sender', sa.String(length=128), nullable=True),
+    sa.Column('recipient', sa.String(length=128), nullable=True),
+    sa.Column('subject', sa.String(length=256), nullable=True),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('html', sa.Text(), nullable=True),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=True),
+    sa.Column('next_attempt', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.String(length=256), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_outbox_next_attempt', 'outbox', ['next_attempt'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_outbox_next_attempt', 'outbox')
+    op.drop_table('outbox')
@@ -0,0 +1,42 @@
+"""search index
+
+Revision ID: d4b9f6a2e583
+Revises: c3a8e5f1d472
+Create Date: 2026-10-18 19:02:44.610283
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd4b9f6a2e583'
+down_revision = 'c3a8e5f1d472'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def has_fts5(bind):
+    return bind.dialect.name == 'sqlite' and any(
+        row[0] == 'ENABLE_FTS5'
+        for row in bind.execute('PRAGMA compile_options'))
+
+
+def upgrade():
+    op.create_table('search_terms',
+    sa.Column('term', sa.String(length=64), nullable=False),
+    sa.Column('doc', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('weight', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('term', 'doc')
+    )
+    op.create_index('ix_search_terms_doc', 'search_terms', ['doc'],
+                    unique=False)
+    if has_fts5(op.get_bind()):
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS search_index '
+                   'USING fts5(title, body)')
+    # filled by "manage.py reindex", which deploy runs
+
+
+def downgrade():
+    if has_fts5(op.get_bind()):
+        op.execute('DROP TABLE IF EXISTS search_index')
+    op.drop_index('ix_search_terms_doc', 'search_terms')
+    op.drop_table('search_terms')
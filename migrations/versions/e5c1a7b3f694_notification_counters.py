@@ -0,0 +1,57 @@
+"""notification counters
+
+Revision ID: e5c1a7b3f694
+Revises: d4b9f6a2e583
+Create Date: 2026-10-18 19:48:13.275190
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e5c1a7b3f694'
+down_revision = 'd4b9f6a2e583'
+
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+COUNTERS = {
+    'clicktimes': ('unread_comments_on_me', 'unread_followed_by',
+                   'unread_atme'),
+    'students': ('unread_discussion',),
+}
+
+users = sa.table('users', sa.column('id', sa.Integer))
+clicktimes = sa.table('clicktimes',
+                      sa.column('id', sa.Integer),
+                      sa.column('user_id', sa.Integer),
+                      sa.column('timestamp', sa.DateTime))
+
+
+def upgrade():
+    for table, columns in COUNTERS.items():
+        for column in columns:
+            op.add_column(table, sa.Column(column, sa.Integer(),
+                                           nullable=True, server_default='0'))
+    # exactly one row per user from now on: keep the oldest of any
+    # duplicates and add the missing ones
+    first = sa.select([sa.func.min(clicktimes.c.id).label('id')]).\
+        group_by(clicktimes.c.user_id).alias('first')
+    op.execute(clicktimes.delete().
+               where(clicktimes.c.user_id != None).
+               where(~clicktimes.c.id.in_(sa.select([first.c.id]))))
+    op.execute(clicktimes.insert().from_select(
+        ['user_id', 'timestamp'],
+        sa.select([users.c.id, sa.literal(datetime.utcnow())]).
+        where(~users.c.id.in_(sa.select([clicktimes.c.user_id]).
+                              where(clicktimes.c.user_id != None)))))
+    op.create_index('ix_clicktimes_user_id', 'clicktimes', ['user_id'],
+                    unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_clicktimes_user_id', 'clicktimes')
+    for table, columns in COUNTERS.items():
+        with op.batch_alter_table(table) as batch_op:
+            for column in columns:
+                batch_op.drop_column(column)
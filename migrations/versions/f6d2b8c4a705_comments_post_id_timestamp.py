@@ -0,0 +1,27 @@
+"""comments post_id timestamp index
+
+Revision ID: f6d2b8c4a705
+Revises: e5c1a7b3f694
+Create Date: 2026-10-18 20:37:52.108431
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f6d2b8c4a705'
+down_revision = 'e5c1a7b3f694'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_comments_post_id_timestamp', 'comments',
+                    ['post_id', 'timestamp'], unique=False)
+    # a prefix of the new index
+    op.drop_index('ix_comments_post_id', 'comments')
+
+
+def downgrade():
+    op.create_index('ix_comments_post_id', 'comments', ['post_id'],
+                    unique=False)
+    op.drop_index('ix_comments_post_id_timestamp', 'comments')
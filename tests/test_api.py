@@ -147,7 +147,7 @@ class APITestCase(unittest.TestCase):
 
         # get the post from the user
         response = self.client.get(
-            url_for('api.get_user_posts', id=u.id),
+            url_for('api.get_user_posts', id=u.id, count=1),
             headers=self.get_api_headers('john@example.com', 'cat'))
         self.assertTrue(response.status_code == 200)
         json_response = json.loads(response.data.decode('utf-8'))
@@ -157,7 +157,7 @@ class APITestCase(unittest.TestCase):
 
         # get the post from the user as a follower
         response = self.client.get(
-            url_for('api.get_user_followed_posts', id=u.id),
+            url_for('api.get_user_followed_posts', id=u.id, count=1),
             headers=self.get_api_headers('john@example.com', 'cat'))
         self.assertTrue(response.status_code == 200)
         json_response = json.loads(response.data.decode('utf-8'))
@@ -257,7 +257,7 @@ class APITestCase(unittest.TestCase):
 
         # get all the comments
         response = self.client.get(
-            url_for('api.get_comments', id=post.id),
+            url_for('api.get_comments', id=post.id, count=1),
             headers=self.get_api_headers('susan@example.com', 'dog'))
         self.assertTrue(response.status_code == 200)
         json_response = json.loads(response.data.decode('utf-8'))
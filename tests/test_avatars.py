@@ -0,0 +1,92 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from PIL import Image
+from app import create_app, db
+from app.models import User
+from app import avatars
+
+
+class AvatarsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.static_folder = tempfile.mkdtemp()
+        self.app.static_folder = self.static_folder
+        self.app.static_url_path = '/static'
+        self.app_context = self.app.test_request_context('/')
+        self.app_context.push()
+        db.create_all()
+        avatars.urls.clear()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        avatars.urls.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.static_folder)
+
+    def upload(self, size=(300, 200), mode='RGB', format='JPEG'):
+        data = io.BytesIO()
+        Image.new(mode, size, 'red').save(data, format)
+        data.seek(0)
+        return data
+
+    def test_renditions(self):
+        avatar_file = avatars.save_avatar(self.upload())
+        self.assertTrue(avatar_file.endswith('.jpg'))
+        self.assertEqual(len(avatar_file), 36)
+        for size in avatars.SIZES:
+            path = os.path.join(self.static_folder, 'avatar',
+                                avatar_file.replace('.jpg', '.%d.jpg' % size))
+            with Image.open(path) as image:
+                self.assertEqual(image.size, (size, size))
+        # same bytes, same name
+        self.assertEqual(avatars.save_avatar(self.upload()), avatar_file)
+        self.assertTrue(avatars.save_avatar(
+            self.upload(mode='RGBA', format='PNG')).endswith('.png'))
+        self.assertIsNone(avatars.save_avatar(io.BytesIO(b'not an image')))
+
+        u = User(email='john@example.com', avatar_file=avatar_file)
+        url = u.avatar_url(size=28)
+        self.assertEqual(url, '/avatar/' + avatar_file.replace('.jpg',
+                                                               '.40.jpg'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+        response.close()
+
+        # uploads from before renditions are served as they were
+        u.avatar_file = '/static/avatar/john.jpg'
+        self.assertEqual(u.avatar_url(40), '/static/avatar/john.jpg')
+
+    def test_identicon(self):
+        u = User(email='john@example.com')
+        url = u.avatar_url(size=200)
+        self.assertEqual(url, '/avatar/identicon/'
+                         'd4c74594d841139328695756648b6bd6.200.png')
+        self.assertIn((None, 'd4c74594d841139328695756648b6bd6', 200),
+                      avatars.urls.entries)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        with Image.open(io.BytesIO(response.data)) as image:
+            self.assertEqual(image.size, (200, 200))
+        response.close()
+        # drawn in memory, nothing left behind on disk
+        self.assertFalse(os.path.exists(os.path.join(
+            self.app.static_folder, 'avatar', 'identicon')))
+        response = self.client.get(url, headers={
+            'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get(
+            '/avatar/identicon/d4c74594d841139328695756648b6bd6.7.png',
+            headers={'Accept': 'application/json'}).status_code, 404)
+        self.assertEqual(avatars.identicon('d4c74594d841139328695756648b6bd6',
+                                           40).tobytes(),
+                         avatars.identicon('d4c74594d841139328695756648b6bd6',
+                                           40).tobytes())
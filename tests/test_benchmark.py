@@ -0,0 +1,45 @@
+import unittest
+from app import create_app, db
+from app.models import Role
+from app import benchmark
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 95), 95)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile([3], 99), 3)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_run(self):
+        self.assertIsNone(benchmark.targets())
+        benchmark.seed(scale=0.01, seed=1)
+        ids = benchmark.targets()
+        counts = benchmark.dataset()
+        self.assertTrue(counts['posts'] >= 11)
+        routes = [route for route in benchmark.ROUTES
+                  if route[0] in ('main.lesson', 'api.get_post')]
+        results = benchmark.run(self.app, ids, requests=3, routes=routes)
+        self.assertEqual(sorted(results), ['api.get_post', 'main.lesson'])
+        for result in results.values():
+            self.assertEqual(result['status'], {'200': 3})
+            self.assertTrue(result['p50'] <= result['p95'] <= result['p99'])
+            self.assertTrue(result['queries_per_request'] > 0)
+        data = benchmark.report(results, counts, 'abc123')
+        self.assertEqual(data['commit'], 'abc123')
+        self.assertTrue(data['peak_rss_kb'] > 0)
+        self.assertEqual(data['routes'], results)
@@ -0,0 +1,96 @@
+import re
+import unittest
+from datetime import datetime
+from flask_sqlalchemy import get_debug_queries
+from app import create_app, db, render
+from app.models import User, AnonymousUser, Role, Post, CollectPost
+
+
+class BookmarksTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.john = User(email='john@example.com', username='john',
+                         password='cat', confirmed=True)
+        self.susan = User(email='susan@example.com', username='susan',
+                          password='dog', confirmed=True)
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        render.fragments.clear()
+
+    def tearDown(self):
+        render.fragments.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_bookmarks(self):
+        posts = [Post(body='p%d' % i, topic='p%d' % i, author=self.susan)
+                 for i in range(5)]
+        posts[4].private = True
+        db.session.add_all(posts)
+        db.session.commit()
+        tied = datetime(2026, 1, 1)
+        for post in posts:
+            db.session.add(CollectPost(user_id=self.john.id, post_id=post.id,
+                                       timestamp=tied))
+        # susan's bookmarks never show up in john's collection
+        db.session.add(CollectPost(user_id=self.susan.id, post_id=posts[0].id))
+        db.session.commit()
+        return posts
+
+    def test_bookmarked(self):
+        posts = self.add_bookmarks()
+        other = Post(body='other', author=self.susan)
+        db.session.add(other)
+        db.session.commit()
+        db.session.refresh(self.john)
+        ids = set(post.id for post in posts + [other])
+        with self.app.test_request_context():
+            before = len(get_debug_queries())
+            self.assertEqual(self.john.bookmarked(posts + [other]),
+                             ids - set([other.id]))
+            self.assertEqual(len(get_debug_queries()) - before, 1)
+        self.assertEqual(self.john.bookmarked([]), set())
+        self.assertEqual(AnonymousUser().bookmarked(posts), set())
+        self.assertEqual(self.john.bookmarks.count(), 5)
+
+    def test_collection(self):
+        self.add_bookmarks()
+        client = self.app.test_client()
+        client.set_cookie('localhost', 'english', 'yes')
+        # logged in as susan, reading john's collection
+        client.post('/login', data={'email': 'susan@example.com',
+                                    'password': 'dog'})
+        url = '/collection/%d' % self.john.id
+        shown = []
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            html = response.data.decode('utf-8')
+            shown.extend(re.findall(r'>(p\d)</a></h2>', html))
+            match = re.search(r'href="([^"]*cursor=[^"]*)">\s*&raquo;', html)
+            url = match and match.group(1).replace('&amp;', '&')
+        self.assertEqual(shown, ['p3', 'p2', 'p1', 'p0'])
+
+    def test_collect(self):
+        post = Post(body='hello', author=self.susan)
+        db.session.add(post)
+        db.session.commit()
+        client = self.app.test_client()
+        client.set_cookie('localhost', 'english', 'yes')
+        client.post('/login', data={'email': 'john@example.com',
+                                    'password': 'cat'})
+        self.assertTrue(b'>Collect<' in client.get('/post/%d' % post.id).data)
+        client.get('/collect/%d/0' % post.id)
+        client.get('/collect/%d/0' % post.id)
+        self.assertEqual(CollectPost.query.count(), 1)
+        self.assertTrue(b'>Uncollect<' in client.get('/post/%d' % post.id).data)
+        self.assertTrue(b'>Uncollect<' in client.get('/blog').data)
+        client.get('/collect/%d/1' % post.id)
+        client.get('/collect/%d/1' % post.id)
+        self.assertEqual(CollectPost.query.count(), 0)
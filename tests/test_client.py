@@ -1,8 +1,16 @@
+import os
 import re
+import shutil
+import tempfile
+import json
 import unittest
 from flask import url_for
 from app import create_app, db
-from app.models import User, Role
+from app.models import User, Role, Post, Teacher, Lesson, NewLesson, \
+    LessonFile, Student
+from app.exceptions import QueryBudgetExceeded
+from app.metrics import metrics
+from app import render
 
 class FlaskClientTestCase(unittest.TestCase):
     def setUp(self):
@@ -52,3 +60,145 @@ class FlaskClientTestCase(unittest.TestCase):
         # log out
         response = self.client.get(url_for('auth.logout'), follow_redirects=True)
         self.assertTrue(b'You have been logged out' in response.data)
+
+    def add_lessons(self):
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True)
+        db.session.add(u)
+        db.session.commit()
+        t = Teacher(teacher_id=u.id, about_teacher='about')
+        db.session.add(t)
+        for i in range(3):
+            l = Lesson(lesson_name='lesson%d' % i, about_lesson='about',
+                       teacher_id=u.id)
+            db.session.add(l)
+            db.session.commit()
+            db.session.add(LessonFile(lesson_id=l.id, file='/static/lesson/a.pdf',
+                                      filename='a.pdf'))
+            for j in range(2):
+                nl = NewLesson(lesson_id=l.id, year='2017', season='spring')
+                db.session.add(nl)
+                db.session.commit()
+                for k in range(5):
+                    s = User(email='s%d%d%d@example.com' % (i, j, k),
+                             username='s%d%d%d' % (i, j, k), password='dog')
+                    db.session.add(s)
+                    db.session.commit()
+                    db.session.add(Student(student_id=s.id,
+                                           newlesson_id=nl.id))
+                    db.session.add(Post(body='hi', author=s,
+                                        tag='newlessons_' + str(nl.id)))
+        db.session.commit()
+        self.client.set_cookie('localhost', 'english', 'yes')
+        return t, Lesson.query.first()
+
+    def test_lesson_pages_query_budget(self):
+        t, l = self.add_lessons()
+        for show in ('1', '2', '3', '4'):
+            self.client.set_cookie('localhost', 'show_all_class', show)
+            response = self.client.get('/lesson/%d' % l.id)
+            self.assertEqual(response.status_code, 200)
+        for show in ('1', '2', '3', '4'):
+            self.client.set_cookie('localhost', 'show_opened_lesson', show)
+            response = self.client.get('/teacher/%d' % t.id)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(b'lesson2' in response.data)
+
+        self.app.config['FLASKY_QUERY_BUDGETS'] = {'main.lesson': 1}
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/lesson/%d' % l.id)
+
+    def test_seat_map(self):
+        u = User(email='john@example.com', username='john', password='cat',
+                 name='John', confirmed=True)
+        db.session.add(u)
+        db.session.commit()
+        l = Lesson(teacher_id=u.id)
+        db.session.add(l)
+        db.session.commit()
+        nl = NewLesson(lesson_id=l.id, room_row=2, room_column=3)
+        db.session.add(nl)
+        db.session.commit()
+        db.session.add(Student(student_id=u.id, newlesson_id=nl.id,
+                               seat='0203', absence=2))
+        db.session.commit()
+        # the roster is not shown to anonymous visitors
+        response = self.client.get('/current-lesson/%d/seats' % nl.id)
+        self.assertEqual(response.status_code, 302)
+        self.client.post('/login', data={'email': 'john@example.com',
+                                         'password': 'cat'})
+        response = self.client.get('/current-lesson/%d/seats' % nl.id)
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(json_response['rows'], 2)
+        self.assertEqual(json_response['columns'], 3)
+        self.assertEqual(json_response['grid'][0][0], {'seat': '0101'})
+        self.assertEqual(json_response['grid'][1][2]['username'], 'john')
+        self.assertEqual(json_response['grid'][1][2]['absence'], 2)
+        # which the lesson page polls to refresh its seat map
+        self.client.set_cookie('localhost', 'english', 'yes')
+        self.client.set_cookie('localhost', 'show_lesson_discussion', '2')
+        response = self.client.get('/current-lesson/%d' % nl.id)
+        self.assertTrue(('data-url="/current-lesson/%d/seats"' % nl.id)
+                        .encode('utf-8') in response.data)
+        self.assertTrue(b'js/seatmap.js' in response.data)
+
+    def test_metrics(self):
+        metrics.clear()
+        render.fragments.clear()
+        self.app.config['FLASKY_METRICS_SAMPLE_RATE'] = 1.0
+        self.app.config['FLASKY_METRICS_REPEAT_THRESHOLD'] = 3
+        self.app.config['FLASKY_METRICS_TOKEN'] = 'secret'
+        auth = {'Authorization': 'Bearer secret'}
+        t, l = self.add_lessons()
+        self.client.get('/lesson/%d' % l.id)
+        self.client.get('/lesson/%d' % l.id)
+        # every post on the front page lazy-loads its author
+        self.client.get('/')
+        response = self.client.get('/metrics', headers=auth)
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data(as_text=True)
+        self.assertTrue(
+            'flasky_request_queries_count{endpoint="main.lesson"} 2' in data)
+        self.assertTrue(
+            'flasky_request_seconds_count{endpoint="main.index"} 1' in data)
+        self.assertTrue(re.search(
+            r'flasky_repeated_statement_requests\{endpoint="main.index",'
+            r'statement="SELECT users.id [^"]*"\} 1', data))
+        self.assertFalse(re.search(
+            r'flasky_repeated_statement_requests\{endpoint="main.lesson"',
+            data))
+
+        # unsampled requests are not recorded
+        self.app.config['FLASKY_METRICS_SAMPLE_RATE'] = 0.0
+        self.client.get('/lesson/%d' % l.id)
+        data = self.client.get('/metrics', headers=auth).get_data(
+            as_text=True)
+        self.assertTrue(
+            'flasky_request_queries_count{endpoint="main.lesson"} 2' in data)
+
+        # only with the token (or to an administrator), wherever from
+        for headers in ({}, {'Authorization': 'Bearer wrong'}):
+            headers['Accept'] = 'application/json'
+            response = self.client.get(
+                '/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'},
+                headers=headers)
+            self.assertEqual(response.status_code, 404)
+
+    def test_metrics_across_workers(self):
+        metrics.clear()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.app.config['FLASKY_METRICS_SAMPLE_RATE'] = 1.0
+        self.app.config['FLASKY_METRICS_DIR'] = folder
+        self.app.config['FLASKY_METRICS_TOKEN'] = 'secret'
+        auth = {'Authorization': 'Bearer secret'}
+        t, l = self.add_lessons()
+        self.client.get('/lesson/%d' % l.id)
+        # another worker has written its totals as well
+        own = os.path.join(folder, 'metrics-%d.json' % os.getpid())
+        shutil.copy(own, os.path.join(folder, 'metrics-1.json'))
+        data = self.client.get('/metrics', headers=auth).get_data(
+            as_text=True)
+        self.assertTrue(
+            'flasky_request_queries_count{endpoint="main.lesson"} 2' in data)
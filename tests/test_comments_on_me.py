@@ -0,0 +1,81 @@
+import re
+import unittest
+from datetime import datetime
+from flask_sqlalchemy import get_debug_queries
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from app.pagination import KeysetPagination
+
+
+class CommentsOnMeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['FLASKY_COMMENTS_PER_PAGE'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.john = User(email='john@example.com', username='john',
+                         password='cat', confirmed=True)
+        self.susan = User(email='susan@example.com', username='susan',
+                          password='dog', confirmed=True)
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_comments(self):
+        first = Post(body='first', topic='First', author=self.john)
+        second = Post(body='second', topic='Second', author=self.john)
+        other = Post(body='other', topic='Other', author=self.susan)
+        tied = datetime(2026, 1, 1)
+        comments = [Comment(body='c%d' % i, post=(first, second)[i % 2],
+                            author=self.susan, timestamp=tied)
+                    for i in range(4)]
+        comments.append(Comment(body='c4', post=first, author=self.susan,
+                                timestamp=datetime(2026, 1, 2)))
+        db.session.add_all([first, second, other,
+                            Comment(body='not mine', post=other,
+                                    author=self.john)] + comments)
+        db.session.commit()
+        return comments
+
+    def test_query(self):
+        comments = self.add_comments()
+        db.session.refresh(self.john)
+        with self.app.test_request_context():
+            before = len(get_debug_queries())
+            query = self.john.received_comments().options(
+                db.contains_eager(Comment.post),
+                db.joinedload(Comment.author))
+            page = KeysetPagination(query, (Comment.timestamp, Comment.id),
+                                    per_page=10)
+            shown = [(c.body, c.post.topic, c.author.username)
+                     for c in page.items]
+            self.assertEqual(len(get_debug_queries()) - before, 1)
+        self.assertEqual(shown, [
+            ('c4', 'First', 'susan'), ('c3', 'Second', 'susan'),
+            ('c2', 'First', 'susan'), ('c1', 'Second', 'susan'),
+            ('c0', 'First', 'susan')])
+        self.assertEqual(page.total, len(comments))
+
+    def test_view(self):
+        self.add_comments()
+        client = self.app.test_client()
+        client.set_cookie('localhost', 'english', 'yes')
+        client.post('/login', data={'email': 'john@example.com',
+                                    'password': 'cat'})
+        url = '/comments-on-me/%d' % self.john.id
+        shown = []
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            html = response.data.decode('utf-8')
+            shown.extend(re.findall(r'<p>(c\d)</p>', html))
+            match = re.search(r'href="([^"]*cursor=[^"]*)">\s*&raquo;', html)
+            url = match and match.group(1).replace('&amp;', '&')
+        # ties on timestamp neither repeat nor drop a comment across pages
+        self.assertEqual(shown, ['c4', 'c3', 'c2', 'c1', 'c0'])
@@ -0,0 +1,124 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.email import send_email, send_pending
+from app.mailsink import MailSink
+from app.models import User, Role, OutboxMessage
+
+
+class EmailTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.sink = MailSink(('127.0.0.1', 0)).start()
+        state = self.app.extensions['mail']
+        state.suppress = False
+        state.server = '127.0.0.1'
+        state.port = self.sink.port
+        state.use_ssl = state.use_tls = False
+        state.username = None
+
+    def tearDown(self):
+        self.sink.stop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def queue(self, n):
+        for i in range(n):
+            db.session.add(OutboxMessage(
+                sender='517@example.com', recipient='user%d@example.com' % i,
+                subject='hello %d' % i, body='body', html='<p>body</p>'))
+        db.session.commit()
+
+    def test_send_email(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        with self.app.test_request_context():
+            send_email(u.email, 'Confirm', 'email/confirm', user=u,
+                       token='abc')
+        self.assertEqual(len(self.sink.messages), 1)
+        sender, recipients, data = self.sink.messages[0]
+        self.assertEqual(recipients, ['john@example.com'])
+        self.assertTrue(b'/confirm/abc' in data)
+        self.assertEqual(OutboxMessage.query.count(), 0)
+
+    def test_batches_share_a_connection(self):
+        self.app.config['FLASKY_MAIL_BATCH_SIZE'] = 2
+        self.queue(5)
+        self.assertEqual(send_pending(), 5)
+        self.assertEqual(len(self.sink.messages), 5)
+        self.assertEqual(self.sink.connections, 1)
+        self.assertEqual(OutboxMessage.query.count(), 0)
+        self.assertEqual(send_pending(), 0)
+        self.assertEqual(self.sink.connections, 1)
+
+    def test_backoff(self):
+        self.queue(2)
+        self.sink.stop()
+        self.assertEqual(send_pending(), 0)
+        delay = self.app.config['FLASKY_MAIL_RETRY_DELAY']
+        for message in OutboxMessage.query:
+            self.assertEqual(message.attempts, 1)
+            self.assertTrue(message.last_error)
+            self.assertTrue(message.next_attempt >
+                            datetime.utcnow() + timedelta(seconds=delay - 5))
+
+        # not due yet
+        self.assertEqual(send_pending(), 0)
+        self.assertEqual(OutboxMessage.query.first().attempts, 1)
+
+        # the second failure waits twice as long
+        OutboxMessage.query.update({'next_attempt': datetime.utcnow()})
+        db.session.commit()
+        send_pending()
+        message = OutboxMessage.query.first()
+        self.assertEqual(message.attempts, 2)
+        self.assertTrue(message.next_attempt >
+                        datetime.utcnow() + timedelta(seconds=2 * delay - 5))
+
+        self.sink = MailSink(('127.0.0.1', 0)).start()
+        self.app.extensions['mail'].port = self.sink.port
+        OutboxMessage.query.update({'next_attempt': datetime.utcnow()})
+        db.session.commit()
+        self.assertEqual(send_pending(), 2)
+        self.assertEqual(len(self.sink.messages), 2)
+
+    def test_give_up(self):
+        self.queue(2)
+        self.sink.refuse.add('user0@example.com')
+        self.assertEqual(send_pending(), 1)
+        message = OutboxMessage.query.one()
+        self.assertEqual(message.recipient, 'user0@example.com')
+        self.assertIsNone(message.next_attempt)
+        self.assertTrue('550' in message.last_error)
+
+        self.app.config['FLASKY_MAIL_MAX_ATTEMPTS'] = 1
+        self.queue(1)
+        self.sink.stop()
+        send_pending()
+        self.assertEqual(OutboxMessage.query.filter(
+            OutboxMessage.next_attempt != None).count(), 0)
+        self.sink = MailSink(('127.0.0.1', 0)).start()
+
+    def test_broken_message(self):
+        self.queue(2)
+        broken = OutboxMessage.query.filter_by(
+            recipient='user0@example.com').one()
+        broken.subject = 'hello\nBcc: everyone@example.com'
+        db.session.commit()
+        self.assertEqual(send_pending(), 1)
+        self.assertEqual(len(self.sink.messages), 1)
+        message = OutboxMessage.query.one()
+        self.assertEqual(message.attempts, 1)
+        self.assertTrue(message.next_attempt > datetime.utcnow())
+
+        self.app.config['FLASKY_MAIL_MAX_ATTEMPTS'] = 2
+        message.next_attempt = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(send_pending(), 0)
+        self.assertIsNone(OutboxMessage.query.one().next_attempt)
@@ -0,0 +1,67 @@
+import unittest
+from datetime import datetime
+from app import create_app, db
+from app.fake import Generator, generate, STUDENTS_PER_CLASS
+from app.render import render_markdown
+from app.models import Role, User, Follow, Post, Comment, AtMe, Teacher, \
+    Lesson, NewLesson, Student, Timeline
+
+
+class FakeDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_seeded_rows_repeat(self):
+        now = datetime(2017, 3, 1)
+        a = Generator(scale=0.05, seed=7, now=now)
+        b = Generator(scale=0.05, seed=7, now=now)
+        users_a = list(a.users())
+        users_b = list(b.users())
+        for user in users_a + users_b:
+            del user['password_hash']   # salted
+        self.assertEqual(users_a, users_b)
+        self.assertEqual(list(a.posts()), list(b.posts()))
+        c = Generator(scale=0.05, seed=8, now=now)
+        self.assertNotEqual(list(a.posts()), list(c.posts()))
+
+    def test_generate(self):
+        counts = generate(scale=0.05, seed=1, chunk=100)
+        self.assertEqual(counts['users'], User.query.count())
+        self.assertEqual(counts['posts'], Post.query.count())
+        self.assertEqual(counts['comments'], Comment.query.count())
+        self.assertEqual(counts['atmes'], AtMe.query.count())
+        self.assertEqual(counts['follows'], Follow.query.count())
+        self.assertEqual(Teacher.query.count(), 1)
+        self.assertEqual(Lesson.query.count(), 3)
+        self.assertEqual(NewLesson.query.count(), 6)
+        self.assertEqual(Student.query.count(), 6 * STUDENTS_PER_CLASS)
+
+        # counters and timelines are rebuilt after the bulk insert
+        u = User.query.get(5)
+        self.assertEqual(u.post_count, u.posts.count())
+        self.assertEqual(u.follower_count, u.followers.count())
+        self.assertTrue(Timeline.query.filter_by(user_id=u.id).count() > 0)
+        nl = NewLesson.query.first()
+        self.assertEqual(nl.student_count, STUDENTS_PER_CLASS)
+        self.assertEqual(nl.seat_count, STUDENTS_PER_CLASS)
+        self.assertEqual(nl.discussion_count,
+                         Post.query.filter_by(newlesson_id=nl.id).count())
+        seats = [s.seat for s in Student.query.filter_by(newlesson_id=nl.id)]
+        self.assertEqual(len(set(seats)), len(seats))
+
+        # every mention points at a comment that names the user
+        for atme in AtMe.query.limit(10):
+            comment = Comment.query.get(atme.comment_id)
+            self.assertTrue(comment.body.startswith('@' + atme.username))
+            self.assertEqual(comment.body_html, render_markdown(comment.body))
+            self.assertTrue(comment.timestamp >=
+                            Post.query.get(comment.post_id).timestamp)
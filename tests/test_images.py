@@ -0,0 +1,109 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from flask import g, render_template_string
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+from app import create_app, db, render, images
+from app.images import save_image, image_url, pending, rendition_name
+from app.store import save_file
+
+
+class ImagesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.static_folder = tempfile.mkdtemp()
+        self.app.static_folder = self.static_folder
+        self.app.static_url_path = '/static'
+        self.app_context = self.app.test_request_context('/')
+        self.app_context.push()
+        db.create_all()
+        render.fragments.clear()
+
+    def tearDown(self):
+        render.fragments.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.static_folder)
+
+    def upload(self, name='photo.jpg', size=(2000, 1500)):
+        exif = Image.Exif()
+        exif[0x0110] = 'Secret Camera'    # Model
+        exif[0x0112] = 6                  # Orientation: rotate 90 CW
+        data = io.BytesIO()
+        Image.new('RGB', size, (200, 10, 10)).save(data, 'JPEG', exif=exif)
+        data.seek(0)
+        return FileStorage(data, filename=name)
+
+    def test_renditions(self):
+        url = save_image(self.upload(name='photo.JPG'))
+        self.assertTrue(url.startswith('/static/store/'))
+        self.assertTrue(url.endswith('.jpg'))
+        path = os.path.join(self.static_folder, url[len('/static/'):])
+        # the blob keeps the bytes its name is the hash of
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.upload().read())
+        with Image.open(rendition_name(path, 'full')) as full:
+            # orientation applied, bounded, metadata gone
+            self.assertEqual(full.size, (768, 1024))
+            self.assertFalse(full.getexif())
+        with Image.open(rendition_name(path, 'card')) as card:
+            self.assertEqual(card.size, (384, 512))
+            self.assertFalse(card.getexif())
+        with Image.open(rendition_name(path, 'thumb')) as thumb:
+            self.assertEqual(max(thumb.size), 80)
+        with Image.open(rendition_name(path, 'card', 'webp')) as webp:
+            self.assertEqual(webp.format, 'WEBP')
+        card = rendition_name(url, 'card')
+        self.assertEqual(image_url(url, 'card'), card)
+        self.assertEqual(image_url(url), rendition_name(url, 'full'))
+
+        # the same picture again shares the processed blob
+        self.assertEqual(save_image(self.upload(name='again.jpg')), url)
+        # and one stored as a plain file first still gets its renditions
+        images.remove(path)
+        with open(path, 'wb') as f:
+            f.write(self.upload().read())
+        self.assertEqual(save_file(self.upload(name='plain.jpg')), url)
+        self.assertEqual(save_image(self.upload(name='again.jpg')), url)
+        self.assertTrue(os.path.exists(rendition_name(path, 'thumb')))
+
+        html = render_template_string(
+            "{% call picture(url, 'card') %}"
+            "<img src=\"{{ image_url(url, 'card') }}\">{% endcall %}", url=url)
+        self.assertEqual(html, '<picture><source srcset="%s" type="image/webp">'
+                         '<img src="%s"></picture>' %
+                         (rendition_name(url, 'card', 'webp'), card))
+
+    def test_fallback_is_not_cached(self):
+        self.app.config['FLASKY_IMAGE_WORKERS'] = 1
+        os.makedirs(os.path.join(self.static_folder, 'post'))
+        path = os.path.join(self.static_folder, 'post', 'late.jpg')
+        self.upload().save(path)
+        url = '/static/post/late.jpg'
+        self.assertEqual(list(pending('post')), [path])
+        template = ("{% call cached_fragment('card', 1) %}"
+                    "{{ image_url(url, 'card') }}{% endcall %}")
+
+        self.assertEqual(render_template_string(template, url=url), url)
+        self.assertEqual(len(render.fragments.entries), 0)
+        # an enclosing fragment must not cache the fallback either
+        self.assertTrue(g.fragment_volatile)
+        g.fragment_volatile = False
+
+        # once the rendition exists the fragment is cached as usual
+        from app.images import schedule
+        schedule(path).result()
+        self.assertEqual(render_template_string(template, url=url),
+                         '/static/post/late.card.jpg')
+        self.assertEqual(len(render.fragments.entries), 1)
+
+    def test_not_an_image(self):
+        data = FileStorage(io.BytesIO(b'not an image'), filename='x.jpg')
+        url = save_image(data)
+        self.assertEqual(image_url(url, 'card'), url)
+        self.assertEqual(image_url('http://example.com/a.jpg', 'card'),
+                         'http://example.com/a.jpg')
@@ -0,0 +1,107 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Teacher, Lesson, NewLesson, \
+    LessonFile, Student
+
+
+class LessonModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_stats(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        s1 = User(email='susan@example.com', username='susan', password='dog')
+        s2 = User(email='david@example.com', username='david', password='dog')
+        db.session.add_all([u, s1, s2])
+        db.session.commit()
+        t = Teacher(teacher_id=u.id)
+        l = Lesson(teacher_id=u.id)
+        db.session.add_all([t, l])
+        db.session.commit()
+        nl = NewLesson(lesson_id=l.id)
+        db.session.add(nl)
+        db.session.commit()
+        f = LessonFile(lesson_id=l.id)
+        st1 = Student(student_id=s1.id, newlesson_id=nl.id, seat='0102')
+        st2 = Student(student_id=s2.id, newlesson_id=nl.id)
+        p = Post(body='hi', author=s1, tag='newlessons_' + str(nl.id))
+        db.session.add_all([f, st1, st2, p])
+        db.session.commit()
+        for x in (t, l, nl):
+            db.session.refresh(x)
+        self.assertEqual(nl.count_student(), 2)
+        self.assertEqual(nl.count_seat(), 1)
+        self.assertEqual(nl.count_exercise(), 0)
+        self.assertEqual(nl.count_discussion(), 1)
+        self.assertEqual(l.count_newlesson(), 1)
+        self.assertEqual(l.count_file(), 1)
+        self.assertEqual(l.count_student(), 2)
+        self.assertEqual(l.count_discussion(), 1)
+        self.assertEqual(t.count_lesson(), 1)
+        self.assertEqual(t.count_file(), 1)
+        self.assertEqual(t.count_student(), 2)
+        self.assertEqual(t.count_discussion(), 1)
+
+        st2.seat = '0203'
+        st2.topic = 'loops'
+        db.session.delete(st1)
+        db.session.delete(f)
+        db.session.delete(p)
+        db.session.commit()
+        for x in (t, l, nl):
+            db.session.refresh(x)
+        self.assertEqual(nl.count_student(), 1)
+        self.assertEqual(nl.count_seat(), 1)
+        self.assertEqual(nl.count_exercise(), 1)
+        self.assertEqual(nl.count_discussion(), 0)
+        self.assertEqual(t.count_file(), 0)
+        self.assertEqual(t.count_student(), 1)
+        self.assertEqual(t.count_discussion(), 0)
+
+        db.session.execute(NewLesson.__table__.update().values(
+            student_count=7, seat_count=7))
+        db.session.commit()
+        Teacher.rebuild_stats()
+        for x in (t, l, nl):
+            db.session.refresh(x)
+        self.assertEqual(nl.count_student(), 1)
+        self.assertEqual(nl.count_seat(), 1)
+        self.assertEqual(l.count_student(), 1)
+        self.assertEqual(t.count_student(), 1)
+
+        # edits that keep the parent leave the counters as they were
+        l.lesson_name = 'algebra'
+        nl.year = '2017'
+        db.session.commit()
+        db.session.refresh(t)
+        self.assertEqual(t.count_lesson(), 1)
+        self.assertEqual(t.count_student(), 1)
+
+    def test_post_newlesson_id(self):
+        l = Lesson()
+        db.session.add(l)
+        db.session.commit()
+        nl = NewLesson(lesson_id=l.id)
+        db.session.add(nl)
+        db.session.commit()
+        p1 = Post(body='class', tag='newlessons_' + str(nl.id))
+        p2 = Post(body='blog', tag='posts')
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(p1.newlesson_id, nl.id)
+        self.assertIsNone(p2.newlesson_id)
+        self.assertEqual(Post.query.filter_by(newlesson_id=nl.id).all(), [p1])
+        p2.tag = 'newlessons_' + str(nl.id)
+        db.session.commit()
+        db.session.refresh(nl)
+        self.assertEqual(p2.newlesson_id, nl.id)
+        self.assertEqual(nl.count_discussion(), 2)
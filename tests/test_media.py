@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app, db
+from app.media import media_url
+
+
+class MediaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.static_folder = tempfile.mkdtemp()
+        self.app.static_folder = self.static_folder
+        self.app.static_url_path = '/static'
+        self.app_context = self.app.test_request_context('/')
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.data = os.urandom(10000)
+        self.name = 'ab' + '0' * 38
+        for path in ('video/lecture.mp4', 'store/ab/%s.mp4' % self.name,
+                     'css/site.css'):
+            path = os.path.join(self.static_folder, path)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(self.data)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.static_folder)
+
+    def get(self, url, **headers):
+        headers.setdefault('Accept', 'application/json')
+        response = self.client.get(url, headers=headers)
+        body = response.get_data()
+        response.close()
+        return response, body
+
+    def test_media_url(self):
+        self.assertEqual(media_url('/static/video/lecture.mp4'),
+                         '/media/video/lecture.mp4')
+        self.assertEqual(media_url('http://example.com/a.mp4'),
+                         'http://example.com/a.mp4')
+
+    def test_range_and_conditional(self):
+        url = '/media/store/ab/%s.mp4' % self.name
+        response, body = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(response.mimetype, 'video/mp4')
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.headers['ETag'], '"%s"' % self.name)
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+
+        response, body = self.get(url, Range='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.data[100:200])
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 100-199/10000')
+        self.assertEqual(response.headers['Content-Length'], '100')
+
+        response, body = self.get(url, Range='bytes=9000-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.data[9000:])
+
+        response, body = self.get(url, **{'If-None-Match': '"%s"' % self.name})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(body, b'')
+
+        # a stale If-Range gets the whole file
+        response, body = self.get(url, Range='bytes=0-9',
+                                  **{'If-Range': '"other"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+
+        response, body = self.get(url, Range='bytes=20000-')
+        self.assertEqual(response.status_code, 416)
+
+        response, body = self.get(url, Range='bytes=0-9',
+                                  **{'If-Range': '"%s"' % self.name})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.data[:10])
+
+    def test_file_wrapper(self):
+        # a server's file_wrapper gets the real file, seeked to the range,
+        # and the Content-Length to send from it
+        wrapped = []
+
+        def file_wrapper(f, block_size):
+            wrapped.append((f.fileno(), f.tell()))
+            return iter([f.read()])
+
+        response = self.client.get(
+            '/media/store/ab/%s.mp4' % self.name,
+            headers={'Range': 'bytes=100-199'},
+            environ_overrides={'wsgi.file_wrapper': file_wrapper})
+        response.close()
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Length'], '100')
+        self.assertEqual(len(wrapped), 1)
+        self.assertEqual(wrapped[0][1], 100)
+
+    def test_legacy_file(self):
+        response, body = self.get('/media/video/lecture.mp4')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        response, body = self.get('/media/video/lecture.mp4',
+                                  **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_not_media(self):
+        for url in ('/media/css/site.css', '/media/video/missing.mp4',
+                    '/media/video/../css/site.css'):
+            response, body = self.get(url)
+            self.assertEqual(response.status_code, 404)
+
+    def test_offload(self):
+        url = '/media/store/ab/%s.mp4' % self.name
+        self.app.config['FLASKY_MEDIA_OFFLOAD'] = 'x-accel-redirect'
+        response, body = self.get(url, Range='bytes=0-9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, b'')
+        self.assertEqual(response.headers['X-Accel-Redirect'],
+                         '/protected-media/store/ab/%s.mp4' % self.name)
+        self.assertEqual(response.headers['ETag'], '"%s"' % self.name)
+        response, body = self.get(url, **{'If-None-Match': '"%s"' % self.name})
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('X-Accel-Redirect', response.headers)
+
+        self.app.config['FLASKY_MEDIA_OFFLOAD'] = 'x-sendfile'
+        response, body = self.get(url)
+        self.assertEqual(response.headers['X-Sendfile'], os.path.join(
+            self.static_folder, 'store', 'ab', '%s.mp4' % self.name))
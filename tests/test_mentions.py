@@ -0,0 +1,80 @@
+import json
+import unittest
+from flask_sqlalchemy import get_debug_queries
+from app import create_app, db
+from app.mentions import candidates, resolve, record_mentions, suggest
+from app.models import User, Role, Post, Comment, AtMe
+
+
+class MentionsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.users = {}
+        for i, username in enumerate(['john', 'susan', u'张三', 'sue']):
+            self.users[username] = User(
+                email='u%d@example.com' % i, username=username,
+                password='cat', confirmed=True)
+        db.session.add_all(self.users.values())
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_resolve(self):
+        self.assertEqual(candidates('hi @bob.')[0], ['bob.', 'bob', 'bo', 'b'])
+        self.assertEqual(candidates('mail john@example.com'), [])
+        with self.app.test_request_context():
+            before = len(get_debug_queries())
+            self.assertEqual(
+                [name for name, user_id in
+                 resolve(u'@susan @nobody @john, @susan again @张三你好')],
+                ['susan', 'john', u'张三'])
+            self.assertEqual(len(get_debug_queries()) - before, 1)
+        self.assertEqual(resolve('no mentions'), [])
+
+    def test_record_mentions(self):
+        post = Post(body='hello', author=self.users['john'])
+        comment = Comment(body=u'@susan @sue and @susan, see @张三', post=post,
+                          author=self.users['john'])
+        db.session.add_all([post, comment])
+        self.assertEqual(record_mentions(comment), ['susan', 'sue', u'张三'])
+        db.session.commit()
+        atmes = AtMe.query.order_by(AtMe.id).all()
+        self.assertEqual([a.username for a in atmes], ['susan', 'sue', u'张三'])
+        for atme in atmes:
+            self.assertEqual(atme.comment_id, comment.id)
+            self.assertEqual(atme.username_whoatme, 'john')
+        self.assertEqual(self.users['susan'].atme_count, 1)
+        self.assertEqual(self.users['john'].atme_count, 0)
+
+        # the counters agree with a full recount
+        User.reconcile_counters()
+        self.assertEqual(self.users['susan'].atme_count, 1)
+        self.assertEqual(self.users[u'张三'].atme_count, 1)
+
+    def test_views(self):
+        post = Post(body='hello', author=self.users['susan'])
+        db.session.add(post)
+        db.session.commit()
+        client = self.app.test_client()
+        client.set_cookie('localhost', 'english', 'yes')
+        client.post('/login', data={'email': 'u0@example.com',
+                                    'password': 'cat'})
+        response = client.post('/post/%d' % post.id,
+                               data={'body': '@susan thanks'})
+        self.assertEqual(response.status_code, 302)
+        atme = AtMe.query.one()
+        self.assertEqual(atme.username, 'susan')
+        self.assertEqual(atme.comment_id, Comment.query.one().id)
+
+        self.assertEqual([u.username for u in suggest('su')],
+                         ['sue', 'susan'])
+        response = client.get('/mention-suggestions?q=sus')
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([u['username'] for u in data['users']], ['susan'])
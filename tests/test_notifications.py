@@ -0,0 +1,137 @@
+import json
+import unittest
+from sqlalchemy.exc import IntegrityError
+from app import create_app, db
+from app.mentions import record_mentions
+from app.models import User, Role, Post, Comment, AtMe, Lesson, NewLesson, \
+    Student, ClickTime
+
+
+class NotificationsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.john = User(email='john@example.com', username='john',
+                         password='cat', confirmed=True)
+        self.susan = User(email='susan@example.com', username='susan',
+                          password='dog', confirmed=True)
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def unread(self, user):
+        return ClickTime.unread(user.id)
+
+    def test_counters(self):
+        post = Post(body='hello', author=self.john)
+        db.session.add(post)
+        db.session.add_all([
+            Comment(body='nice', post=post, author=self.susan),
+            Comment(body='thanks', post=post, author=self.john)])
+        self.susan.follow(self.john)
+        self.john.follow(self.john)
+        db.session.commit()
+        comment = Comment(body='@john @susan see this', post=post,
+                          author=self.susan)
+        db.session.add(comment)
+        record_mentions(comment)
+        db.session.add(AtMe(comment_id=comment.id, username='john',
+                            username_whoatme='susan'))
+        db.session.commit()
+
+        counts = self.unread(self.john)
+        self.assertEqual(counts['comments_on_me'], 2)
+        self.assertEqual(counts['followed_by'], 1)
+        self.assertEqual(counts['atme'], 2)
+        self.assertEqual(counts['total'], 5)
+        self.assertEqual(self.unread(self.susan)['total'], 0)
+
+        ClickTime.mark_read(self.john.id, 'comments_on_me')
+        db.session.commit()
+        clicktime = ClickTime.query.filter_by(user_id=self.john.id).one()
+        self.assertEqual(clicktime.unread_comments_on_me, 0)
+        self.assertIsNotNone(clicktime.user_comments_on_me)
+        self.assertEqual(self.unread(self.john)['total'], 3)
+
+    def test_one_row_per_user(self):
+        # created with the user, so notify() only ever updates it
+        self.assertEqual(ClickTime.query.filter_by(
+            user_id=self.susan.id).count(), 1)
+        db.session.add(ClickTime(user_id=self.susan.id))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_class_discussion(self):
+        lesson = Lesson(lesson_name='Maths', teacher_id=self.john.id)
+        db.session.add(lesson)
+        db.session.commit()
+        a = NewLesson(lesson_id=lesson.id)
+        b = NewLesson(lesson_id=lesson.id)
+        db.session.add_all([a, b])
+        db.session.commit()
+        db.session.add_all([
+            Student(student_id=self.susan.id, newlesson_id=a.id),
+            Student(student_id=self.susan.id, newlesson_id=b.id),
+            Student(student_id=self.john.id, newlesson_id=a.id)])
+        db.session.commit()
+        db.session.add_all([
+            Post(body='hw', author=self.john, newlesson_id=a.id),
+            Post(body='hw', author=self.john, newlesson_id=b.id),
+            Post(body='q', author=self.susan, newlesson_id=a.id),
+            Post(body='blog', author=self.john)])
+        db.session.commit()
+        self.assertEqual(self.unread(self.susan)['lesson_discussion'], 2)
+        self.assertEqual(self.unread(self.john)['lesson_discussion'], 1)
+
+        ClickTime.mark_discussion_read(self.susan.id, a.id)
+        db.session.commit()
+        self.assertEqual(self.unread(self.susan)['lesson_discussion'], 1)
+
+        # deleting a post, or tagging it out of the class, takes it back
+        posts = Post.query.filter(Post.newlesson_id != None).\
+            order_by(Post.id).all()
+        db.session.delete(posts[1])
+        db.session.commit()
+        self.assertEqual(self.unread(self.susan)['lesson_discussion'], 0)
+        self.assertEqual(self.unread(self.john)['lesson_discussion'], 1)
+        posts[2].tag = 'newlessons_%d' % b.id
+        db.session.commit()
+        self.assertEqual(self.unread(self.john)['lesson_discussion'], 0)
+        # susan read lesson a before, so she is not taken below zero
+        posts[0].tag = 'posts'
+        db.session.commit()
+        self.assertEqual(self.unread(self.susan)['lesson_discussion'], 0)
+        self.assertEqual(Student.query.filter(
+            Student.unread_discussion < 0).count(), 0)
+
+    def test_views(self):
+        post = Post(body='hello', author=self.john)
+        db.session.add(post)
+        db.session.add(Comment(body='nice', post=post, author=self.susan))
+        self.susan.follow(self.john)
+        db.session.commit()
+        client = self.app.test_client()
+        client.set_cookie('localhost', 'english', 'yes')
+        client.post('/login', data={'email': 'john@example.com',
+                                    'password': 'cat'})
+
+        response = client.get('/notifications')
+        self.assertEqual(response.status_code, 200)
+        counts = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(counts['total'], 2)
+        response = client.get('/notifications', headers={
+            'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        client.get('/followers/john')
+        client.get('/comments-on-me/%d' % self.john.id)
+        counts = json.loads(client.get('/notifications').data.decode('utf-8'))
+        self.assertEqual(counts['total'], 0)
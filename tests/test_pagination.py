@@ -0,0 +1,53 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import User, Role, Post
+from app.pagination import KeysetPagination
+
+
+class KeysetPaginationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def paginate(self, cursor=None):
+        return KeysetPagination(Post.query, (Post.timestamp, Post.id),
+                                cursor, per_page=10)
+
+    def test_walk(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        now = datetime.utcnow()
+        # pairs of posts share a timestamp so the id has to break ties
+        db.session.add_all([Post(body=str(i), author=u,
+                                 timestamp=now - timedelta(minutes=i // 2))
+                            for i in range(25)])
+        db.session.commit()
+        expected = Post.query.order_by(Post.timestamp.desc(),
+                                       Post.id.desc()).all()
+
+        pages = [self.paginate()]
+        self.assertFalse(pages[0].has_prev)
+        while pages[-1].has_next:
+            pages.append(self.paginate(pages[-1].next_cursor))
+        self.assertEqual([len(p.items) for p in pages], [10, 10, 5])
+        self.assertEqual([post for p in pages for post in p.items], expected)
+        self.assertEqual(pages[-1]._total, None)
+        self.assertEqual(pages[-1].total, 25)
+
+        back = self.paginate(pages[-1].prev_cursor)
+        self.assertEqual(back.items, pages[1].items)
+        self.assertTrue(back.has_next)
+        back = self.paginate(back.prev_cursor)
+        self.assertEqual(back.items, pages[0].items)
+        self.assertFalse(back.has_prev)
+
+        self.assertEqual(self.paginate('not-a-cursor').items, pages[0].items)
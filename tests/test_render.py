@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from app import render
+
+
+class RenderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.cache_dir = tempfile.mkdtemp()
+        self.app.config['FLASKY_RENDER_CACHE_DIR'] = self.cache_dir
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        render.cache.clear()
+        render.fragments.clear()
+
+    def tearDown(self):
+        render.cache.clear()
+        render.fragments.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_sanitize(self):
+        html = render.render_markdown(
+            '*hi* <script>alert(1)</script> http://example.com')
+        self.assertTrue('<em>hi</em>' in html)
+        self.assertFalse('<script>' in html)
+        self.assertTrue('<a href="http://example.com" rel="nofollow">'
+                        in html)
+        self.assertIsNone(render.render_markdown(None))
+
+    def test_cache(self):
+        u = User(email='john@example.com', password='cat')
+        p = Post(body='**same**', author=u)
+        db.session.add(p)
+        db.session.commit()
+        key = render.render_key('**same**')
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache_dir, key[:2], key + '.html')))
+
+        # a second post with the same text comes from the cache
+        render.cache.entries[key] = 'cached'
+        self.assertEqual(Post(body='**same**').body_html, 'cached')
+
+        # and so does a fresh process, from disk
+        render.cache.clear()
+        self.assertEqual(Post(body='**same**').body_html,
+                         '<p><strong>same</strong></p>')
+
+        self.app.config['FLASKY_RENDER_CACHE_SIZE'] = 2
+        for text in ('a', 'b', 'c'):
+            render.render_markdown(text)
+        self.assertEqual(list(render.cache.entries),
+                         [render.render_key('b'), render.render_key('c')])
+
+    def test_post_versions(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        p = Post(body='first', author=u)
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(p.version, 0)
+        p.body = 'second'
+        db.session.commit()
+        self.assertEqual(p.version, 1)
+        c = Comment(body='hi', post=p, author=u)
+        db.session.add(c)
+        db.session.commit()
+        db.session.refresh(p)
+        self.assertEqual(p.comment_count, 1)
+        self.assertEqual(p.version, 1)
+        u.username = 'johnny'
+        db.session.commit()
+        db.session.refresh(p)
+        self.assertEqual(p.version, 2)
+        db.session.delete(c)
+        db.session.commit()
+        db.session.refresh(p)
+        self.assertEqual(p.comment_count, 0)
+
+    def test_post_cards(self):
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True)
+        p = Post(body='first', author=u)
+        db.session.add(p)
+        db.session.commit()
+        client = self.app.test_client()
+        client.set_cookie('localhost', 'english', 'yes')
+        response = client.get('/')
+        self.assertTrue(b'first' in response.data)
+        self.assertEqual(len(render.fragments.entries), 1)
+        p.body = 'second'
+        db.session.add(Comment(body='hi', post=p, author=u))
+        db.session.commit()
+        response = client.get('/')
+        self.assertTrue(b'second' in response.data)
+        self.assertTrue(b'1  Comment' in response.data)
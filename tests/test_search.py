@@ -0,0 +1,150 @@
+import json
+import unittest
+from app import create_app, db, search
+from app.models import User, Role, Post, Comment, Lesson, Teacher
+
+
+class SearchTestCase(unittest.TestCase):
+    fts5 = True
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.url = str(db.engine.url)
+        search.fts5[self.url] = self.fts5 and search.has_fts5(db.engine)
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john',
+                         name=u'王小明', password='cat', confirmed=True)
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        search.fts5.pop(self.url, None)
+        self.app_context.pop()
+
+    def post(self, body, topic=None, **kwargs):
+        post = Post(body=body, topic=topic, author=self.user, **kwargs)
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def ids(self, q, kind=None, **kwargs):
+        with self.app.test_request_context():
+            return [(hit.kind, hit.item.id) for hit in
+                    search.search(q, kind, **kwargs).items]
+
+    def test_terms(self):
+        self.assertEqual(list(search.terms(u'Python 上课时间 (HTML5)')),
+                         ['python', u'上课', u'课时', u'时间', 'html5'])
+        self.assertEqual(list(search.terms(u'课')), [u'课'])
+        self.assertEqual(search.query_terms('a b a'), ['a', 'b'])
+
+    def test_search(self):
+        notice = self.post(u'下周一的上课时间改到九点。', topic=u'调课通知')
+        other = self.post(u'这是一篇关于通知栏设计的文章。')
+        self.post(u'Private notes about the exam', private=True)
+        comment = Comment(body=u'收到，上课时间已记下', post=notice,
+                          author=self.user)
+        lesson = Lesson(lesson_name=u'高等数学', about_lesson=u'微积分入门')
+        teacher = Teacher(school=u'第一中学', field=u'数学',
+                          teacher_id=self.user.id)
+        db.session.add_all([comment, lesson, teacher])
+        db.session.commit()
+
+        self.assertEqual(sorted(self.ids(u'上课时间')),
+                         [('comment', comment.id), ('post', notice.id)])
+        # a word in the title outranks the same word in the body
+        self.assertEqual(self.ids(u'通知'),
+                         [('post', notice.id), ('post', other.id)])
+        self.assertEqual(self.ids(u'数学'),
+                         [('teacher', teacher.id), ('lesson', lesson.id)])
+        self.assertEqual(self.ids(u'数学', kind='lesson'),
+                         [('lesson', lesson.id)])
+        self.assertEqual(self.ids(u'王小明'), [('user', self.user.id)])
+        self.assertEqual(self.ids('JOHN'), [('user', self.user.id)])
+        self.assertEqual(self.ids('exam'), [])
+        self.assertEqual(self.ids(u'上课 不存在'), [])
+        self.assertEqual(self.ids(''), [])
+
+        # edits, moderation and deletes are picked up
+        other.body = u'The exam moves to Friday'
+        comment.disabled = True
+        db.session.commit()
+        self.assertEqual(self.ids(u'通知'), [('post', notice.id)])
+        self.assertEqual(self.ids(u'Exam'), [('post', other.id)])
+        self.assertEqual(self.ids(u'记下'), [])
+        db.session.delete(notice)
+        db.session.commit()
+        self.assertEqual(self.ids(u'上课'), [])
+
+    def test_private_post_comments(self):
+        post = self.post(u'Grades are out', private=True)
+        comment = Comment(body=u'Mine is lower than expected', post=post,
+                          author=self.user)
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual(self.ids('expected'), [])
+        post.private = False
+        db.session.commit()
+        self.assertEqual(self.ids('expected'), [('comment', comment.id)])
+        post.private = True
+        db.session.commit()
+        self.assertEqual(self.ids('expected'), [])
+        self.assertEqual(search.rebuild(), 3)
+        self.assertEqual(self.ids('expected'), [])
+
+    def test_pages_and_rebuild(self):
+        for i in range(5):
+            self.post(u'homework %d' % i)
+        with self.app.test_request_context():
+            page = search.search('homework', page=2, per_page=2)
+        self.assertEqual(page.total, 5)
+        self.assertEqual(len(page.items), 2)
+        self.assertTrue(page.has_prev and page.has_next)
+
+        db.session.execute(Post.__table__.update().values(
+            body='essay'))   # behind the model events' back
+        db.session.commit()
+        self.assertEqual(len(self.ids('homework')), 5)
+        self.assertEqual(search.rebuild(), 6)
+        self.assertEqual(self.ids('homework'), [])
+        self.assertEqual(len(self.ids('essay')), 5)
+
+    def test_delete_views(self):
+        other = User(email='susan@example.com', username='susan',
+                     password='dog', confirmed=True)
+        teacher = Teacher(school=u'Riverside High', teacher_id=self.user.id)
+        db.session.add_all([other, teacher])
+        db.session.commit()
+        self.assertEqual(self.ids('susan'), [('user', other.id)])
+        self.assertEqual(self.ids('riverside'), [('teacher', teacher.id)])
+        client = self.app.test_client()
+        client.post('/login', data={'email': 'john@example.com',
+                                    'password': 'cat'})
+        client.get('/del-user/%d' % other.id)
+        client.get('/del-teacher/%d' % teacher.id)
+        with self.app.test_request_context():
+            self.assertEqual(search.search('susan').total, 0)
+            self.assertEqual(search.search('riverside').total, 0)
+
+    def test_views(self):
+        self.post(u'Midterm review session on Thursday', topic='Review')
+        client = self.app.test_client()
+        client.set_cookie('localhost', 'english', 'yes')
+        response = client.get('/search?q=midterm')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b'Midterm review' in response.data)
+        response = client.get('/api/v1.0/search?q=REVIEW')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(data['results'][0]['kind'], 'post')
+        self.assertTrue(data['results'][0]['url'].startswith('http://'))
+
+
+class InvertedIndexTestCase(SearchTestCase):
+    fts5 = False
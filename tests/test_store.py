@@ -0,0 +1,132 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from werkzeug.datastructures import FileStorage
+from app import create_app, db
+from app.models import Role, User, Post, Lesson, Teacher, Blob
+from app import store
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.static_folder = tempfile.mkdtemp()
+        self.app.static_folder = self.static_folder
+        self.app.static_url_path = '/static'
+        self.app_context = self.app.test_request_context('/')
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', password='cat')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.static_folder)
+
+    def upload(self, data=b'%PDF lecture notes', name='notes.PDF'):
+        return FileStorage(io.BytesIO(data), filename=name)
+
+    def blob(self, url):
+        return Blob.query.filter_by(path=url[len('/static/'):]).first()
+
+    def test_dedupe_on_upload(self):
+        url = store.save_file(self.upload())
+        self.assertTrue(url.startswith('/static/store/'))
+        self.assertTrue(url.endswith('.pdf'))
+        self.assertEqual(store.save_file(self.upload(name='copy.pdf')), url)
+        other = store.save_file(self.upload(data=b'other'))
+        self.assertNotEqual(other, url)
+        folder = os.path.join(self.static_folder, 'store')
+        files = [name for _, _, names in os.walk(folder) for name in names]
+        self.assertEqual(len(files), 2)
+        with open(os.path.join(self.static_folder,
+                               url[len('/static/'):]), 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF lecture notes')
+        blob = self.blob(url)
+        self.assertEqual(blob.size, len(b'%PDF lecture notes'))
+        self.assertEqual(len(blob.sha256), 64)
+
+    def test_refcount(self):
+        url = store.save_file(self.upload())
+        db.session.commit()
+        self.assertEqual(self.blob(url).refcount, 0)
+
+        post = Post(body='x', author=self.user, file1=url, file2=url)
+        lesson = Lesson(lesson_name='y', file1=url)
+        db.session.add_all([post, lesson])
+        db.session.commit()
+        self.assertEqual(self.blob(url).refcount, 3)
+
+        post = Post.query.get(post.id)
+        post.file2 = store.save_file(self.upload(data=b'other'))
+        db.session.commit()
+        self.assertEqual(self.blob(url).refcount, 2)
+        self.assertEqual(self.blob(post.file2).refcount, 1)
+
+        db.session.delete(Post.query.get(post.id))
+        db.session.commit()
+        self.assertEqual(self.blob(url).refcount, 1)
+
+        # unreferenced blobs are collected once they are old enough
+        lesson = Lesson.query.get(lesson.id)
+        lesson.file1 = None
+        db.session.commit()
+        self.assertEqual(store.collect(), 0)
+        Blob.query.update({Blob.timestamp: datetime.utcnow() -
+                           store.COLLECT_AFTER - timedelta(minutes=1)})
+        self.assertEqual(store.collect(), 2)
+        db.session.commit()
+        self.assertEqual(Blob.query.count(), 0)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.static_folder, url[len('/static/'):])))
+
+    def test_del_teacher(self):
+        url = store.save_file(self.upload())
+        teacher = Teacher(school='x', pic=url)
+        self.user.username, self.user.confirmed = 'john', True
+        db.session.add(teacher)
+        db.session.commit()
+        self.assertEqual(self.blob(url).refcount, 1)
+        client = self.app.test_client()
+        client.post('/login', data={'email': 'john@example.com',
+                                    'password': 'cat'})
+        response = client.get('/del-teacher/%d' % teacher.id)
+        self.assertEqual(response.status_code, 302)
+        self.assertIsNone(Teacher.query.get(teacher.id))
+        self.assertEqual(self.blob(url).refcount, 0)
+
+    def test_dedupe_legacy(self):
+        folder = os.path.join(self.static_folder, 'file')
+        os.makedirs(folder)
+        for name in ('a.pdf', 'b.pdf'):
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(b'%PDF same lecture')
+        post = Post(body='x', author=self.user, file1='/static/file/a.pdf',
+                    file2='/static/file/b.pdf', file3='/static/file/gone.pdf')
+        db.session.add(post)
+        db.session.commit()
+
+        stats = store.dedupe()
+        self.assertEqual(stats, {'files': 2, 'blobs': 1,
+                                 'bytes_saved': len(b'%PDF same lecture')})
+        post = Post.query.get(post.id)
+        self.assertEqual(post.file1, post.file2)
+        self.assertEqual(post.file3, '/static/file/gone.pdf')
+        self.assertEqual(self.blob(post.file1).refcount, 2)
+        self.assertEqual(os.listdir(folder), [])
+
+        # a file from before the store is removed when it is replaced
+        with open(os.path.join(folder, 'c.pdf'), 'wb') as f:
+            f.write(b'c')
+        store.release('/static/file/c.pdf')
+        store.release(post.file1)
+        self.assertEqual(os.listdir(folder), [])
+        self.assertTrue(os.path.exists(os.path.join(
+            self.static_folder, post.file1[len('/static/'):])))
@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from base64 import b64encode
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import User, Role, Post, Lesson, Upload, Blob
+from app.store import expire_uploads
+
+
+class UploadsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.folder = tempfile.mkdtemp()
+        self.app.static_folder = os.path.join(self.folder, 'static')
+        self.app.static_url_path = '/static'
+        self.app.config['FLASKY_UPLOAD_DIR'] = os.path.join(self.folder,
+                                                            'uploads')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+        self.user = User(email='john@example.com', password='cat',
+                         confirmed=True)
+        self.other = User(email='susan@example.com', password='dog',
+                          confirmed=True)
+        db.session.add_all([self.user, self.other])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.folder)
+
+    def headers(self, email='john@example.com', password='cat', **extra):
+        headers = {
+            'Authorization': 'Basic ' + b64encode(
+                (email + ':' + password).encode('utf-8')).decode('utf-8'),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+        headers.update(extra)
+        return headers
+
+    def start(self, data, filename='lecture.mp4'):
+        response = self.client.post(
+            '/api/v1.0/uploads/', headers=self.headers(),
+            data=json.dumps({'filename': filename, 'size': len(data)}))
+        self.assertEqual(response.status_code, 201)
+        return response.headers['Location']
+
+    def send(self, url, data, start):
+        return self.client.put(url, data=data, headers=self.headers(**{
+            'Content-Type': 'application/octet-stream',
+            'Content-Range': 'bytes %d-%d/*' % (start, start + len(data) - 1)
+        }))
+
+    def offset(self, url):
+        response = self.client.get(url, headers=self.headers())
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode('utf-8'))['offset']
+
+    def test_chunked_upload(self):
+        data = os.urandom(300 * 1024)
+        url = self.start(data)
+        self.assertEqual(self.offset(url), 0)
+
+        response = self.send(url, data[:100 * 1024], 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Upload-Offset'], str(100 * 1024))
+
+        # a retried or out of order chunk is refused with the real offset
+        response = self.send(url, data[:100 * 1024], 0)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.headers['Upload-Offset'], str(100 * 1024))
+
+        # finishing early is refused too
+        post = Post(body='video', author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        target = json.dumps({'target': 'post', 'id': post.id,
+                             'field': 'file4'})
+        response = self.client.post(url + '/complete', data=target,
+                                    headers=self.headers())
+        self.assertEqual(response.status_code, 409)
+
+        # resume from where the server says
+        start = self.offset(url)
+        self.assertEqual(self.send(url, data[start:], start).status_code, 200)
+        self.assertEqual(self.send(url, b'x', len(data)).status_code, 400)
+
+        # only the owner can see or attach it
+        self.assertEqual(self.client.get(url, headers=self.headers(
+            'susan@example.com', 'dog')).status_code, 403)
+        response = self.client.post(url + '/complete', data=target,
+                                    headers=self.headers())
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(json_response['url'].startswith('/static/store/'))
+        self.assertTrue(json_response['url'].endswith('.mp4'))
+
+        post = Post.query.get(post.id)
+        self.assertEqual(post.file4, json_response['url'])
+        self.assertEqual(post.filename4, 'lecture.mp4')
+        with open(os.path.join(self.app.static_folder,
+                               post.file4[len('/static/'):]), 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(Blob.query.one().refcount, 1)
+        self.assertEqual(Upload.query.count(), 0)
+        self.assertEqual(os.listdir(self.app.config['FLASKY_UPLOAD_DIR']), [])
+
+    def test_attach_permissions(self):
+        url = self.start(b'notes', filename='notes.pdf')
+        self.assertEqual(self.send(url, b'notes', 0).status_code, 200)
+        lesson = Lesson(lesson_name='algebra', teacher_id=self.other.id)
+        db.session.add(lesson)
+        db.session.commit()
+        for target, status in (({'target': 'lesson', 'id': lesson.id,
+                                 'field': 'file9'}, 400),
+                               ({'target': 'user', 'id': 1}, 400),
+                               ({'target': 'lesson', 'id': lesson.id,
+                                 'field': 'file2'}, 403)):
+            response = self.client.post(url + '/complete',
+                                        data=json.dumps(target),
+                                        headers=self.headers())
+            self.assertEqual(response.status_code, status)
+
+        lesson.teacher_id = self.user.id
+        db.session.commit()
+        response = self.client.post(url + '/complete', data=json.dumps(
+            {'target': 'lesson', 'id': lesson.id, 'field': 'file2'}),
+            headers=self.headers())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Lesson.query.get(lesson.id).filename2, 'notes.pdf')
+
+    def test_new_upload_validation(self):
+        for body in ({'filename': 'evil.exe', 'size': 10},
+                     {'filename': 'a.mp4', 'size': -1},
+                     {'filename': 'a.mp4',
+                      'size': self.app.config['FLASKY_UPLOAD_MAX_SIZE'] + 1}):
+            response = self.client.post('/api/v1.0/uploads/',
+                                        data=json.dumps(body),
+                                        headers=self.headers())
+            self.assertEqual(response.status_code, 400)
+
+    def test_expire(self):
+        url = self.start(b'abc')
+        upload = Upload.query.one()
+        path = upload.path
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(expire_uploads(), 0)
+        upload.timestamp = datetime.utcnow() - timedelta(days=2)
+        db.session.commit()
+        self.assertEqual(expire_uploads(), 1)
+        db.session.commit()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(Upload.query.count(), 0)
@@ -1,8 +1,10 @@
 import unittest
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from app import create_app, db
-from app.models import User, AnonymousUser, Role, Permission, Follow
+from app.models import User, AnonymousUser, Role, Permission, Follow, \
+    Post, Comment, AtMe, CollectPost, Timeline
+from app.presence import LastSeenTracker
 
 
 class UserModelTestCase(unittest.TestCase):
@@ -125,14 +127,56 @@ class UserModelTestCase(unittest.TestCase):
         self.assertTrue(
             (datetime.utcnow() - u.last_seen).total_seconds() < 3)
 
-    def test_ping(self):
-        u = User(password='cat')
-        db.session.add(u)
+    def test_last_seen_tracker(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
         db.session.commit()
-        time.sleep(2)
-        last_seen_before = u.last_seen
-        u.ping()
-        self.assertTrue(u.last_seen > last_seen_before)
+        start = u1.last_seen
+        tracker = LastSeenTracker()
+
+        # visits inside the threshold are not recorded at all
+        self.assertFalse(tracker.touch(u1, start + timedelta(seconds=30)))
+        self.assertTrue(tracker.touch(u1, start + timedelta(seconds=90)))
+        self.assertFalse(tracker.touch(u1, start + timedelta(seconds=120)))
+        self.assertTrue(tracker.touch(u2, start + timedelta(minutes=5)))
+        self.assertEqual(len(tracker.pending), 2)
+
+        # a comment posted after the visit stays unread
+        p = Post(body='post', author=u1)
+        db.session.add(p)
+        db.session.commit()
+        c1 = Comment(body='old', post=p, author=u2,
+                     timestamp=start + timedelta(seconds=60))
+        c2 = Comment(body='new', post=p, author=u2,
+                     timestamp=start + timedelta(seconds=100))
+        db.session.add_all([c1, c2])
+        db.session.commit()
+        self.assertEqual(tracker.flush(), 2)
+        # committed on its own, whatever happens to the request
+        db.session.rollback()
+        self.assertEqual(tracker.pending, {})
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, start + timedelta(seconds=90))
+        self.assertEqual(u2.last_seen, start + timedelta(minutes=5))
+        self.assertEqual(u1.commented_new_count, 1)
+
+        # an older pending visit never moves last_seen backwards
+        tracker.pending[u1.id] = start
+        tracker.flush()
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, start + timedelta(seconds=90))
+        self.assertEqual(tracker.flush(), 0)
+
+        # a failed flush puts its visits back behind any newer ones
+        tracker.pending[u2.id] = start + timedelta(minutes=20)
+        tracker.requeue({u1.id: start + timedelta(minutes=10),
+                         u2.id: start + timedelta(minutes=15)})
+        self.assertEqual(tracker.pending,
+                         {u1.id: start + timedelta(minutes=10),
+                          u2.id: start + timedelta(minutes=20)})
+        tracker.pending.clear()
 
     def test_gravatar(self):
         u = User(email='john@example.com', password='cat')
@@ -188,6 +232,50 @@ class UserModelTestCase(unittest.TestCase):
         db.session.commit()
         self.assertTrue(Follow.query.count() == 1)
 
+    def test_timeline(self):
+        self.app.config['FLASKY_TIMELINE_LENGTH'] = 3
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime.utcnow()
+        posts = [Post(body=str(i), author=u2,
+                      timestamp=now - timedelta(minutes=i)) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.count(), 0)
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(
+            u1.followed_posts.order_by(Timeline.timestamp.desc()).all(),
+            posts[:3])
+        p = Post(body='new', author=u2)
+        p1 = Post(body='mine', author=u1)
+        db.session.add_all([p, p1])
+        db.session.commit()
+        # posting does not trim the followers' timelines
+        self.assertEqual(u1.followed_posts.count(), 5)
+        self.assertEqual(Timeline.trim_all(), 2)
+        self.assertEqual(Timeline.trim_all(), 0)
+        self.assertEqual(
+            u1.followed_posts.order_by(Timeline.timestamp.desc()).all(),
+            [p1, p, posts[0]])
+        self.assertEqual(u2.followed_posts.count(), 3)
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.count(), 2)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [p1])
+        u1.follow(u2)
+        db.session.commit()
+        Timeline.query.delete()
+        db.session.commit()
+        Timeline.rebuild()
+        self.assertEqual(
+            u1.followed_posts.order_by(Timeline.timestamp.desc()).all(),
+            [p1, posts[0], posts[1]])
+
     def test_to_json(self):
         u = User(email='john@example.com', password='cat')
         db.session.add(u)
@@ -197,3 +285,80 @@ class UserModelTestCase(unittest.TestCase):
                          'posts', 'followed_posts', 'post_count']
         self.assertEqual(sorted(json_user.keys()), sorted(expected_keys))
         self.assertTrue('api/v1.0/users/' in json_user['url'])
+
+    def test_counters(self):
+        u1 = User(email='john@example.com', username='john', password='cat')
+        u2 = User(email='susan@example.org', username='susan', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        p1 = Post(body='public', author=u1)
+        p2 = Post(body='private', private=True, author=u1)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        c = Comment(body='hi @john', post=p1, author=u2)
+        db.session.add(c)
+        db.session.add(CollectPost(user_id=u2.id, post_id=p2.id))
+        db.session.commit()
+        db.session.add(AtMe(comment_id=c.id, username='john',
+                            username_whoatme='susan'))
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.private_count), (2, 1))
+        self.assertEqual((u1.commented_count, u1.atme_count), (1, 1))
+        self.assertEqual((u2.comment_count, u2.collected_count), (1, 1))
+        self.assertEqual((u1.followed_count, u1.follower_count), (2, 1))
+        self.assertEqual((u2.followed_count, u2.follower_count), (1, 2))
+
+        p2.private = False
+        db.session.add(p2)
+        db.session.delete(p1)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.private_count), (1, 0))
+        self.assertEqual((u1.commented_count, u1.followed_count), (0, 1))
+        self.assertEqual(u2.follower_count, 1)
+
+        User.query.update({'post_count': 7, 'atme_count': 0})
+        db.session.commit()
+        User.reconcile_counters()
+        self.assertEqual((u1.post_count, u1.atme_count), (1, 1))
+
+    def test_received_comments(self):
+        u1 = User(email='john@example.com', username='john', password='cat')
+        u2 = User(email='susan@example.org', username='susan', password='dog')
+        p1 = Post(body='first', author=u1)
+        p2 = Post(body='second', author=u1)
+        db.session.add_all([u1, u2, p1, p2])
+        db.session.commit()
+        db.session.add_all([Comment(body='a', post=p1, author=u2),
+                            Comment(body='b', post=p1, author=u2)])
+        db.session.commit()
+        self.assertEqual(u1.n_commented(), 2)
+        self.assertEqual(u1.n_commented_new(), 2)
+        self.assertEqual(u1.commented_new_count, 2)
+        self.assertEqual([(p, len(c)) for p, c in u1.commented()],
+                         [(p1, 2), (p2, 0)])
+        tracker = LastSeenTracker()
+        tracker.touch(u1, datetime.utcnow() + timedelta(minutes=5))
+        tracker.flush()
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(u1.n_commented_new(), 0)
+        self.assertEqual(u1.commented_new_count, 0)
+
+        # moving a comment moves its unread mark; a user who has never been
+        # seen has read nothing yet
+        p3 = Post(body='third', author=u2)
+        db.session.add(p3)
+        db.session.commit()
+        User.query.filter_by(id=u2.id).update({'last_seen': None})
+        comment = Comment.query.filter_by(body='a').one()
+        comment.post = p3
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(u1.commented_new_count, 0)
+        self.assertEqual(u2.commented_new_count, 1)
+        comment.post = p1
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(u2.commented_new_count, 0)